@@ -3,54 +3,206 @@ Model, view and controller representing configuration for the APBS code.
 """
 import os.path
 import attrs
-import enum
 import logging
 import pathlib
-import string
+import re
+import shutil
+import tempfile
 import textwrap
+import threading
 
 _log = logging.getLogger(__name__)
 
-from pymol.Qt import QtWidgets
+from pymol.Qt import (QtCore, QtWidgets)
 from .ui.views import APBSGroupBoxView
 from .ui.apbs_dialog_ui import Ui_apbs_dialog
-from . import pymol_api, grid, util
+from . import grid, pymol_api, util
+from .core import apbs_input, cache, memory
+from .core import grid as core_grid
+from .core.apbs_input import (ApbsModeEnum, BcflEnum, ChgmEnum, SrfmEnum,
+    SOLVER_DEFAULTS)
 
 # ------------------------------------------------------------------------------
 # Models
 
-ApbsModeEnum = util.labeled_enum_factory("ApbsModeEnum",
-    {
-        'npbe': 'Nonlinear Poisson-Boltzmann Equation',
-        'lpbe': 'Linearized Poisson-Boltzmann Equation'
-    }
-)
-
-BcflEnum = util.labeled_enum_factory("BcflEnum",
-    {
-        'zero': 'Zero',
-        'sdh': 'Single DH sphere',
-        'mdh': 'Multiple DH spheres',
-        'focus': 'Focusing'
-    }
-)
-
-ChgmEnum = util.labeled_enum_factory("ChgmEnum",
-    {
-        'spl0': 'Linear',
-        'spl2': 'Cubic B-splines',
-        'spl4': 'Quintic B-splines'
-    }
-)
-
-SrfmEnum = util.labeled_enum_factory("SrfmEnum",
-    {
-        'mol': 'Mol surf for epsilon; inflated VdW for kappa, no smoothing',
-        'smol': 'Same, but with harmonic average smoothing',
-        'spl2': 'Cubic spline', # valid?
-        'spl4': 'Similar to cubic spline, but with 7th order polynomial'
-    }
-)
+class APBSProgressParser():
+    """Estimate fractional progress of an APBS run from its output, one line at
+    a time. Each mg-auto/mg-manual calculation is split into setup, solve and
+    output phases; multigrid iteration lines (if any are printed) advance
+    progress within the solve phase.
+    """
+    _n_calcs_regex = re.compile(r'Preparing to run (\d+) PBE calculations')
+    _calc_regex = re.compile(r'CALCULATION #(\d+)')
+    _iter_regex = re.compile(r'\biter(?:ation)?s?\s*[=:]?\s*(\d+)', re.I)
+    # (line regex, fraction of current calculation done when line seen)
+    _phases = (
+        (re.compile(r'Setting up problem'), 0.05),
+        (re.compile(r'Solving PDE'), 0.2),
+        (re.compile(r'Calculating (forces|energy)'), 0.85),
+        (re.compile(r'Writing'), 0.9)
+    )
+    _SOLVE_START = 0.2
+    _SOLVE_END = 0.85
+
+    def __init__(self):
+        self.n_calcs = 1
+        self.calc_idx = 0
+        self.calc_frac = 0.
+        self.solving = False
+
+    @property
+    def fraction(self):
+        return min(1., (self.calc_idx + self.calc_frac) / self.n_calcs)
+
+    def parse_line(self, line):
+        """Update state from one line of APBS output; return True if the
+        progress estimate changed.
+        """
+        old_fraction = self.fraction
+        n_calcs_match = self._n_calcs_regex.search(line)
+        calc_match = self._calc_regex.search(line)
+        iter_match = self._iter_regex.search(line) if self.solving else None
+        if n_calcs_match:
+            self.n_calcs = max(int(n_calcs_match.group(1)), 1)
+        elif calc_match:
+            self.calc_idx = int(calc_match.group(1)) - 1
+            self.calc_frac = 0.
+            self.solving = False
+        elif iter_match:
+            # number of iterations to convergence isn't known in advance, so
+            # approach the end of the solve phase asymptotically
+            n_iter = int(iter_match.group(1))
+            self.calc_frac = self._SOLVE_START + (self._SOLVE_END - self._SOLVE_START) \
+                * (1. - 0.5 ** (n_iter / 5.))
+        else:
+            for regex, frac in self._phases:
+                if regex.search(line):
+                    self.calc_frac = max(self.calc_frac, frac)
+                    self.solving = (frac == self._SOLVE_START)
+                    break
+        return self.fraction != old_fraction
+
+class APBSRunner(util.PYQT_QOBJECT):
+    """Runs the APBS binary in a QProcess, streaming its stdout/stderr to the log
+    line by line and reporting estimated progress. `run()` blocks the calling
+    thread, and is intended to be called from a pipeline stage on a worker thread;
+    `kill()` may be called from any thread. After a run, `peak_rss_mb` holds each
+    process's measured peak memory use (None where it couldn't be measured.)
+    """
+    output_line = util.PYQT_SIGNAL(str)
+    progress_update = util.PYQT_SIGNAL(float)
+
+    POLL_MSEC = 100
+    TERMINATE_MSEC = 3000
+
+    def __init__(self, parent=None):
+        super(APBSRunner, self).__init__(parent)
+        self.kill_event = threading.Event()
+        self.peak_rss_mb = []
+
+    @util.PYQT_SLOT()
+    def kill(self):
+        self.kill_event.set()
+
+    def _terminate(self, proc):
+        _log.warning("Killing APBS process.")
+        proc.terminate()
+        if not proc.waitForFinished(self.TERMINATE_MSEC):
+            proc.kill()
+            proc.waitForFinished(self.TERMINATE_MSEC)
+
+    def _emit_lines(self, buf, data, parser, log_func, prefix="APBS"):
+        buf.extend(bytes(data))
+        *lines, rest = buf.split(b'\n')
+        buf[:] = rest
+        changed = False
+        for line in lines:
+            line = line.decode(errors='replace').rstrip()
+            if not line:
+                continue
+            log_func(f"{prefix}: {line}")
+            self.output_line.emit(line)
+            changed |= parser.parse_line(line)
+        return changed
+
+    def _start(self, args, work_dir):
+        proc = QtCore.QProcess()
+        proc.setWorkingDirectory(str(work_dir))
+        proc.start(str(args[0]), [str(a) for a in args[1:]])
+        if not proc.waitForStarted():
+            raise util.PluginDialogException(f"Couldn't start APBS: {proc.errorString()}")
+        return proc
+
+    def run(self, args, work_dir):
+        """Run the command line `args` in `work_dir`, returning APBS's exit code.
+        Raises CancelledException if `kill()` was called while it was running.
+        """
+        return self.run_parallel([args], work_dir)[0]
+
+    def run_parallel(self, args_list, work_dir, max_procs=None):
+        """Run each command line in `args_list` in `work_dir`, with up to
+        `max_procs` (default: all) processes running at once. Progress is
+        averaged over all commands. Returns a list of exit codes, with -1 for
+        abnormal exits.
+        """
+        self.kill_event.clear()
+        n_jobs = len(args_list)
+        max_procs = max_procs or n_jobs
+        parsers = [APBSProgressParser() for _ in args_list]
+        retvals = [None] * n_jobs
+        self.peak_rss_mb = [None] * n_jobs
+        running = dict() # job index -> (QProcess, stdout buffer, stderr buffer)
+        monitors = dict() # job index -> memory.RSSMonitor
+        next_job = 0
+
+        def _prefix(i):
+            return "APBS" if n_jobs == 1 else f"APBS[{i}]"
+
+        try:
+            while next_job < n_jobs or running:
+                if self.kill_event.is_set():
+                    for proc, _, _ in running.values():
+                        self._terminate(proc)
+                    running.clear()
+                    raise util.CancelledException
+                while next_job < n_jobs and len(running) < max_procs:
+                    proc = self._start(args_list[next_job], work_dir)
+                    running[next_job] = (proc, bytearray(), bytearray())
+                    monitors[next_job] = memory.RSSMonitor(proc.processId()).start()
+                    next_job += 1
+
+                changed = False
+                poll_msec = max(self.POLL_MSEC // len(running), 10)
+                for i, (proc, out_buf, err_buf) in list(running.items()):
+                    # returns False on timeout or process exit; check for both below
+                    proc.waitForReadyRead(poll_msec)
+                    changed |= self._emit_lines(out_buf, proc.readAllStandardOutput(),
+                        parsers[i], _log.info, _prefix(i))
+                    changed |= self._emit_lines(err_buf, proc.readAllStandardError(),
+                        parsers[i], _log.warning, _prefix(i))
+                    if proc.state() != QtCore.QProcess.NotRunning:
+                        continue
+                    self.peak_rss_mb[i] = monitors.pop(i).stop()
+                    # flush any unterminated final lines
+                    self._emit_lines(out_buf, bytes(proc.readAllStandardOutput()) + b'\n',
+                        parsers[i], _log.info, _prefix(i))
+                    self._emit_lines(err_buf, bytes(proc.readAllStandardError()) + b'\n',
+                        parsers[i], _log.warning, _prefix(i))
+                    if proc.exitStatus() != QtCore.QProcess.NormalExit:
+                        retvals[i] = -1
+                    else:
+                        retvals[i] = proc.exitCode()
+                    parsers[i].calc_idx, parsers[i].calc_frac = parsers[i].n_calcs, 0.
+                    del running[i]
+                    changed = True
+                if changed:
+                    self.progress_update.emit(sum(p.fraction for p in parsers) / n_jobs)
+        finally:
+            for proc, _, _ in running.values():
+                self._terminate(proc)
+            for monitor in monitors.values():
+                monitor.stop()
+        return retvals
 
 @util.attrs_define
 class APBSModel(util.BaseModel):
@@ -63,83 +215,218 @@ class APBSModel(util.BaseModel):
     apbs_dx_file: pathlib.Path = ""
     apbs_map_name: str = "apbs_map"
 
-    apbs_mode: ApbsModeEnum = ApbsModeEnum.npbe
-    bcfl: BcflEnum = BcflEnum.sdh # Boundary condition flag
-    ion_plus_one_conc: float = 0.15
-    ion_plus_one_rad: float = 2.0
-    ion_plus_two_conc: float = 0.0
-    ion_plus_two_rad: float = 2.0
-    ion_minus_one_conc: float = 0.15
-    ion_minus_one_rad: float = 1.8
-    ion_minus_two_conc: float = 0.0
-    ion_minus_two_rad: float = 2.0
-    interior_dielectric: float = 2.0
-    solvent_dielectric: float = 78.0
-    chgm: ChgmEnum = ChgmEnum.spl2  # Charge disc method for APBS
-    solvent_radius: float = 1.4
-    system_temp: float = 310.0
-    # sdens: Specify the number of grid points per square-angstrom to use in Vacc
-    # object. Ignored when srad is 0.0 (see srad) or srfm is spl2 (see srfm). There is a direct
-    # correlation between the value used for the Vacc sphere density, the accuracy of the Vacc
-    # object, and the APBS calculation time. APBS default value is 10.0.
-    sdens: float = 10.0
-    srfm: SrfmEnum = SrfmEnum.mol
+    # solver options; see apbs_input.SOLVER_DEFAULTS
+    apbs_mode: ApbsModeEnum = SOLVER_DEFAULTS['apbs_mode']
+    bcfl: BcflEnum = SOLVER_DEFAULTS['bcfl']
+    ion_plus_one_conc: float = SOLVER_DEFAULTS['ion_plus_one_conc']
+    ion_plus_one_rad: float = SOLVER_DEFAULTS['ion_plus_one_rad']
+    ion_plus_two_conc: float = SOLVER_DEFAULTS['ion_plus_two_conc']
+    ion_plus_two_rad: float = SOLVER_DEFAULTS['ion_plus_two_rad']
+    ion_minus_one_conc: float = SOLVER_DEFAULTS['ion_minus_one_conc']
+    ion_minus_one_rad: float = SOLVER_DEFAULTS['ion_minus_one_rad']
+    ion_minus_two_conc: float = SOLVER_DEFAULTS['ion_minus_two_conc']
+    ion_minus_two_rad: float = SOLVER_DEFAULTS['ion_minus_two_rad']
+    interior_dielectric: float = SOLVER_DEFAULTS['interior_dielectric']
+    solvent_dielectric: float = SOLVER_DEFAULTS['solvent_dielectric']
+    chgm: ChgmEnum = SOLVER_DEFAULTS['chgm']
+    solvent_radius: float = SOLVER_DEFAULTS['solvent_radius']
+    system_temp: float = SOLVER_DEFAULTS['system_temp']
+    sdens: float = SOLVER_DEFAULTS['sdens']
+    srfm: SrfmEnum = SOLVER_DEFAULTS['srfm']
+
+    # Parallel focusing (mg-para): split the domain among n_procs APBS processes
+    # run concurrently, then stitch their maps together
+    mg_para: bool = False
+    n_procs: int = 0 # 0 = number of cores
+    # subdomains per axis used by the most recent input file; empty for mg-auto
+    para_pdime: list = attrs.Factory(list)
+    # grid values used by the most recent input file
+    run_grid_values: dict = attrs.Factory(dict)
+
+    # estimates memory use from previous runs' measured peak RSS; shared with
+    # the grid models
+    memory_model: memory.MemoryModel
+
+    use_cache: bool = True
+    cache_dir: pathlib.Path = "" # empty = cache.default_cache_dir()
+    cache_max_size: int = 5000 # MB
+    # map file produced by the most recent run (APBS output or cache entry)
+    apbs_result_file: pathlib.Path = ""
+
+    runner: APBSRunner = attrs.Factory(APBSRunner)
+
+    def __attrs_post_init__(self):
+        super().__attrs_post_init__()
+        self._work_dir = None # TemporaryDirectory for unset paths; see _default_paths()
 
     def template_apbs_values(self):
-        return attrs.asdict(self)
+        # only the solver options; other fields aren't used by the template
+        return attrs.asdict(self, recurse=False,
+            filter=lambda a, _: a.name in apbs_input.SOLVER_DEFAULTS)
 
-    @staticmethod
-    def template_grid_values(grid_model):
-        return {
-            'grid_coarse_x': grid_model.coarse_dim[0],
-            'grid_coarse_y': grid_model.coarse_dim[1],
-            'grid_coarse_z': grid_model.coarse_dim[2],
-            'grid_fine_x': grid_model.fine_dim[0],
-            'grid_fine_y': grid_model.fine_dim[1],
-            'grid_fine_z': grid_model.fine_dim[2],
-            'grid_center_x': grid_model.center[0],
-            'grid_center_y': grid_model.center[1],
-            'grid_center_z': grid_model.center[2],
-            'grid_points_x': grid_model.fine_grid_pts[0],
-            'grid_points_y': grid_model.fine_grid_pts[1],
-            'grid_points_z': grid_model.fine_grid_pts[2]
-        }
+    def cache_key_values(self):
+        return apbs_input.solver_values(self.template_apbs_values())
 
-    def write_APBS_input_file(self, pqr_filename, grid_model):
-        template_path = os.path.join(
-            os.path.dirname(os.path.abspath(__file__)),
-            'apbs_input_template.txt'
+    def map_cache(self):
+        return cache.MapCache(
+            cache_dir = self.cache_dir or cache.default_cache_dir(),
+            max_size_mb = self.cache_max_size
         )
-        if not os.path.isfile(template_path):
-            raise util.PluginDialogException(f"APBS template file not found at {template_path}.")
-
-        with open(template_path, 'r') as f:
-            apbs_template = string.Template(f.read())
-        _log.debug("GOT THE APBS INPUT FILE")
-
-        if self.dx_filename.endswith('.dx'):
-            self.dx_filename = self.dx_filename[:-3]
 
-        template_dict = dict()
-        template_dict.update(self.template_grid_values(grid_model))
-        template_dict.update(self.template_apbs_values())
-
-        apbs_input_text = apbs_template.substitute(template_dict)
-        _log.debug("GOT THE APBS INPUT FILE")
+    @staticmethod
+    def template_grid_values(grid_model):
+        return apbs_input.template_grid_values(grid_model)
+
+    def input_grid_values(self, grid_model):
+        """Grid values for the input file: those of `grid_model` for mg-auto, or
+        for mg-para, per-subdomain grid points and the decomposition.
+        """
+        grid_values = self.template_grid_values(grid_model)
+        if self.mg_para:
+            n_procs = self.n_procs or os.cpu_count() or 1
+            nfocus = memory.focus_levels(grid_model.coarse_dim, grid_model.fine_dim)
+            pdime, dime = core_grid.para_decomposition(
+                grid_model.fine_grid_points, n_procs, grid_model.max_mem_allowed,
+                mem_coefficients = self.memory_model.linear_coefficients(
+                    self.apbs_mode.name, nfocus
+                )
+            )
+            grid_values.update(apbs_input.para_grid_values(pdime, dime))
+        return grid_values
+
+    def _default_paths(self):
+        """Put the APBS input and map files in a temporary working directory
+        owned by the model, unless their paths have been set. The directory is
+        removed by cleanup(), or at the latest when python exits.
+        """
+        if not self.apbs_config_file or not self.apbs_dx_file:
+            if self._work_dir is None:
+                self._work_dir = tempfile.TemporaryDirectory(prefix='apbs_plugin_')
+            if not self.apbs_config_file:
+                self.apbs_config_file = os.path.join(self._work_dir.name, 'apbs_input.in')
+            if not self.apbs_dx_file:
+                self.apbs_dx_file = os.path.join(self._work_dir.name, 'apbs_pot.dx')
+
+    def cleanup(self):
+        """Remove the temporary working directory made by _default_paths() and
+        reset the paths that pointed into it.
+        """
+        if self._work_dir is None:
+            return
+        work_dir = self._work_dir.name
+        for field in ('apbs_config_file', 'apbs_dx_file', 'apbs_result_file'):
+            if os.path.dirname(str(getattr(self, field))) == work_dir:
+                setattr(self, field, "")
+        self._work_dir.cleanup()
+        self._work_dir = None
 
+    def write_APBS_input_file(self, pqr_filename, grid_model):
+        self._default_paths()
+        grid_values = self.input_grid_values(grid_model)
+        self.para_pdime = apbs_input.para_pdime(grid_values)
+        self.run_grid_values = grid_values
         try:
-            with open(self.apbs_config_file, 'w') as f:
-                f.write(apbs_input_text)
-        except Exception:
+            if self.para_pdime:
+                apbs_input.write_para_input_files(self.apbs_config_file, pqr_filename,
+                    self.apbs_dx_file, self.template_apbs_values(), grid_values)
+            else:
+                apbs_input_text = apbs_input.format_apbs_input(pqr_filename, self.apbs_dx_file,
+                    self.template_apbs_values(), grid_values)
+                with open(self.apbs_config_file, 'w') as f:
+                    f.write(apbs_input_text)
+        except OSError:
             raise util.PluginDialogException(f"Couldn't write file to  {self.apbs_config_file}.")
+        _log.debug("GOT THE APBS INPUT FILE")
 
     def run_apbs(self):
-        # TODO
-        pass
+        """Run APBS on the config file written by `write_APBS_input_file`.
+        Blocks until APBS exits; progress is reported through `runner`'s Signals.
+        """
+        apbs_path = str(self.apbs_path) or shutil.which('apbs')
+        if not apbs_path:
+            raise util.PluginDialogException("Couldn't find the apbs binary; please "
+                "set its path in the APBS options.")
+        config_file = os.path.abspath(self.apbs_config_file)
+        if self.para_pdime:
+            return self._run_apbs_para(apbs_path, config_file)
+        _log.info(f"Running APBS: {apbs_path} {config_file}")
+        retval = self.runner.run([apbs_path, config_file], os.path.dirname(config_file))
+        if retval != 0:
+            raise util.PluginDialogException(f"APBS returned {retval}; check the "
+                "PyMOL log for its output.")
+        if not os.path.isfile(self.apbs_dx_file):
+            raise util.PluginDialogException(f"APBS didn't write a potential map "
+                f"to {self.apbs_dx_file}.")
+        self.record_memory_use()
+        self.apbs_result_file = self.apbs_dx_file
+
+    def record_memory_use(self):
+        """Add the peak memory measured for the last run to `memory_model`, so
+        that later grids are sized from measured rather than assumed usage.
+        """
+        peaks = [p for p in self.runner.peak_rss_mb if p]
+        if not peaks:
+            return
+        dime, nfocus = apbs_input.run_memory_params(self.run_grid_values)
+        self.memory_model.add_sample(self.apbs_mode.name, dime, nfocus, max(peaks))
+        try:
+            self.memory_model.save()
+        except OSError as exc:
+            _log.warning(f"Couldn't save memory samples: {exc}")
+
+    def _run_apbs_para(self, apbs_path, config_file):
+        # one APBS process per subdomain, then stitch the partial maps
+        files = apbs_input.para_files(config_file, self.apbs_dx_file, self.para_pdime)
+        n_procs = self.n_procs or os.cpu_count() or 1
+        _log.info(f"Running {len(files)} APBS processes (mg-para, pdime "
+            f"{self.para_pdime}), {min(n_procs, len(files))} at a time.")
+        retvals = self.runner.run_parallel(
+            [[apbs_path, in_file] for in_file, _ in files],
+            os.path.dirname(config_file), max_procs=n_procs
+        )
+        failed = [str(i) for i, retval in enumerate(retvals) if retval != 0]
+        if failed:
+            raise util.PluginDialogException(f"APBS returned nonzero for "
+                f"subdomain(s) {', '.join(failed)}; check the PyMOL log for its output.")
+        self.record_memory_use()
+        try:
+            apbs_input.stitch_para_maps([dx_file for _, dx_file in files], self.apbs_dx_file,
+                self.para_pdime)
+        except (OSError, util.PluginException) as exc:
+            raise util.PluginDialogException(f"Couldn't combine mg-para potential maps: {exc}")
+        self.apbs_result_file = self.apbs_dx_file
+
+    def run_apbs_cached(self, pqr_filename):
+        """Look up the potential map for the inputs of the file written by
+        `write_APBS_input_file` in the on-disk cache, and only run APBS on a miss.
+        """
+        if not self.use_cache:
+            return self.run_apbs()
+        map_cache = self.map_cache()
+        key = map_cache.key(pqr_filename, self.cache_key_values(), self.run_grid_values)
+        cached_file = map_cache.get(key)
+        if cached_file is not None:
+            _log.info("Inputs unchanged from a previous run; skipping APBS.")
+            self.apbs_result_file = cached_file
+            return
+        self.run_apbs()
+        try:
+            # load from the cached copy, so the map can be unloaded from the
+            # session without writing it out again (see PyMolModel.load_dx())
+            self.apbs_result_file = map_cache.put(key, self.apbs_dx_file)
+        except OSError as exc:
+            # not fatal: we still have the result
+            _log.warning(f"Couldn't add potential map to cache: {exc}")
 
     def load_apbs_map(self):
-        # TODO
-        pass
+        """Load the potential map written by APBS into PyMol (see
+        PyMolModel.load_dx().) Returns statistics of the map's values, gathered
+        while parsing.
+        """
+        dx_file = self.apbs_result_file or self.apbs_dx_file
+        # maps unloaded to save memory are kept in the same cache
+        self.pymol_cmd.map_cache = self.map_cache()
+        return self.pymol_cmd.load_dx(dx_file, self.apbs_map_name).get_stats()
 # ------------------------------------------------------------------------------
 # Views
 
@@ -155,51 +442,54 @@ class APBSDialogView(QtWidgets.QDialog, Ui_apbs_dialog):
 # ------------------------------------------------------------------------------
 # Controller
 
-class APBSDialogController(util.BaseController):
+class APBSDialogController(util.DialogController):
     def __init__(self, model):
         super(APBSDialogController, self).__init__()
         self.model = model
-        self.view = APBSDialogView()
-
-        util.biconnect(self.view.mode_comboBox, self.model, "apbs_mode")
-        util.biconnect(self.view.protein_eps_doubleSpinBox, self.model, "interior_dielectric")
-        util.biconnect(self.view.solvent_eps_doubleSpinBox, self.model, "solvent_dielectric")
-        util.biconnect(self.view.solvent_r_doubleSpinBox, self.model, "solvent_radius")
-        util.biconnect(self.view.vacc_doubleSpinBox, self.model, "sdens")
-        util.biconnect(self.view.sys_temp_doubleSpinBox, self.model, "system_temp")
-        util.biconnect(self.view.bc_comboBox, self.model, "bcfl")
-        util.biconnect(self.view.charge_disc_comboBox, self.model, "chgm")
-        util.biconnect(self.view.surf_calc_comboBox, self.model, "srfm")
-
-        self.model.apbs_mode.init_combobox(self.view.mode_comboBox)
-        self.model.bcfl.init_combobox(self.view.bc_comboBox)
-        self.model.chgm.init_combobox(self.view.mode_comboBox)
-        self.model.srfm.init_combobox(self.view.surf_calc_comboBox)
+
+    def init_view(self):
+        view = APBSDialogView()
+
+        util.biconnect(view.mode_comboBox, self.model, "apbs_mode")
+        util.biconnect(view.protein_eps_doubleSpinBox, self.model, "interior_dielectric")
+        util.biconnect(view.solvent_eps_doubleSpinBox, self.model, "solvent_dielectric")
+        util.biconnect(view.solvent_r_doubleSpinBox, self.model, "solvent_radius")
+        util.biconnect(view.vacc_doubleSpinBox, self.model, "sdens")
+        util.biconnect(view.sys_temp_doubleSpinBox, self.model, "system_temp")
+        util.biconnect(view.bc_comboBox, self.model, "bcfl")
+        util.biconnect(view.charge_disc_comboBox, self.model, "chgm")
+        util.biconnect(view.surf_calc_comboBox, self.model, "srfm")
+
+        self.model.apbs_mode.init_combobox(view.mode_comboBox)
+        self.model.bcfl.init_combobox(view.bc_comboBox)
+        self.model.chgm.init_combobox(view.mode_comboBox)
+        self.model.srfm.init_combobox(view.surf_calc_comboBox)
 
         # TODO: ions_tableWidget
 
         # init view from model values
         self.model.refresh()
-
-    @util.PYQT_SLOT()
-    def exec_(self):
-        self.view.exec_()
+        return view
 
 class APBSGroupBoxController(util.BaseController):
     def __init__(self,
-        pymol_controller=None, view=None
+        pymol_controller=None, memory_model=None, view=None
     ):
         super(APBSGroupBoxController, self).__init__()
         if pymol_controller is None:
             raise ValueError
+        if memory_model is None:
+            memory_model = memory.MemoryModel.load()
         self.model = APBSModel(
-            pymol_cmd = pymol_controller.model.pymol_instance
+            pymol_cmd = pymol_controller.model,
+            memory_model = memory_model
         )
         self.dialog_controller = APBSDialogController(self.model)
 
         self.pymol_controller = pymol_controller
         self.grid_controller = grid.GridController(
-            pymol_controller = self.pymol_controller
+            pymol_controller = self.pymol_controller,
+            memory_model = memory_model
         )
         if view is None:
             self.view = APBSGroupBoxView()
@@ -0,0 +1,380 @@
+"""
+Headless batch mode: run the plugin's calculation (PQR -> grid -> APBS input ->
+APBS -> map) over many structures, without the GUI. Usage:
+
+    python -m APBS_Qt_plugin.batch [options] --out-dir DIR STRUCTURE [STRUCTURE ...]
+
+Structures are PDB files (converted with pdb2pqr) or PQR files (used as-is).
+Jobs run in a process pool, and progress is recorded in a JSON manifest in
+`out-dir`. Re-running with the same `out-dir` resumes: structures that
+completed successfully are skipped, and failed or unfinished ones are re-run.
+"""
+import argparse
+import concurrent.futures
+import enum
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import logging
+_log = logging.getLogger(__name__)
+
+import attrs
+
+# only the Qt-free core is imported, so that workers start quickly
+from .core import apbs_input, cache, dx, grid, memory, pqr, psize, util
+
+# ------------------------------------------------------------------------------
+
+MANIFEST_NAME = 'manifest.json'
+
+@attrs.define
+class BatchJob():
+    """Everything a worker process needs to run the calculation on one
+    structure. Must be picklable.
+    """
+    structure: str
+    job_dir: str
+    apbs_path: str
+    pdb2pqr_path: str = ""
+    pdb2pqr_flags: str = "--ff=AMBER"
+    max_mem_allowed: int = 2500
+    para_procs: int = 0 # if > 1, use mg-para with this many APBS processes
+    apbs_values: dict = attrs.Factory(lambda: parse_apbs_options([]))
+    use_cache: bool = True
+    cache_dir: str = ""
+    cache_max_size: int = 5000
+    memory_samples: str = "" # empty = memory.default_samples_path()
+
+def _run_logged(args, log_path, cwd=None):
+    with open(log_path, 'a') as log_f:
+        log_f.write(f"$ {' '.join(shlex.quote(str(a)) for a in args)}\n")
+        log_f.flush()
+        return subprocess.run(
+            [str(a) for a in args], cwd=cwd, stdout=log_f, stderr=subprocess.STDOUT
+        ).returncode
+
+def _run_apbs_monitored(args_list, log_path, cwd):
+    # run APBS processes concurrently; return (exit codes, peak RSS in MB)
+    with open(log_path, 'a') as log_f:
+        procs, monitors = [], []
+        for args in args_list:
+            log_f.write(f"$ {' '.join(shlex.quote(str(a)) for a in args)}\n")
+            log_f.flush()
+            procs.append(subprocess.Popen([str(a) for a in args], cwd=cwd,
+                stdout=log_f, stderr=subprocess.STDOUT))
+            monitors.append(memory.RSSMonitor(procs[-1].pid).start())
+        retvals = [proc.wait() for proc in procs]
+    peaks = [p for p in (m.stop() for m in monitors) if p]
+    return retvals, (max(peaks) if peaks else None)
+
+def write_pqr(job, log_path):
+    """Stage 1: generate (or copy) the PQR file; return its path."""
+    stem, ext = os.path.splitext(os.path.basename(job.structure))
+    pqr_filename = os.path.join(job.job_dir, stem + '.pqr')
+    if ext.lower() == '.pqr':
+        shutil.copyfile(job.structure, pqr_filename)
+    else:
+        if not job.pdb2pqr_path:
+            raise util.PluginException("Couldn't find pdb2pqr, needed to convert "
+                f"{job.structure}.")
+        args = [job.pdb2pqr_path] + shlex.split(job.pdb2pqr_flags) \
+            + [job.structure, pqr_filename]
+        retval = _run_logged(args, log_path, cwd=job.job_dir)
+        if retval != 0:
+            raise util.PluginException(f"pdb2pqr returned {retval}; see {log_path}.")
+    unassigned = pqr.clean_pqr_file(pqr_filename)
+    if unassigned:
+        raise util.PluginException(f"Unable to assign parameters for "
+            f"{len(unassigned)} atoms (IDs {'+'.join(unassigned)}).")
+    return pqr_filename
+
+def size_grid(job, pqr_filename, memory_model):
+    """Stage 2: grid parameters, as computed by GridPSizeModel."""
+    grid_params = psize.run_psize(pqr_filename, gmemceil=job.max_mem_allowed)
+    grid_params.fine_grid_points = grid.correct_fine_grid(
+        grid_params.fine_grid_points, job.max_mem_allowed,
+        memory_model.linear_coefficients(job.apbs_values['apbs_mode'],
+            memory.focus_levels(grid_params.coarse_dim, grid_params.fine_dim))
+    )
+    return grid_params
+
+def write_apbs_input(job, pqr_filename, config_file, dx_filename, grid_values):
+    """Stage 3: write the APBS input file, or one per process for mg-para."""
+    if apbs_input.para_pdime(grid_values):
+        apbs_input.write_para_input_files(config_file, pqr_filename, dx_filename,
+            job.apbs_values, grid_values)
+    else:
+        with open(config_file, 'w') as f:
+            f.write(apbs_input.format_apbs_input(
+                pqr_filename, dx_filename, job.apbs_values, grid_values
+            ))
+
+def run_apbs(job, config_file, dx_filename, grid_values, log_path):
+    """Stage 4: run APBS, or for mg-para, one APBS process per subdomain
+    concurrently and then stitch their maps. Returns peak memory use (MB) of the
+    APBS processes, or None if it couldn't be measured.
+    """
+    pdime = apbs_input.para_pdime(grid_values)
+    if not pdime:
+        (retval,), peak_mb = _run_apbs_monitored(
+            [[job.apbs_path, config_file]], log_path, job.job_dir
+        )
+        if retval != 0 or not os.path.isfile(dx_filename):
+            raise util.PluginException(f"APBS returned {retval}; see {log_path}.")
+        return peak_mb
+    files = apbs_input.para_files(config_file, dx_filename, pdime)
+    retvals, peak_mb = _run_apbs_monitored(
+        [[job.apbs_path, in_file] for in_file, _ in files], log_path, job.job_dir
+    )
+    failed = [str(i) for i, retval in enumerate(retvals) if retval != 0]
+    if failed:
+        raise util.PluginException(f"APBS returned nonzero for subdomain(s) "
+            f"{', '.join(failed)}; see {log_path}.")
+    apbs_input.stitch_para_maps([dx_file for _, dx_file in files], dx_filename, pdime)
+    return peak_mb
+
+def run_job(job):
+    """Run the full calculation for one structure. Called in a worker process;
+    returns a manifest entry rather than raising.
+    """
+    start = time.time()
+    os.makedirs(job.job_dir, exist_ok=True)
+    log_path = os.path.join(job.job_dir, 'job.log')
+    entry = {'structure': job.structure, 'job_dir': job.job_dir, 'log': log_path}
+    stage = None
+    try:
+        stage = 'pqr'
+        pqr_filename = write_pqr(job, log_path)
+
+        stage = 'grid'
+        memory_model = memory.MemoryModel.load(job.memory_samples or None)
+        grid_params = size_grid(job, pqr_filename, memory_model)
+        grid_values = apbs_input.template_grid_values(grid_params)
+        if job.para_procs > 1:
+            grid_values.update(apbs_input.para_grid_values(*grid.para_decomposition(
+                grid_params.fine_grid_points, job.para_procs, job.max_mem_allowed,
+                mem_coefficients = memory_model.linear_coefficients(
+                    job.apbs_values['apbs_mode'],
+                    memory.focus_levels(grid_params.coarse_dim, grid_params.fine_dim)
+                )
+            )))
+
+        stage = 'apbs_input'
+        dx_filename = os.path.join(job.job_dir, 'potential.dx')
+        config_file = os.path.join(job.job_dir, 'apbs.in')
+        write_apbs_input(job, pqr_filename, config_file, dx_filename, grid_values)
+
+        stage = 'apbs'
+        map_cache = cache.MapCache(
+            cache_dir = job.cache_dir or cache.default_cache_dir(),
+            max_size_mb = job.cache_max_size
+        ) if job.use_cache else None
+        key = cached_file = None
+        if map_cache is not None:
+            key = map_cache.key(pqr_filename, apbs_input.solver_values(job.apbs_values), grid_values)
+            cached_file = map_cache.get(key)
+        if cached_file is not None:
+            shutil.copyfile(cached_file, dx_filename)
+            entry['cache_hit'] = True
+        else:
+            peak_mb = run_apbs(job, config_file, dx_filename, grid_values, log_path)
+            if peak_mb is not None:
+                dime, nfocus = apbs_input.run_memory_params(grid_values)
+                entry['memory'] = {'mode': job.apbs_values['apbs_mode'],
+                    'dime': dime, 'nfocus': nfocus, 'peak_mb': peak_mb}
+            if map_cache is not None:
+                map_cache.put(key, dx_filename)
+            entry['cache_hit'] = False
+
+        stage = 'map'
+        dx_map = dx.read_dx(dx_filename)
+        stats = dx_map.get_stats()
+        entry.update({
+            'status': 'ok',
+            'dx_file': dx_filename,
+            'counts': list(dx_map.counts),
+            'origin': list(dx_map.origin),
+            'delta': list(dx_map.delta),
+            'min': stats.min,
+            'max': stats.max,
+            'mean': stats.mean,
+            'std': stats.std
+        })
+    except Exception as exc:
+        entry.update({'status': 'failed', 'stage': stage,
+            'error': f"{type(exc).__name__}: {exc}"})
+    entry['elapsed'] = time.time() - start
+    return entry
+
+# ------------------------------------------------------------------------------
+
+def physical_memory_mb():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024. * 1024.)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def n_workers(max_mem_allowed, max_workers=None, mem_budget=None, para_procs=0):
+    """Size the process pool by number of cores (each job using `para_procs` of
+    them if running mg-para), and by how many jobs of `max_mem_allowed` MB fit
+    in `mem_budget` MB (default: physical memory).
+    """
+    n = (os.cpu_count() or 1) // max(para_procs, 1)
+    if max_workers:
+        n = min(n, max_workers)
+    if mem_budget is None:
+        mem_budget = physical_memory_mb()
+    if mem_budget:
+        n = min(n, int(mem_budget // max_mem_allowed))
+    return max(n, 1)
+
+def load_manifest(path):
+    if not os.path.isfile(path):
+        return dict()
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_manifest(manifest, path):
+    # write atomically, so an interrupted run leaves a usable manifest
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def job_dir_name(structure, taken):
+    stem = os.path.splitext(os.path.basename(structure))[0]
+    name, i = stem, 1
+    while name in taken:
+        i += 1
+        name = f"{stem}_{i}"
+    taken.add(name)
+    return name
+
+def run_batch(structures, out_dir, max_workers=None, mem_budget=None, force=False,
+    **job_kwargs):
+    """Run all `structures`, resuming from the manifest in `out_dir` if present.
+    Returns the manifest, a dict keyed on structure path.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+
+    taken = {os.path.basename(e['job_dir']) for e in manifest.values()}
+    jobs = []
+    for structure in structures:
+        structure = os.path.abspath(structure)
+        entry = manifest.get(structure, dict())
+        if not force and entry.get('status') == 'ok' \
+            and os.path.isfile(entry.get('dx_file', '')):
+            _log.info(f"Skipping {structure}: already done.")
+            continue
+        job_dir = entry.get('job_dir') or os.path.join(out_dir, job_dir_name(structure, taken))
+        jobs.append(BatchJob(structure=structure, job_dir=job_dir, **job_kwargs))
+        manifest[structure] = {'structure': structure, 'job_dir': job_dir, 'status': 'pending'}
+    save_manifest(manifest, manifest_path)
+    if not jobs:
+        return manifest
+
+    # samples are recorded here rather than in the workers, so that concurrent
+    # jobs don't overwrite each other's
+    memory_model = memory.MemoryModel.load(jobs[0].memory_samples or None)
+    n = min(len(jobs), n_workers(
+        jobs[0].max_mem_allowed, max_workers, mem_budget, jobs[0].para_procs
+    ))
+    _log.info(f"Running {len(jobs)} jobs on {n} worker processes.")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n) as executor:
+        futures = {executor.submit(run_job, job): job for job in jobs}
+        for i, future in enumerate(concurrent.futures.as_completed(futures)):
+            job = futures[future]
+            try:
+                entry = future.result()
+            except Exception as exc:
+                # worker process died
+                entry = {'structure': job.structure, 'job_dir': job.job_dir,
+                    'status': 'failed', 'error': f"{type(exc).__name__}: {exc}"}
+            manifest[job.structure] = entry
+            save_manifest(manifest, manifest_path)
+            if 'memory' in entry:
+                memory_model.add_sample(**entry['memory'])
+                try:
+                    memory_model.save()
+                except OSError as exc:
+                    _log.warning(f"Couldn't save memory samples: {exc}")
+            _log.info(f"[{i + 1}/{len(jobs)}] {job.structure}: {entry['status']}"
+                + (f" ({entry['error']})" if entry['status'] != 'ok' else ""))
+    return manifest
+
+# ------------------------------------------------------------------------------
+
+def parse_apbs_options(option_strs):
+    """Apply NAME=VALUE overrides to the default solver options (see
+    apbs_input.SOLVER_DEFAULTS). Values are validated against the type of the
+    default, and returned as strings as they'd be substituted into the APBS
+    input template (which also keeps them picklable.)
+    """
+    values = apbs_input.default_solver_values()
+    for option in option_strs or []:
+        name, _, value = option.partition('=')
+        if name not in values:
+            raise ValueError(f"Unknown APBS option '{name}'.")
+        type_ = type(apbs_input.SOLVER_DEFAULTS[name])
+        if issubclass(type_, enum.Enum):
+            values[name] = type_[value]
+        else:
+            values[name] = type_(value)
+    return {k: str(v) for k, v in values.items()}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('structures', nargs='+', help="PDB or PQR files.")
+    parser.add_argument('--out-dir', required=True,
+        help="Directory for per-structure output and the manifest.")
+    parser.add_argument('--jobs', type=int, default=None,
+        help="Max number of worker processes (default: number of cores).")
+    parser.add_argument('--max-mem', type=int, default=2500,
+        help="Memory allowed per APBS job, in MB (as max_mem_allowed).")
+    parser.add_argument('--mem-budget', type=float, default=None,
+        help="Total memory for all jobs, in MB (default: physical memory).")
+    parser.add_argument('--para', type=int, default=0, metavar='N',
+        help="Split each calculation among N concurrent APBS processes (mg-para).")
+    parser.add_argument('--apbs', default=shutil.which('apbs') or "",
+        help="Path to the apbs binary.")
+    parser.add_argument('--pdb2pqr', default=shutil.which('pdb2pqr30') \
+        or shutil.which('pdb2pqr') or "", help="Path to the pdb2pqr binary.")
+    parser.add_argument('--pdb2pqr-flags', default="--ff=AMBER")
+    parser.add_argument('--set', dest='apbs_options', action='append', metavar='NAME=VALUE',
+        help="Override an APBS option, e.g. --set apbs_mode=lpbe. Repeatable.")
+    parser.add_argument('--no-cache', action='store_true',
+        help="Don't use the potential map cache.")
+    parser.add_argument('--cache-dir', default="")
+    parser.add_argument('--force', action='store_true',
+        help="Re-run structures that already completed.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if not args.apbs:
+        parser.error("Couldn't find apbs; specify with --apbs.")
+
+    manifest = run_batch(
+        args.structures, args.out_dir, max_workers=args.jobs,
+        mem_budget=args.mem_budget, force=args.force,
+        apbs_path=args.apbs, pdb2pqr_path=args.pdb2pqr,
+        pdb2pqr_flags=args.pdb2pqr_flags, max_mem_allowed=args.max_mem,
+        para_procs=args.para,
+        apbs_values=parse_apbs_options(args.apbs_options),
+        use_cache=not args.no_cache, cache_dir=args.cache_dir
+    )
+    n_failed = sum(1 for e in manifest.values() if e.get('status') != 'ok')
+    print(f"{len(manifest) - n_failed}/{len(manifest)} structures done; "
+        f"manifest: {os.path.join(args.out_dir, MANIFEST_NAME)}")
+    return 1 if n_failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,6 @@
+"""
+Computational core of the plugin: grid sizing, PQR file cleanup, APBS input
+generation and potential map I/O. Nothing in this package imports Qt or PyMol,
+so it can be used by headless workers (see batch.py) without initializing
+either; the Qt models in the parent package are layered on top of it.
+"""
@@ -0,0 +1,205 @@
+"""
+Generation of APBS input files from the solver options and grid parameters,
+and handling of the files written by mg-para runs.
+"""
+import os.path
+import string
+
+import logging
+_log = logging.getLogger(__name__)
+
+from . import dx, grid, memory, util
+
+# ------------------------------------------------------------------------------
+
+ApbsModeEnum = util.labeled_enum_factory("ApbsModeEnum",
+    {
+        'npbe': 'Nonlinear Poisson-Boltzmann Equation',
+        'lpbe': 'Linearized Poisson-Boltzmann Equation'
+    }
+)
+
+BcflEnum = util.labeled_enum_factory("BcflEnum",
+    {
+        'zero': 'Zero',
+        'sdh': 'Single DH sphere',
+        'mdh': 'Multiple DH spheres',
+        'focus': 'Focusing'
+    }
+)
+
+ChgmEnum = util.labeled_enum_factory("ChgmEnum",
+    {
+        'spl0': 'Linear',
+        'spl2': 'Cubic B-splines',
+        'spl4': 'Quintic B-splines'
+    }
+)
+
+SrfmEnum = util.labeled_enum_factory("SrfmEnum",
+    {
+        'mol': 'Mol surf for epsilon; inflated VdW for kappa, no smoothing',
+        'smol': 'Same, but with harmonic average smoothing',
+        'spl2': 'Cubic spline', # valid?
+        'spl4': 'Similar to cubic spline, but with 7th order polynomial'
+    }
+)
+
+# APBS options that determine the computed potential, and their defaults.
+# apbs.APBSModel's fields of the same names take their defaults from here.
+SOLVER_DEFAULTS = {
+    'apbs_mode': ApbsModeEnum.npbe,
+    'bcfl': BcflEnum.sdh, # Boundary condition flag
+    'ion_plus_one_conc': 0.15,
+    'ion_plus_one_rad': 2.0,
+    'ion_plus_two_conc': 0.0,
+    'ion_plus_two_rad': 2.0,
+    'ion_minus_one_conc': 0.15,
+    'ion_minus_one_rad': 1.8,
+    'ion_minus_two_conc': 0.0,
+    'ion_minus_two_rad': 2.0,
+    'interior_dielectric': 2.0,
+    'solvent_dielectric': 78.0,
+    'chgm': ChgmEnum.spl2, # Charge disc method for APBS
+    'solvent_radius': 1.4,
+    'system_temp': 310.0,
+    # sdens: Specify the number of grid points per square-angstrom to use in Vacc
+    # object. Ignored when srad is 0.0 (see srad) or srfm is spl2 (see srfm). There is a direct
+    # correlation between the value used for the Vacc sphere density, the accuracy of the Vacc
+    # object, and the APBS calculation time. APBS default value is 10.0.
+    'sdens': 10.0,
+    'srfm': SrfmEnum.mol
+}
+
+def solver_values(apbs_values):
+    """Subset of `apbs_values` that determine the solution, as strings. These
+    form the potential map cache key.
+    """
+    return {k: str(v) for k, v in apbs_values.items() if k in SOLVER_DEFAULTS}
+
+def default_solver_values():
+    return dict(SOLVER_DEFAULTS)
+
+def template_grid_values(grid_params):
+    """Template values for the grid of `grid_params`, which can be a grid model
+    or a psize.PsizeResult.
+    """
+    return {
+        'grid_coarse_x': grid_params.coarse_dim[0],
+        'grid_coarse_y': grid_params.coarse_dim[1],
+        'grid_coarse_z': grid_params.coarse_dim[2],
+        'grid_fine_x': grid_params.fine_dim[0],
+        'grid_fine_y': grid_params.fine_dim[1],
+        'grid_fine_z': grid_params.fine_dim[2],
+        'grid_center_x': grid_params.center[0],
+        'grid_center_y': grid_params.center[1],
+        'grid_center_z': grid_params.center[2],
+        'grid_points_x': grid_params.fine_grid_points[0],
+        'grid_points_y': grid_params.fine_grid_points[1],
+        'grid_points_z': grid_params.fine_grid_points[2]
+    }
+
+def format_apbs_input(pqr_filename, dx_filename, apbs_values, grid_values, para_rank=0):
+    """Return text of the APBS input file, from the template. If `grid_values`
+    include an mg-para decomposition (see `para_grid_values`), this is the input
+    for the process that solves subdomain `para_rank`.
+    """
+    template_path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        'apbs_input_template.txt'
+    )
+    if not os.path.isfile(template_path):
+        raise util.PluginDialogException(f"APBS template file not found at {template_path}.")
+
+    with open(template_path, 'r') as f:
+        apbs_template = string.Template(f.read())
+
+    # APBS appends the '.dx' extension itself
+    dx_filename = str(dx_filename)
+    if dx_filename.endswith('.dx'):
+        dx_filename = dx_filename[:-3]
+
+    template_dict = dict()
+    template_dict.update(grid_values)
+    template_dict.update(apbs_values)
+    template_dict['pqr_filename'] = pqr_filename
+    template_dict['dx_filename'] = dx_filename
+    pdime = para_pdime(grid_values)
+    if pdime:
+        # "async" makes APBS solve only the given subdomain, so that the
+        # subdomains can be run as independent processes
+        template_dict['mg_method'] = 'mg-para'
+        template_dict['para_keywords'] = (f"pdime {pdime[0]} {pdime[1]} {pdime[2]}\n"
+            f"    ofrac {grid_values['para_ofrac']}\n"
+            f"    async {para_rank}")
+    else:
+        template_dict['mg_method'] = 'mg-auto'
+        template_dict['para_keywords'] = ""
+    return apbs_template.substitute(template_dict)
+
+def para_grid_values(pdime, dime, ofrac=grid.PARA_OFRAC):
+    """Template grid values for an mg-para run: `dime` grid points in each of
+    `pdime` subdomains (as returned by `grid.para_decomposition`.)
+    """
+    return {
+        'grid_points_x': dime[0],
+        'grid_points_y': dime[1],
+        'grid_points_z': dime[2],
+        'para_pdime_x': pdime[0],
+        'para_pdime_y': pdime[1],
+        'para_pdime_z': pdime[2],
+        'para_ofrac': ofrac
+    }
+
+def para_pdime(grid_values):
+    """mg-para decomposition in `grid_values`, or an empty list for mg-auto."""
+    if 'para_pdime_x' not in grid_values:
+        return []
+    return [int(grid_values[f'para_pdime_{ax}']) for ax in 'xyz']
+
+def run_memory_params(grid_values):
+    """(grid points, focusing steps) of each APBS process run with `grid_values`,
+    as used by memory.MemoryModel.
+    """
+    dime = [int(grid_values[f'grid_points_{ax}']) for ax in 'xyz']
+    coarse_dim = [float(grid_values[f'grid_coarse_{ax}']) for ax in 'xyz']
+    fine_dim = [float(grid_values[f'grid_fine_{ax}']) for ax in 'xyz']
+    pdime = para_pdime(grid_values)
+    if pdime:
+        # each process focuses down to its own subdomain
+        ofrac = float(grid_values['para_ofrac'])
+        fine_dim = [f * (1. + 2. * ofrac) / p if p > 1 else f \
+            for f, p in zip(fine_dim, pdime)]
+    return dime, memory.focus_levels(coarse_dim, fine_dim)
+
+def para_files(config_file, dx_filename, pdime):
+    """(input file, partial map) paths for each process of an mg-para run. APBS
+    names the map written by process k "<stem>-PE<k>.dx".
+    """
+    config_stem = os.path.splitext(str(config_file))[0]
+    dx_stem = str(dx_filename)
+    if dx_stem.endswith('.dx'):
+        dx_stem = dx_stem[:-3]
+    return [(f"{config_stem}-PE{k}.in", f"{dx_stem}-PE{k}.dx") \
+        for k in range(pdime[0] * pdime[1] * pdime[2])]
+
+def write_para_input_files(config_file, pqr_filename, dx_filename, apbs_values, grid_values):
+    """Write one input file per mg-para process; returns `para_files()`."""
+    files = para_files(config_file, dx_filename, para_pdime(grid_values))
+    for rank, (in_file, _) in enumerate(files):
+        with open(in_file, 'w') as f:
+            f.write(format_apbs_input(
+                pqr_filename, dx_filename, apbs_values, grid_values, para_rank=rank
+            ))
+    return files
+
+def stitch_para_maps(partial_dx_files, dx_filename, pdime):
+    """Combine the maps written by the processes of an mg-para run into one
+    map of the whole domain, written to `dx_filename`. The partial maps are
+    deleted afterwards.
+    """
+    dx_map = dx.stitch_maps([dx.read_dx(path) for path in partial_dx_files], pdime)
+    dx.write_dx(dx_map, dx_filename)
+    for path in partial_dx_files:
+        os.remove(path)
+    _log.info(f"Stitched {len(partial_dx_files)} mg-para maps into {dx_filename}.")
@@ -0,0 +1,149 @@
+"""
+Persistent on-disk cache of potential maps computed by APBS, so that repeating
+a calculation with unchanged inputs doesn't re-run the solver.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import logging
+_log = logging.getLogger(__name__)
+
+import attrs
+import numpy as np
+
+from . import dx
+
+# ------------------------------------------------------------------------------
+
+_HASH_CHUNK = 1024 * 1024
+_FLOAT_MB = 1024. * 1024.
+
+def default_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') \
+        or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'APBS_Qt_plugin')
+
+@attrs.define
+class MapCache():
+    """Content-addressed store of DX files. Entries are keyed on a hash of
+    everything that determines the solution (see `key()`), and evicted in least
+    recently used order once the total size exceeds `max_size_mb`. Recency is
+    tracked through each entry's modification time, which is bumped on a hit.
+    """
+    cache_dir: str = attrs.field(factory=default_cache_dir, converter=str)
+    max_size_mb: int = 5000
+
+    @staticmethod
+    def key(pqr_filename, apbs_values, grid_values):
+        """Hash of the PQR file's contents, the APBS parameters and the grid
+        geometry (both dicts of JSON-serializable values.)
+        """
+        h = hashlib.sha256()
+        with open(pqr_filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(_HASH_CHUNK), b''):
+                h.update(chunk)
+        h.update(json.dumps(
+            {'apbs': apbs_values, 'grid': grid_values}, sort_keys=True, default=str
+        ).encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.dx')
+
+    def get(self, key):
+        """Return path to the cached DX file for `key`, or None on a miss."""
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+        os.utime(path) # mark as most recently used
+        _log.info(f"Potential map cache hit: {path}")
+        return path
+
+    def _put_atomic(self, key, write):
+        # write the entry to a temp file with write(temp path) and rename it,
+        # so concurrent readers never see a partially written entry
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            os.close(fd)
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return path
+
+    def put(self, key, dx_filename):
+        """Copy `dx_filename` into the cache under `key`, evicting old entries if
+        needed. Returns path to the cached copy.
+        """
+        path = self._put_atomic(key, lambda tmp_path: shutil.copyfile(dx_filename, tmp_path))
+        _log.info(f"Added {dx_filename} to potential map cache as {path}")
+        self.evict()
+        return path
+
+    @staticmethod
+    def map_key(dx_map):
+        """Hash of a map's grid and values, for maps with no record of the
+        inputs that produced them.
+        """
+        h = hashlib.sha256()
+        h.update(json.dumps([dx_map.counts, dx_map.origin, dx_map.delta]).encode())
+        h.update(np.ascontiguousarray(dx_map.data, dtype=np.float32).data)
+        return h.hexdigest()
+
+    def put_map(self, key, dx_map):
+        """Write the DXMap `dx_map` into the cache under `key`, evicting old
+        entries if needed. Returns path to the cached file.
+        """
+        path = self.path(key)
+        if os.path.isfile(path):
+            os.utime(path)
+            return path
+        path = self._put_atomic(key, lambda tmp_path: dx.write_dx(dx_map, tmp_path))
+        _log.info(f"Added {dx_map.counts} map to potential map cache as {path}")
+        self.evict()
+        return path
+
+    def contains(self, path):
+        """Whether `path` is an entry of this cache."""
+        return os.path.dirname(os.path.realpath(path)) == os.path.realpath(self.cache_dir) \
+            and str(path).endswith('.dx')
+
+    def entries(self):
+        """(mtime, size, path) of all cache entries, least recently used first."""
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith('.dx'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(entries)
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in
+        `max_size_mb`.
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        max_size = self.max_size_mb * _FLOAT_MB
+        # always keep the most recent entry, even if it's over budget by itself
+        for _, size, path in entries[:-1]:
+            if total <= max_size:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                _log.info(f"Evicted {path} from potential map cache.")
+            except FileNotFoundError:
+                pass # removed by another process
+
+    def clear(self):
+        for _, _, path in self.entries():
+            os.remove(path)
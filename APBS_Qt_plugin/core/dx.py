@@ -0,0 +1,270 @@
+"""
+Reading and writing of potential maps in OpenDX format, as written by APBS.
+"""
+import re
+
+import logging
+_log = logging.getLogger(__name__)
+
+import attrs
+import numpy as np
+
+from . import util
+from .mapstats import MapStats
+
+# ------------------------------------------------------------------------------
+
+_COUNTS_REGEX = re.compile(rb'^object\s+\S+\s+class\s+gridpositions\s+counts\s+(\d+)\s+(\d+)\s+(\d+)')
+_ORIGIN_REGEX = re.compile(rb'^origin\s+(\S+)\s+(\S+)\s+(\S+)')
+_DELTA_REGEX = re.compile(rb'^delta\s+(\S+)\s+(\S+)\s+(\S+)')
+_DATA_REGEX = re.compile(rb'^object\s+\S+\s+class\s+array\s.*\bitems\s+(\d+)\s.*data follows')
+_ROW_FORMAT = "%12.6e %12.6e %12.6e\n"
+_WRITE_ROWS = 64 * 1024
+_READ_CHUNK = 1 << 20 # values parsed, and added to the map's statistics, per call
+_EPS = 1e-6
+
+@attrs.define
+class DXMap():
+    """Scalar field on a regular, axis-aligned grid. `data` is a float32 array
+    of shape `counts`, indexed as [x, y, z]; `origin` and `delta` (grid spacing)
+    are in Angstroms.
+    """
+    data: np.ndarray
+    origin: tuple
+    delta: tuple
+    stats: MapStats = attrs.field(default=None, eq=False, repr=False)
+
+    def get_stats(self):
+        """Statistics of the map's values: those gathered while it was read, or
+        else computed from `data` on first call.
+        """
+        if self.stats is None:
+            self.stats = MapStats.from_array(self.data)
+        return self.stats
+
+    @property
+    def counts(self):
+        return self.data.shape
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+def read_dx_header(f):
+    """Parse the header of a DX file open in binary mode, leaving the file
+    positioned at the start of the data block. Returns (counts, origin, delta).
+    """
+    counts = origin = None
+    deltas = []
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith(b'#'):
+            continue
+        if _COUNTS_REGEX.match(line):
+            counts = tuple(int(x) for x in _COUNTS_REGEX.match(line).groups())
+        elif _ORIGIN_REGEX.match(line):
+            origin = tuple(float(x) for x in _ORIGIN_REGEX.match(line).groups())
+        elif _DELTA_REGEX.match(line):
+            deltas.append([float(x) for x in _DELTA_REGEX.match(line).groups()])
+        elif _DATA_REGEX.match(line):
+            if counts is None or origin is None or len(deltas) != 3:
+                break
+            n_items = int(_DATA_REGEX.match(line).group(1))
+            if n_items != counts[0] * counts[1] * counts[2]:
+                raise util.PluginException(f"DX file {f.name}: {n_items} data "
+                    f"items don't match grid counts {counts}.")
+            deltas = np.array(deltas)
+            if np.count_nonzero(deltas - np.diag(np.diag(deltas))):
+                raise util.PluginException(f"DX file {f.name}: only axis-aligned "
+                    "grids are supported.")
+            return counts, origin, tuple(float(x) for x in np.diag(deltas))
+    raise util.PluginException(f"Couldn't parse header of DX file {f.name}.")
+
+def read_dx(path):
+    """Read a DX file into a DXMap. The data block is converted by numpy's
+    C-level text parser, rather than line by line in python, in chunks; the
+    map's statistics (see mapstats.py) are updated from each chunk as it's
+    parsed, so they don't need another pass over the data.
+    """
+    with open(path, 'rb') as f:
+        counts, origin, delta = read_dx_header(f)
+        n_items = counts[0] * counts[1] * counts[2]
+        data = np.empty(n_items, dtype=np.float32)
+        stats = MapStats()
+        n_read = 0
+        while n_read < n_items:
+            chunk = np.fromfile(f, dtype=np.float32,
+                count=min(_READ_CHUNK, n_items - n_read), sep=' ')
+            if chunk.size == 0:
+                break
+            data[n_read : n_read + chunk.size] = chunk
+            stats.update(chunk)
+            n_read += chunk.size
+    if n_read != n_items:
+        raise util.PluginException(f"DX file {path} truncated: read {n_read} "
+            f"of {n_items} values.")
+    # DX data is written with the z index varying fastest, i.e. C order
+    _log.debug(f"Read {counts} map from {path}.")
+    return DXMap(data=data.reshape(counts), origin=origin, delta=delta, stats=stats)
+
+class DXWriter():
+    """Write a DX file incrementally, in the format APBS uses: three values per
+    line, z index varying fastest. The header is written on creation, values
+    (in that order) by any number of calls to `write()`, and the trailer by
+    `close()`. Can be used as a context manager.
+    """
+    def __init__(self, path, counts, origin, delta, comment="Data from APBS_Qt_plugin"):
+        self.path = path
+        self.counts = tuple(counts)
+        self._f = open(path, 'w')
+        self._carry = np.empty(0, dtype=np.float32) # values not yet on a full row
+        self._n_written = 0
+        nx, ny, nz = self.counts
+        f = self._f
+        f.write(f"# {comment}\n")
+        f.write(f"object 1 class gridpositions counts {nx} {ny} {nz}\n")
+        f.write("origin %12.6e %12.6e %12.6e\n" % tuple(origin))
+        f.write("delta %12.6e 0.000000e+00 0.000000e+00\n" % delta[0])
+        f.write("delta 0.000000e+00 %12.6e 0.000000e+00\n" % delta[1])
+        f.write("delta 0.000000e+00 0.000000e+00 %12.6e\n" % delta[2])
+        f.write(f"object 2 class gridconnections counts {nx} {ny} {nz}\n")
+        f.write(f"object 3 class array type double rank 0 items {nx * ny * nz} data follows\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._f.close()
+
+    def write(self, values):
+        flat = np.ascontiguousarray(values, dtype=np.float32).ravel()
+        self._n_written += flat.size
+        if self._carry.size:
+            flat = np.concatenate((self._carry, flat))
+        n_rows = flat.size // 3
+        # format many rows per call to the % operator, which is done in C
+        for start in range(0, n_rows, _WRITE_ROWS):
+            stop = min(start + _WRITE_ROWS, n_rows)
+            self._f.write(_ROW_FORMAT * (stop - start) % tuple(flat[3 * start : 3 * stop].tolist()))
+        self._carry = flat[3 * n_rows:].copy()
+
+    def close(self):
+        f = self._f
+        n_items = self.counts[0] * self.counts[1] * self.counts[2]
+        if self._n_written != n_items:
+            f.close()
+            raise util.PluginException(f"DX file {self.path}: wrote {self._n_written} "
+                f"of {n_items} values.")
+        if self._carry.size:
+            f.write(' '.join('%12.6e' % x for x in self._carry.tolist()) + '\n')
+        f.write('attribute "dep" string "positions"\n')
+        f.write('object "regular positions regular connections" class field\n')
+        f.write('component "positions" value 1\n')
+        f.write('component "connections" value 2\n')
+        f.write('component "data" value 3\n')
+        f.close()
+
+def write_dx(dx_map, path, comment="Data from APBS_Qt_plugin"):
+    """Write a DXMap to `path` in the format APBS uses: three values per line,
+    z index varying fastest.
+    """
+    with DXWriter(path, dx_map.counts, dx_map.origin, dx_map.delta, comment) as writer:
+        writer.write(dx_map.data)
+    _log.debug(f"Wrote {dx_map.counts} map to {path}.")
+
+def _axis_weights(coords, origin, delta, n):
+    # lower grid index and interpolation weight of each coordinate along one axis
+    frac = np.clip((coords - origin) / delta, 0., n - 1.)
+    idx = np.minimum(np.floor(frac).astype(np.intp), max(n - 2, 0))
+    return idx, frac - idx
+
+def _sample_block(dx_map, xs, ys, zs):
+    # trilinear interpolation of dx_map on the grid xs (x) ys (x) zs
+    (ix, wx), (iy, wy), (iz, wz) = [
+        _axis_weights(c, dx_map.origin[i], dx_map.delta[i], dx_map.counts[i]) \
+        for i, c in enumerate((xs, ys, zs))
+    ]
+    data = dx_map.data
+    out = np.zeros((len(xs), len(ys), len(zs)), dtype=np.float32)
+    for dx_, fx in ((0, 1. - wx), (1, wx)):
+        for dy_, fy in ((0, 1. - wy), (1, wy)):
+            for dz_, fz in ((0, 1. - wz), (1, wz)):
+                corner = data[np.ix_(
+                    np.minimum(ix + dx_, data.shape[0] - 1),
+                    np.minimum(iy + dy_, data.shape[1] - 1),
+                    np.minimum(iz + dz_, data.shape[2] - 1)
+                )]
+                out += corner * (fx[:, None, None] * fy[None, :, None] * fz[None, None, :])
+    return out
+
+def _sample_points(arrays, origin, delta, points):
+    # trilinear interpolation of each of `arrays` (same shape, on the grid given
+    # by origin and delta) at `points` (N x 3); the corner indices and weights
+    # are computed once and shared between arrays
+    (ix, wx), (iy, wy), (iz, wz) = [
+        _axis_weights(points[:, i], origin[i], delta[i], arrays[0].shape[i]) \
+        for i in range(3)
+    ]
+    shape = arrays[0].shape
+    out = [np.zeros(len(points), dtype=np.float32) for _ in arrays]
+    for dx_, fx in ((0, 1. - wx), (1, wx)):
+        jx = np.minimum(ix + dx_, shape[0] - 1)
+        for dy_, fy in ((0, 1. - wy), (1, wy)):
+            jy = np.minimum(iy + dy_, shape[1] - 1)
+            fxy = fx * fy
+            for dz_, fz in ((0, 1. - wz), (1, wz)):
+                jz = np.minimum(iz + dz_, shape[2] - 1)
+                f = fxy * fz
+                for o, a in zip(out, arrays):
+                    o += a[jx, jy, jz] * f
+    return out
+
+def sample_points(dx_map, points):
+    """Trilinearly interpolated values of `dx_map` at `points` (N x 3, in
+    Angstroms.) Points outside the map take the value at the nearest edge.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    return _sample_points([dx_map.data], dx_map.origin, dx_map.delta, points)[0]
+
+def stitch_maps(dx_maps, pdime):
+    """Combine the partial maps written by the processes of an APBS mg-para run
+    into one map of the whole domain. Each partial map covers one of `pdime`
+    subdomains plus an overlap with its neighbors; every point of the output
+    is taken from the subdomain that owns it without overlap, interpolating if
+    the subdomain's spacing differs from the output's.
+    """
+    if len(dx_maps) != pdime[0] * pdime[1] * pdime[2]:
+        raise util.PluginException(f"Expected {pdime[0] * pdime[1] * pdime[2]} "
+            f"partial maps for pdime {pdime}, got {len(dx_maps)}.")
+    origins = np.array([m.origin for m in dx_maps])
+    deltas = np.array([m.delta for m in dx_maps])
+    ends = origins + deltas * (np.array([m.counts for m in dx_maps]) - 1)
+    g_min, g_max = origins.min(axis=0), ends.max(axis=0)
+    g_delta = deltas.min(axis=0)
+    g_counts = np.rint((g_max - g_min) / g_delta).astype(int) + 1
+    cell_len = (g_max - g_min) / np.asarray(pdime)
+
+    data = np.zeros(tuple(g_counts), dtype=np.float32)
+    filled = np.zeros(tuple(pdime), dtype=bool)
+    for m, origin, end in zip(dx_maps, origins, ends):
+        cell = np.clip(
+            np.floor(((origin + end) / 2. - g_min) / cell_len).astype(int),
+            0, np.asarray(pdime) - 1
+        )
+        if filled[tuple(cell)]:
+            raise util.PluginException(f"Partial maps overlap in subdomain {cell}.")
+        filled[tuple(cell)] = True
+        axes = []
+        for i in range(3):
+            lo = int(np.ceil(cell[i] * cell_len[i] / g_delta[i] - _EPS))
+            if cell[i] == pdime[i] - 1:
+                hi = g_counts[i]
+            else:
+                hi = int(np.ceil((cell[i] + 1) * cell_len[i] / g_delta[i] - _EPS))
+            axes.append((lo, hi, g_min[i] + g_delta[i] * np.arange(lo, hi)))
+        (x0, x1, xs), (y0, y1, ys), (z0, z1, zs) = axes
+        data[x0:x1, y0:y1, z0:z1] = _sample_block(m, xs, ys, zs)
+    return DXMap(data=data, origin=tuple(g_min.tolist()), delta=tuple(g_delta.tolist()))
@@ -0,0 +1,176 @@
+"""
+Choice of APBS grid dimensions: sizing the grid from the molecule's extents,
+and coarsening it to fit in memory or decomposing it for mg-para.
+"""
+import math
+
+import logging
+_log = logging.getLogger(__name__)
+
+import numpy as np
+
+# ------------------------------------------------------------------------------
+
+_FLOAT_MB = 1024. * 1024.
+
+def bounding_box(coords, radii):
+    """Return (mins, maxs) of the box enclosing spheres of the given `radii`
+    centered on `coords` (an (N, 3) array.)
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    radii = np.asarray(radii, dtype=np.float64)[:, np.newaxis]
+    return (coords - radii).min(axis=0), (coords + radii).max(axis=0)
+
+def product_of_elts(vec):
+    # return functools.reduce(operator.mul, vec)
+    return vec[0] * vec[1] * vec[2]
+
+# memory use of a calculation as a linear function of the number of fine grid
+# points: (overhead in MB, bytes per point). See memory.MemoryModel for how
+# these are calibrated; the default is psize's flat 200 bytes per point.
+DEFAULT_MEM_COEFFICIENTS = (0., 200.)
+
+def grid_to_mem(grid_pts, mem_coefficients=DEFAULT_MEM_COEFFICIENTS):
+    overhead, per_point = mem_coefficients
+    return overhead + per_point * float(product_of_elts(grid_pts)) / _FLOAT_MB
+
+def mem_to_grid(mem, mem_coefficients=DEFAULT_MEM_COEFFICIENTS):
+    overhead, per_point = mem_coefficients
+    return max(int((mem - overhead) * _FLOAT_MB / per_point), 0)
+
+def correct_fine_grid(fine_grid_pts, max_mem_allowed, mem_coefficients=DEFAULT_MEM_COEFFICIENTS):
+    """Coarsen fine grid if current value would use too much memory, as set
+    by `max_mem_allowed` (in MB). `fine_grid_pts` is a 3-vector of `int`s.
+    """
+    max_grid_points = mem_to_grid(max_mem_allowed, mem_coefficients)
+    est_mem = grid_to_mem(fine_grid_pts, mem_coefficients)
+    _log.info(f"Estimated memory usage: {est_mem:.1f} "
+        f"MB out of maximum allowed: {max_mem_allowed}")
+    if est_mem < max_mem_allowed:
+        return fine_grid_pts # no correction needed
+
+    _log.warning(f"Maximum memory usage exceeded. Old grid dimensions: {fine_grid_pts}")
+    factor = pow(
+        float(max_grid_points / product_of_elts(fine_grid_pts)),
+        0.333333333
+    )
+    fine_grid_pts = [(int(factor * x / 2)) * 2 + 1 for x in fine_grid_pts]
+    _log.info(f"Fine grid points rounded down to: {fine_grid_pts}")
+
+    # Now we have to make sure that this still fits the equation n = c*2^(l+1) + 1.
+    # Here, we'll just assume nlev == 4, which means that we need to be
+    # (some constant times 32) + 1.
+    # This can be annoying if, e.g., you're trying to set [99, 123, 99] ..
+    # it'll get rounded to [99, 127, 99]. First, I'll try to round to the
+    # nearest 32*c+1.  If that doesn't work, I'll just round down.
+    new_grid_pts = [0, 0, 0]
+    for i, n_pts in enumerate(fine_grid_pts):
+        quot, rem = divmod(n_pts - 1, 32)
+        if rem > 16:
+            new_grid_pts[i] = (quot + 1) * 32 + 1
+        else:
+            new_grid_pts[i] = quot * 32 + 1
+    if product_of_elts(new_grid_pts) <= max_grid_points:
+        # print "able to round to closest"
+        fine_grid_pts = new_grid_pts
+    else:
+        # Have to round down.
+        # Note that this can still fail a little bit .. it can only get you back
+        # down to the next multiple <= what was in fine_grid_pts.  So, if fine_grid_pts
+        # was exactly on a multiple, like (99,129,99), you'll get rounded down to
+        # (99,127,99), which is still just a bit over the default max of 1200000.
+        # I think that's ok.  It's the rounding error from int(factor*fine_grid_pts ..)
+        # above, but it'll never be a huge error.  If we needed to, we could easily fix this.
+
+        # print "rounding down more"
+        fine_grid_pts = [((x-1)//32) * 32 + 1 for x in new_grid_pts]
+    return fine_grid_pts
+
+# overlap between neighboring mg-para subdomains, as a fraction of their width
+PARA_OFRAC = 0.1
+
+def _para_axis_points(n_pts, n_procs, ofrac):
+    # grid points along one axis of an mg-para subdomain, keeping the spacing of
+    # the undivided grid and rounding up to c*2^(nlev+1) + 1 with nlev = 4
+    if n_procs == 1:
+        return n_pts
+    pts = int(math.ceil((n_pts - 1) * (1. + 2. * ofrac) / n_procs)) + 1
+    return max(32 * int(math.ceil((pts - 1) / 32.)) + 1, 33)
+
+def para_decomposition(fine_grid_pts, n_procs, max_mem_allowed, ofrac=PARA_OFRAC,
+    mem_coefficients=DEFAULT_MEM_COEFFICIENTS):
+    """Choose a domain decomposition for APBS's mg-para mode, splitting the fine
+    grid among at most `n_procs` processes which all run at once. Returns
+    (pdime, dime): the number of subdomains and the grid points in each
+    subdomain, along each axis. The decomposition minimizes the size of each
+    subdomain's grid (hence the wall clock time); memory for all subdomains
+    together is limited to `max_mem_allowed` (in MB.)
+    """
+    best = None
+    for px in range(1, n_procs + 1):
+        for py in range(1, n_procs // px + 1):
+            for pz in range(1, n_procs // (px * py) + 1):
+                pdime = [px, py, pz]
+                dime = [_para_axis_points(n, p, ofrac) for n, p in zip(fine_grid_pts, pdime)]
+                # prefer fewer processes when the subdomain size is the same
+                score = (product_of_elts(dime), product_of_elts(pdime))
+                if best is None or score < best[0]:
+                    best = (score, pdime, dime)
+    _, pdime, dime = best
+    n_subdomains = product_of_elts(pdime)
+    if n_subdomains > 1:
+        dime = correct_fine_grid(dime, max_mem_allowed / n_subdomains, mem_coefficients)
+    _log.info(f"mg-para decomposition: pdime {pdime}, dime {dime} per subdomain")
+    return pdime, dime
+
+def plugin_grid_params(mins, maxs):
+    """The plugin's own grid sizing, from the bounding box (mins, maxs) of the
+    molecule. Returns (coarse_dim, fine_dim, center, fine_grid_pts).
+    """
+    mins = np.asarray(mins, dtype=np.float64)
+    maxs = np.asarray(maxs, dtype=np.float64)
+    box_length = (maxs - mins).tolist()
+    center = ((maxs + mins) / 2.0).tolist()
+
+    # psize expands the molecular dimensions by CFAC (which defaults
+    # to 1.7) for the coarse grid.
+    CFAC = 1.7
+    coarse_dim = [length * CFAC for length in box_length]
+
+    # psize also does something strange .. it adds a buffer FADD to
+    # the box lengths to get the fine lengths. You'd think it'd also
+    # have FFAC or CADD, but we'll mimic it here. It also has the
+    # requirement that the fine grid lengths must be <= the corase
+    # grid lengths. FADD defaults to 20.
+    FADD = 20
+    fine_dim = [min(cdim, length + FADD) for cdim, length in zip(coarse_dim, box_length)]
+
+    # And now the hard part .. setting up the grid points.
+    # From the APBS manual at http://agave.wustl.edu/apbs/doc/html/user-guide/x594.html#dime
+    # we have the formula
+    # n = c*2^(l+1) + 1
+    # where l is the number of levels in the MG hierarchy.  The typical
+    # number of levels is 4.
+    nlev = 4
+    mult_fac = 2 ** (nlev + 1)  # this will typically be 2^5==32
+    # and c must be a non-zero integer
+
+    # If we didn't have to be c*mult_fac + 1, this is what our grid points
+    # would look like (we use the ceiling to be on the safe side .. it never
+    # hurts to do too much.
+    SPACE = 0.5  # default desired spacing = 0.5A
+    desired_points = [flen / SPACE for flen in fine_dim]
+
+    # Now we set up our cs, taking into account mult_fac
+    # (we use the ceiling to be on the safe side .. it never hurts to do
+    # too much.)
+    cs = [int(math.ceil(pts / mult_fac)) for pts in desired_points]
+    fine_grid_pts = [mult_fac * c + 1 for c in cs]
+
+    _log.info("This plugin was used to calculated grid dimensions")
+    _log.info(f"cs: {cs}")
+    _log.info(f"fine_dim: {fine_dim}")
+    _log.info(f"nlev: {nlev}")
+    _log.info(f"mult_fac: {mult_fac}")
+    _log.info(f"fine_grid_pts: {fine_grid_pts}")
+    return coarse_dim, fine_dim, center, fine_grid_pts
@@ -0,0 +1,234 @@
+"""
+Arithmetic on potential maps: differences, scaling, masking and so on, given as
+a numpy expression in map names, e.g. "A - B", "2.5 * A" or "where(B > 0, A, 0)".
+Maps on different grids are resampled onto a common one, and DX files are
+streamed through in slabs of x-planes, so maps larger than memory can be
+combined.
+"""
+import ast
+import contextlib
+import os
+
+import logging
+_log = logging.getLogger(__name__)
+
+import numpy as np
+
+from . import dx, util
+from .mapstats import MapStats
+
+# ------------------------------------------------------------------------------
+
+_EVAL_CHUNK = 1 << 18 # max values of the result computed per slab
+_EPS = 1e-6
+
+# functions usable in expressions, in addition to arithmetic and comparisons
+_FUNCTIONS = {
+    'abs': np.abs, 'sqrt': np.sqrt, 'exp': np.exp, 'log': np.log,
+    'sign': np.sign, 'minimum': np.minimum, 'maximum': np.maximum,
+    'where': np.where, 'clip': np.clip
+}
+_ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call, ast.Name,
+    ast.Load, ast.Constant,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd,
+    ast.BitAnd, ast.BitOr, ast.Invert,
+    ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq
+)
+
+def map_names(expression):
+    """Names in `expression` that refer to maps rather than functions. Raises
+    PluginException if it isn't a python expression.
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as exc:
+        raise util.PluginException(f"Couldn't parse map expression '{expression}': {exc.msg}")
+    return {
+        node.id for node in ast.walk(tree) \
+        if isinstance(node, ast.Name) and node.id not in _FUNCTIONS
+    }
+
+def compile_expression(expression, names):
+    """Check that `expression` only combines the map `names`, numbers and the
+    functions in _FUNCTIONS with arithmetic, comparison and & | ~ (for masks),
+    and compile it. Returns (code object, set of map names used).
+    """
+    clashes = set(names) & set(_FUNCTIONS)
+    if clashes:
+        raise util.PluginException(f"Map names {sorted(clashes)} clash with "
+            "function names.")
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as exc:
+        raise util.PluginException(f"Couldn't parse map expression '{expression}': {exc.msg}")
+    used = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise util.PluginException(f"Map expression '{expression}': "
+                f"{type(node).__name__} not allowed.")
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise util.PluginException(f"Map expression '{expression}': "
+                f"only numeric constants are allowed.")
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in _FUNCTIONS \
+                or node.keywords:
+                raise util.PluginException(f"Map expression '{expression}': "
+                    f"only calls to {sorted(_FUNCTIONS)}, without keywords, are allowed.")
+        elif isinstance(node, ast.Name) and node.id not in _FUNCTIONS:
+            if node.id not in names:
+                raise util.PluginException(f"Map expression '{expression}': "
+                    f"unknown map '{node.id}'.")
+            used.add(node.id)
+    if not used:
+        raise util.PluginException(f"Map expression '{expression}' doesn't use any maps.")
+    return compile(tree, '<map expression>', 'eval'), used
+
+def _grid_end(grid):
+    counts, origin, delta = grid
+    return np.asarray(origin) + np.asarray(delta) * (np.asarray(counts) - 1)
+
+def common_grid(grids):
+    """Grid (counts, origin, delta) on which to combine maps on `grids`: if they
+    differ, the region where all of them overlap, at the finest spacing of any
+    of them along each axis.
+    """
+    first = grids[0]
+    if all(
+        tuple(g[0]) == tuple(first[0])
+        and np.allclose(g[1], first[1], atol=_EPS) and np.allclose(g[2], first[2], atol=_EPS)
+        for g in grids[1:]
+    ):
+        return tuple(first[0]), tuple(first[1]), tuple(first[2])
+    lo = np.max([g[1] for g in grids], axis=0)
+    hi = np.min([_grid_end(g) for g in grids], axis=0)
+    delta = np.min([g[2] for g in grids], axis=0)
+    counts = np.floor((hi - lo) / delta + _EPS).astype(int) + 1
+    if np.any(hi < lo) or np.any(counts < 2):
+        raise util.PluginException("Maps don't overlap.")
+    return tuple(counts.tolist()), tuple(lo.tolist()), tuple(delta.tolist())
+
+class _PlaneSource():
+    # values of one input map on slabs of the output grid, requested in
+    # increasing x. Subclasses provide _window(i0, i1), returning the map's
+    # x-planes i0 to i1 (exclusive) as an array.
+    def __init__(self, counts, origin, delta):
+        self.counts, self.origin, self.delta = tuple(counts), tuple(origin), tuple(delta)
+
+    def grid(self):
+        return self.counts, self.origin, self.delta
+
+    def slab(self, grid, i0, i1):
+        counts, origin, delta = grid
+        if self.grid() == (tuple(counts), tuple(origin), tuple(delta)):
+            return self._window(i0, i1)
+        xs, ys, zs = [
+            origin[i] + delta[i] * (np.arange(i0, i1) if i == 0 else np.arange(counts[i])) \
+            for i in range(3)
+        ]
+        # x-planes of this map bracketing the slab
+        frac = (xs[[0, -1]] - self.origin[0]) / self.delta[0]
+        p0 = int(np.clip(np.floor(frac[0] + _EPS), 0, self.counts[0] - 1))
+        p1 = int(np.clip(np.floor(frac[1] - _EPS) + 2, p0 + 1, self.counts[0]))
+        window = dx.DXMap(
+            data=self._window(p0, p1),
+            origin=(self.origin[0] + p0 * self.delta[0],) + self.origin[1:],
+            delta=self.delta
+        )
+        return dx._sample_block(window, xs, ys, zs)
+
+class _ArrayPlanes(_PlaneSource):
+    # a map already in memory
+    def __init__(self, dx_map):
+        super().__init__(dx_map.counts, dx_map.origin, dx_map.delta)
+        self.data = dx_map.data
+
+    def _window(self, i0, i1):
+        return self.data[i0:i1]
+
+class _FilePlanes(_PlaneSource):
+    # a DX file, read forward once, holding only the planes of the current window
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, 'rb')
+        try:
+            counts, origin, delta = dx.read_dx_header(self._f)
+        except Exception:
+            self._f.close()
+            raise
+        super().__init__(counts, origin, delta)
+        self._plane_size = counts[1] * counts[2]
+        self._buf = np.empty((0,) + tuple(counts[1:]), dtype=np.float32)
+        self._buf_start = 0 # index of first plane in _buf
+
+    def close(self):
+        self._f.close()
+
+    def _window(self, i0, i1):
+        if i0 < self._buf_start:
+            raise ValueError(f"Planes of {self.path} must be requested in increasing order.")
+        # drop planes before the window; read planes up to its end
+        buf = self._buf[i0 - self._buf_start:]
+        n_new = i1 - (i0 + len(buf))
+        if n_new > 0:
+            skip = max(i0 - (self._buf_start + len(self._buf)), 0)
+            n_values = (skip + n_new) * self._plane_size
+            new = np.fromfile(self._f, dtype=np.float32, count=n_values, sep=' ')
+            if new.size != n_values:
+                raise util.PluginException(f"DX file {self.path} truncated.")
+            new = new[skip * self._plane_size:].reshape((n_new,) + self.counts[1:])
+            buf = np.concatenate((buf, new)) if len(buf) else new
+        self._buf, self._buf_start = buf, i0
+        return buf[:i1 - i0]
+
+def evaluate(expression, sources, out_path, chunk_values=_EVAL_CHUNK,
+    comment="Map expression"):
+    """Evaluate `expression` over the maps in `sources`, a dict of name: DX
+    file path or DXMap, and write the result to the DX file `out_path`. If the
+    maps' grids differ, they're trilinearly resampled onto the grid where all
+    of them overlap (see common_grid()). The result is computed in slabs of
+    x-planes of at most `chunk_values` points, so memory use is bounded by a
+    few slabs of each map read from a file, independent of the maps' size.
+
+    Returns (grid as (counts, origin, delta), MapStats of the result.)
+    """
+    code, used = compile_expression(expression, sources)
+    out_real = os.path.realpath(out_path)
+    with contextlib.ExitStack() as stack:
+        planes = {}
+        for name in sorted(used):
+            src = sources[name]
+            if isinstance(src, dx.DXMap):
+                planes[name] = _ArrayPlanes(src)
+            else:
+                if os.path.realpath(src) == out_real:
+                    raise util.PluginException(f"Map expression output {out_path} "
+                        f"would overwrite its input '{name}'.")
+                planes[name] = _FilePlanes(src)
+                stack.callback(planes[name].close)
+        grid = common_grid([p.grid() for p in planes.values()])
+        counts = grid[0]
+        if any(p.grid() != grid for p in planes.values()):
+            _log.info(f"Resampling maps onto common grid {counts}, "
+                f"origin {grid[1]}, spacing {grid[2]}.")
+
+        n_planes = max(chunk_values // (counts[1] * counts[2]), 1)
+        stats = MapStats()
+        writer = stack.enter_context(dx.DXWriter(out_path, *grid,
+            comment=f"{comment}: {expression}"))
+        for i0 in range(0, counts[0], n_planes):
+            i1 = min(i0 + n_planes, counts[0])
+            namespace = dict(_FUNCTIONS)
+            namespace.update((name, p.slab(grid, i0, i1)) for name, p in planes.items())
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                try:
+                    result = eval(code, {'__builtins__': {}}, namespace)
+                except (TypeError, ValueError) as exc:
+                    raise util.PluginException(f"Couldn't evaluate map "
+                        f"expression '{expression}': {exc}")
+            result = np.broadcast_to(np.asarray(result, dtype=np.float32),
+                (i1 - i0,) + tuple(counts[1:]))
+            writer.write(result)
+            stats.update(result)
+    _log.debug(f"Wrote '{expression}' on {counts} grid to {out_path}.")
+    return grid, stats
@@ -0,0 +1,100 @@
+"""
+Summary statistics of potential maps, accumulated in a single pass over the
+values as they're read, and the default visualization levels derived from them.
+"""
+import attrs
+import numpy as np
+
+# ------------------------------------------------------------------------------
+
+_HIST_BINS = 4096
+# histogram covers values up to this magnitude (kT/e); values beyond it are
+# counted in the end bins (min and max are still exact)
+_HIST_LIMIT = 1e4
+_HIST_LO = -np.arcsinh(_HIST_LIMIT)
+_HIST_WIDTH = 2. * np.arcsinh(_HIST_LIMIT) / _HIST_BINS
+_STATS_CHUNK = 1 << 20 # values per update() in MapStats.from_array()
+
+# percentiles of the map's values used for default levels: the molecular
+# surface color ramp spans +/- the larger magnitude of the first pair, and the
+# isosurfaces are drawn at the second pair
+RAMP_PERCENTILES = (5., 95.)
+ISO_PERCENTILES = (1., 99.)
+
+@attrs.define
+class MapStats():
+    """Count, extrema, mean, standard deviation and a fixed-bin histogram of
+    map values, accumulated chunk by chunk with `update()`. Histogram bins are
+    evenly spaced in asinh(value), so percentiles are resolved both near zero
+    and in the long tails of a potential map, without knowing its range in
+    advance.
+    """
+    count: int = 0
+    min: float = np.inf
+    max: float = -np.inf
+    mean: float = 0.
+    m2: float = 0. # sum of squared deviations from the mean
+    histogram: np.ndarray = attrs.Factory(
+        lambda: np.zeros(_HIST_BINS, dtype=np.int64)
+    )
+
+    @classmethod
+    def from_array(cls, data):
+        stats = cls()
+        flat = np.asarray(data).ravel()
+        for start in range(0, flat.size, _STATS_CHUNK):
+            stats.update(flat[start : start + _STATS_CHUNK])
+        return stats
+
+    def update(self, values):
+        """Add a chunk of values to the statistics.
+        """
+        values = np.asarray(values).ravel()
+        n = values.size
+        if n == 0:
+            return
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        # elementwise work is done in the map's (single) precision; sums are
+        # accumulated in double
+        chunk_mean = float(values.mean(dtype=np.float64))
+        v = values.astype(np.float32) - np.float32(chunk_mean)
+        chunk_m2 = float(np.square(v, out=v).sum(dtype=np.float64))
+        # combine with previous chunks (Chan et al.'s pairwise update)
+        total = self.count + n
+        diff = chunk_mean - self.mean
+        self.mean += diff * n / total
+        self.m2 += chunk_m2 + diff * diff * self.count * n / total
+        self.count = total
+
+        v = np.arcsinh(values, out=v, dtype=np.float32)
+        v -= np.float32(_HIST_LO)
+        v *= np.float32(1. / _HIST_WIDTH)
+        np.clip(v, 0, _HIST_BINS - 1, out=v)
+        self.histogram += np.bincount(v.astype(np.intp), minlength=_HIST_BINS)
+
+    @property
+    def std(self):
+        return float(np.sqrt(self.m2 / self.count)) if self.count else float('nan')
+
+    def percentile(self, q):
+        """Approximate `q`-th percentile (0 to 100) of the values, interpolated
+        linearly within a histogram bin.
+        """
+        if not self.count:
+            return float('nan')
+        target = self.count * min(max(q, 0.), 100.) / 100.
+        cum = np.cumsum(self.histogram)
+        i = min(int(np.searchsorted(cum, target, side='left')), _HIST_BINS - 1)
+        prev = cum[i - 1] if i > 0 else 0
+        frac = (target - prev) / self.histogram[i] if self.histogram[i] else 0.
+        value = np.sinh(_HIST_LO + (i + frac) * _HIST_WIDTH)
+        return float(min(max(value, self.min), self.max))
+
+    def default_levels(self):
+        """Return (ramp range, positive isosurface level, negative isosurface
+        level) for visualizing the map, from percentiles of its values.
+        """
+        ramp = max(abs(self.percentile(q)) for q in RAMP_PERCENTILES)
+        neg_iso, pos_iso = (self.percentile(q) for q in ISO_PERCENTILES)
+        return ramp, max(pos_iso, 0.), min(neg_iso, 0.)
@@ -0,0 +1,232 @@
+"""
+Estimates of the memory used by an APBS calculation, calibrated from the peak
+resident set size (RSS) measured on previous runs, and the monitor used to take
+those measurements.
+"""
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+
+import logging
+_log = logging.getLogger(__name__)
+
+import attrs
+import numpy as np
+
+from . import cache
+
+# ------------------------------------------------------------------------------
+
+_FLOAT_MB = 1024. * 1024.
+_MAX_SAMPLES = 200 # per solver mode; oldest are dropped first
+_NLEV = 4 # multigrid levels assumed when choosing grid dimensions
+_REDFAC = 0.25 # max factor by which a domain is reduced at each focusing step
+
+# (overhead in MB, bytes per fine grid point, extra bytes per grid point for
+# each focusing step) for each solver mode, before any calibration. These
+# reproduce psize's flat 200 bytes per grid point.
+DEFAULT_COEFFICIENTS = {
+    'npbe': (0., 200., 0.),
+    'lpbe': (0., 200., 0.)
+}
+
+def default_samples_path():
+    return os.path.join(cache.default_cache_dir(), 'memory_samples.json')
+
+def multigrid_levels(dime):
+    """Number of multigrid levels available for a grid of `dime` points, which
+    must satisfy n = c * 2^(nlev + 1) + 1 along each axis.
+    """
+    nlev = None
+    for n in dime:
+        n, levels = int(n) - 1, -1
+        while n > 0 and n % 2 == 0:
+            n //= 2
+            levels += 1
+        nlev = levels if nlev is None else min(nlev, levels)
+    return max(nlev or 1, 1)
+
+def focus_levels(coarse_dim, fine_dim, redfac=_REDFAC):
+    """Number of focusing steps mg-auto takes from the coarse grid lengths to the
+    fine grid lengths.
+    """
+    ratio = max(float(c) / float(f) for c, f in zip(coarse_dim, fine_dim) if f > 0)
+    if ratio <= 1.:
+        return 0
+    return int(math.ceil(math.log(ratio) / math.log(1. / redfac)))
+
+def _hierarchy_factor(nlev):
+    # storage of all multigrid levels relative to the nlev the coefficients
+    # are expressed in; each coarser level has 1/8 the points of the previous
+    def _total(n):
+        return sum(0.125 ** l for l in range(n))
+    return _total(nlev) / _total(_NLEV)
+
+def _features(dime, nfocus):
+    n_points = float(dime[0] * dime[1] * dime[2])
+    return [1., n_points * _hierarchy_factor(multigrid_levels(dime)) / _FLOAT_MB,
+        n_points * nfocus / _FLOAT_MB]
+
+@attrs.define
+class MemoryModel():
+    """Linear model of APBS's peak memory use (in MB) for each solver mode, as
+    overhead + (bytes per point) * (fine grid points, scaled for the number of
+    multigrid levels) + (bytes per point per focusing step) * (grid points) *
+    (focusing steps). Coefficients start at `DEFAULT_COEFFICIENTS` and are fit
+    to measured samples by `calibrate()`; calibrated estimates are inflated by
+    `safety_factor`.
+    """
+    samples_path: str = "" # empty = don't persist samples
+    samples: list = attrs.Factory(list)
+    coefficients: dict = attrs.Factory(lambda: dict(DEFAULT_COEFFICIENTS))
+    safety_factor: float = 1.1
+
+    @classmethod
+    def load(cls, samples_path=None):
+        """Return a model calibrated from the samples in `samples_path`
+        (default: in the cache directory.) Missing or unreadable sample files
+        give the uncalibrated model.
+        """
+        if samples_path is None:
+            samples_path = default_samples_path()
+        model = cls(samples_path=samples_path)
+        try:
+            with open(samples_path, 'r') as f:
+                model.samples = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as exc:
+            _log.warning(f"Couldn't read memory samples from {samples_path}: {exc}")
+        for mode in {s['mode'] for s in model.samples}:
+            model.calibrate(mode)
+        return model
+
+    def save(self):
+        if not self.samples_path:
+            return
+        os.makedirs(os.path.dirname(self.samples_path), exist_ok=True)
+        # write atomically, since batch runs may share the file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.samples_path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.samples, f)
+        os.replace(tmp_path, self.samples_path)
+
+    def is_calibrated(self, mode):
+        return any(s['mode'] == mode for s in self.samples)
+
+    def _coefficients(self, mode):
+        coeffs = self.coefficients.get(mode, DEFAULT_COEFFICIENTS['npbe'])
+        if self.is_calibrated(mode):
+            return [self.safety_factor * c for c in coeffs]
+        return list(coeffs)
+
+    def estimate_mb(self, mode, dime, nfocus=0):
+        """Estimated peak memory (MB) of a calculation on a `dime` grid."""
+        return float(np.dot(self._coefficients(mode), _features(dime, nfocus)))
+
+    def linear_coefficients(self, mode, nfocus=0):
+        """(overhead in MB, bytes per fine grid point) of the estimate, for use
+        when choosing grid dimensions (with `_NLEV` multigrid levels.)
+        """
+        overhead, per_point, per_focus = self._coefficients(mode)
+        return overhead, per_point + per_focus * nfocus
+
+    def add_sample(self, mode, dime, nfocus, peak_mb):
+        """Record the measured peak memory of a calculation and recalibrate."""
+        _log.info(f"APBS peak memory: {peak_mb:.0f} MB; estimated "
+            f"{self.estimate_mb(mode, dime, nfocus):.0f} MB.")
+        self.samples.append({'mode': mode, 'dime': [int(n) for n in dime],
+            'nfocus': int(nfocus), 'peak_mb': float(peak_mb), 'time': time.time()})
+        mode_samples = [s for s in self.samples if s['mode'] == mode]
+        if len(mode_samples) > _MAX_SAMPLES:
+            self.samples.remove(mode_samples[0])
+        self.calibrate(mode)
+
+    def calibrate(self, mode):
+        """Fit coefficients for `mode` to its samples. Which coefficients are fit
+        depends on how many distinct grid sizes have been measured; the rest
+        keep their default values.
+        """
+        samples = [s for s in self.samples if s['mode'] == mode]
+        if not samples:
+            return
+        X = np.array([_features(s['dime'], s['nfocus']) for s in samples])
+        y = np.array([s['peak_mb'] for s in samples])
+        default = np.array(DEFAULT_COEFFICIENTS.get(mode, DEFAULT_COEFFICIENTS['npbe']))
+        for free in ([0, 1, 2], [0, 1], [1]):
+            if np.linalg.matrix_rank(X[:, free]) < len(free):
+                continue
+            fixed = [i for i in range(3) if i not in free]
+            coeffs = default.copy()
+            coeffs[free] = np.linalg.lstsq(
+                X[:, free], y - X[:, fixed] @ default[fixed], rcond=None
+            )[0]
+            if (coeffs >= 0.).all():
+                self.coefficients[mode] = tuple(coeffs.tolist())
+                _log.debug(f"Calibrated {mode} memory model from {len(samples)} "
+                    f"samples: {self.coefficients[mode]}")
+                return
+
+# ------------------------------------------------------------------------------
+
+def read_rss_mb(pid):
+    """Return (current, peak) resident set size in MB of process `pid`, either of
+    which may be None if it can't be determined on this platform.
+    """
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+        # values are reported in kB
+        rss = status.get('VmRSS')
+        hwm = status.get('VmHWM')
+        return (
+            float(rss.split()[0]) / 1024. if rss else None,
+            float(hwm.split()[0]) / 1024. if hwm else None
+        )
+    except (OSError, ValueError):
+        pass
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss / _FLOAT_MB, None
+    except ModuleNotFoundError:
+        return None, None
+    except Exception: # psutil.Error; process exited or not accessible
+        return None, None
+
+class RSSMonitor():
+    """Sample the resident set size of process `pid` on a background thread
+    while it runs, and record its peak. Where the OS reports the peak directly
+    (Linux's VmHWM), sampling only needs to catch the process before it exits.
+    """
+    INTERVAL_SEC = 0.2
+
+    def __init__(self, pid, interval=None):
+        self.pid = pid
+        self.interval = interval or self.INTERVAL_SEC
+        self.peak_mb = None
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while True:
+            rss, hwm = read_rss_mb(self.pid)
+            for value in (rss, hwm):
+                if value is not None and (self.peak_mb is None or value > self.peak_mb):
+                    self.peak_mb = value
+            if self._stop_event.wait(self.interval):
+                break
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop sampling; return the peak RSS in MB, or None if it couldn't be
+        measured.
+        """
+        self._stop_event.set()
+        self._thread.join()
+        return self.peak_mb
@@ -0,0 +1,113 @@
+"""
+Cleanup of PQR files written by pdb2pqr or PyMol, so that APBS can read them.
+"""
+import os
+import re
+import shutil
+import tempfile
+
+import logging
+_log = logging.getLogger(__name__)
+
+import numpy as np
+from . import psize
+
+# ------------------------------------------------------------------------------
+
+# APBS accepts whitespace-delimited columns
+_COORD_REGEX = r'([- 0-9]{4}\.[ 0-9]{3})'
+_SOURCE_REGEX = re.compile(r'^(ATOM  |HETATM)(........................)' + 3*_COORD_REGEX, flags=re.M)
+_TARGET_REGEX = r'\1\2 \3 \4 \5'
+_UNASSIGNED_REGEX = re.compile(r'REMARK   5 *(\d+) \w* in')
+
+_BLOCK_SIZE = 8 * 1024 * 1024
+
+# fixed-width PDB columns (0-based) that strip_chain_and_b_factors blanks
+_CHAIN_COL = 21
+_OCCUPANCY_B_COLS = slice(54, 66)
+_ZERO_OCCUPANCY_B = np.frombuffer(b'  0.00  0.00', dtype=np.uint8)
+
+def _iter_line_blocks(f, block_size=_BLOCK_SIZE):
+    # yield blocks of whole lines of roughly block_size bytes
+    remainder = ''
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        block = remainder + block
+        cut = block.rfind('\n') + 1
+        remainder = block[cut:]
+        yield block[:cut]
+    if remainder:
+        yield remainder
+
+def clean_pqr_file(pqr_filename, clean_columns=True):
+    """Clean up coordinate columns of the PQR file in place (see
+    `clean_pqr_columns`) and return IDs of atoms pdb2pqr couldn't
+    assign parameters to, in a single pass over the file. The file is processed
+    in fixed-size blocks and written to a temporary file which then atomically
+    replaces the original, so memory use doesn't grow with file size.
+    """
+    unassigned = []
+    if not clean_columns:
+        with open(pqr_filename, 'r') as f:
+            for block in _iter_line_blocks(f):
+                unassigned.extend(_UNASSIGNED_REGEX.findall(block))
+        return unassigned
+
+    out_dir = os.path.dirname(os.path.abspath(pqr_filename))
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, suffix='.pqr.tmp')
+    try:
+        with open(pqr_filename, 'r') as f_in, os.fdopen(fd, 'w') as f_out:
+            for block in _iter_line_blocks(f_in):
+                unassigned.extend(_UNASSIGNED_REGEX.findall(block))
+                f_out.write(_SOURCE_REGEX.sub(_TARGET_REGEX, block))
+        shutil.copymode(pqr_filename, tmp_path)
+        os.replace(tmp_path, pqr_filename)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return unassigned
+
+def clean_pqr_columns(pqr_txt):
+    """Cleanup on contents of generated PQR files.
+
+    pdb2pqr will happily write out a file where the coordinate
+    columns overlap if you have -100.something as one of the
+    coordinates, like
+
+    90.350  97.230-100.010
+
+    and so will PyMOL. We can't just assume that it's 0-1
+    because pdb2pqr will debump things and write them out with
+    3 digits post-decimal.
+    """
+    return _SOURCE_REGEX.sub(_TARGET_REGEX, pqr_txt)
+
+def get_unassigned_atoms(pqr_txt):
+    """
+    Return string of unassigned atoms, identified via warning text in comments
+    in output.
+    """
+    return '+'.join(_UNASSIGNED_REGEX.findall(pqr_txt))
+
+def strip_chain_and_b_factors(text, fmt):
+    """Return PDB or PQR `text` (as bytes) with chain information removed from
+    its records, and for PDB files (`fmt` 'pdb'), occupancy and b-factors too.
+    Done in bulk on the fixed-width columns, as coordinates written by PyMol fit
+    them.
+    """
+    buf = np.frombuffer(bytearray(text.encode()), dtype=np.uint8)
+
+    # Get rid of chain information
+    starts, _, is_record = psize.record_lines(buf, min_length=_CHAIN_COL + 1)
+    buf[starts[is_record] + _CHAIN_COL] = ord(' ')
+    if fmt == 'pdb':
+        # Get rid of occupancy and b-factor information. In PQR files these
+        # columns hold charge and radius, so leave them alone.
+        starts, _, is_record = psize.record_lines(buf, min_length=_OCCUPANCY_B_COLS.stop)
+        buf[starts[is_record, np.newaxis] + np.arange(
+            _OCCUPANCY_B_COLS.start, _OCCUPANCY_B_COLS.stop
+        )] = _ZERO_OCCUPANCY_B
+    return buf.tobytes()
@@ -0,0 +1,206 @@
+"""
+Reimplementation of APBS's psize.py, which picks grid dimensions for a PQR file.
+Results match psize.py; the PQR file is parsed in large blocks with numpy rather
+than one line at a time.
+"""
+import math
+import warnings
+
+import logging
+_log = logging.getLogger(__name__)
+
+import attrs
+import numpy as np
+
+from . import util
+
+# ------------------------------------------------------------------------------
+
+# defaults from psize.py
+PSIZE_CONSTANTS = {
+    "cfac": 1.7,      # coarse grid is this factor larger than molecule
+    "fadd": 20.,      # fine grid is this many Angstroms larger than molecule
+    "space": 0.50,    # desired fine grid spacing (A)
+    "gmemfac": 200,   # bytes of memory per grid point
+    "gmemceil": 400,  # max MB per processor
+    "ofrac": 0.1,     # overlap factor between mg-para subdomains
+    "redfac": 0.25    # max factor by which a domain can be reduced when focusing
+}
+
+_BLOCK_SIZE = 64 * 1024 * 1024
+_N_FIELDS = 5 # x, y, z, charge, radius
+_RECORD_NAMES = (b'ATOM', b'HETATM') # matched as line prefixes, as in psize.py
+_MINUS, _SPACE, _NEWLINE = ord('-'), ord(' '), ord('\n')
+
+@attrs.define
+class PsizeResult():
+    """Output of psize: the same quantities printed by psize.py."""
+    n_atoms: int
+    charge: float
+    mol_dim: list       # molecule dimensions
+    center: list        # cgcent, fgcent
+    coarse_dim: list    # cglen
+    fine_dim: list      # fglen
+    fine_grid_points: list # dime
+    nsmall: list        # dime of each subdomain if memory ceiling is exceeded
+    procgrid: list      # pdime for mg-para
+    nfocus: int         # levels of focusing needed per subdomain
+
+def _parse_lines_slow(lines):
+    # psize.py's per-line logic: fallback for blocks where records don't
+    # contain exactly x, y, z, charge, radius after column 30
+    values = []
+    for line in lines.split(b'\n'):
+        if not line.startswith(_RECORD_NAMES):
+            continue
+        words = line[30:].replace(b'-', b' -').split()
+        if len(words) < _N_FIELDS:
+            continue
+        values.append([float(w) for w in words[:_N_FIELDS]])
+    return np.array(values, dtype=np.float64).reshape(-1, _N_FIELDS)
+
+def _line_ranges(starts, ends):
+    # indices of all bytes in the half-open ranges [starts, ends)
+    lengths = ends - starts
+    offsets = np.repeat(starts - np.cumsum(np.concatenate(([0], lengths[:-1]))), lengths)
+    return offsets + np.arange(lengths.sum())
+
+def record_lines(buf, min_length=0):
+    """Locate lines in `buf`, a uint8 array of PDB/PQR text. Returns arrays of
+    (line start offsets, line end offsets, mask of ATOM/HETATM records at least
+    `min_length` characters long).
+    """
+    ends = np.flatnonzero(buf == _NEWLINE)
+    if ends.size == 0 or ends[-1] != buf.size - 1:
+        ends = np.append(ends, buf.size)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+
+    # select record lines by comparing their first 6 bytes
+    is_record = (ends - starts) >= max(min_length, 6)
+    head = buf[np.minimum(starts[:, np.newaxis] + np.arange(6), buf.size - 1)]
+    is_name = np.zeros(len(starts), dtype=bool)
+    for name in _RECORD_NAMES:
+        name = np.frombuffer(name, dtype=np.uint8)
+        is_name |= (head[:, :len(name)] == name).all(axis=1)
+    return starts, ends, is_record & is_name
+
+def _parse_block(block):
+    """Return an (N, 5) array of (x, y, z, charge, radius) for the ATOM and HETATM
+    records in `block`, which must consist of whole lines.
+    """
+    buf = np.frombuffer(bytearray(block), dtype=np.uint8)
+    if buf.size == 0:
+        return np.empty((0, _N_FIELDS))
+    starts, ends, is_record = record_lines(buf, min_length=31)
+    n_records = np.count_nonzero(is_record)
+    if n_records == 0:
+        return np.empty((0, _N_FIELDS))
+
+    # blank out everything but the numeric fields, which then become
+    # whitespace-separated: first 30 columns of records, and all other lines
+    buf[starts[is_record, np.newaxis] + np.arange(30)] = _SPACE
+    buf[_line_ranges(starts[~is_record], ends[~is_record])] = _SPACE
+    # as in psize.py, separate columns that run together, e.g. "97.230-100.010"
+    buf = np.insert(buf, np.flatnonzero(buf == _MINUS), _SPACE)
+
+    try:
+        with warnings.catch_warnings():
+            # unparseable text is only a DeprecationWarning in some numpy versions
+            warnings.simplefilter('error', DeprecationWarning)
+            values = np.fromstring(buf.tobytes(), dtype=np.float64, sep=' ')
+    except (ValueError, DeprecationWarning):
+        values = None
+    if values is None or values.size != _N_FIELDS * n_records:
+        return _parse_lines_slow(block)
+    return values.reshape(-1, _N_FIELDS)
+
+def iter_pqr_records(pqr_filename, block_size=_BLOCK_SIZE):
+    """Yield (N, 5) arrays of (x, y, z, charge, radius) from a PQR file, reading
+    it in blocks of roughly `block_size` bytes so that memory use is bounded.
+    """
+    remainder = b''
+    with open(pqr_filename, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            block = remainder + block
+            cut = block.rfind(b'\n') + 1
+            remainder = block[cut:]
+            yield _parse_block(block[:cut])
+    if remainder:
+        yield _parse_block(remainder)
+
+def parse_pqr_extents(pqr_filename):
+    """Return (mins, maxs, total charge, number of atoms) for the PQR file, where
+    mins and maxs include atomic radii.
+    """
+    # psize.py's initial values; these affect the result for small molecules
+    # near the origin, so keep them for compatibility
+    mins = np.full(3, 360.)
+    maxs = np.full(3, -360.)
+    charge = 0.
+    n_atoms = 0
+    for records in iter_pqr_records(pqr_filename):
+        if len(records) == 0:
+            continue
+        coords, q, rad = records[:, :3], records[:, 3], records[:, 4:5]
+        mins = np.minimum(mins, (coords - rad).min(axis=0))
+        maxs = np.maximum(maxs, (coords + rad).max(axis=0))
+        charge += q.sum()
+        n_atoms += len(records)
+    return mins, maxs, charge, n_atoms
+
+def psize_from_extents(mins, maxs, **constants):
+    """psize.py's setAll(): compute grid parameters from molecular extents.
+    """
+    c = dict(PSIZE_CONSTANTS)
+    c.update(constants)
+
+    olen = [max(maxs[i] - mins[i], 0.1) for i in range(3)]
+    center = [(maxs[i] + mins[i]) / 2. for i in range(3)]
+    clen = [c["cfac"] * olen[i] for i in range(3)]
+    flen = [min(olen[i] + c["fadd"], clen[i]) for i in range(3)]
+
+    n = []
+    for i in range(3):
+        t = int(flen[i] / c["space"] + 0.5)
+        n.append(max(32 * int((t - 1) / 32. + 0.5) + 1, 33))
+
+    # parallel decomposition in case memory requirements are above ceiling:
+    # shrink the largest dimension until it fits
+    nsmall = list(n)
+    while c["gmemfac"] * nsmall[0] * nsmall[1] * nsmall[2] / 1024 / 1024 >= c["gmemceil"]:
+        i = nsmall.index(max(nsmall))
+        nsmall[i] = 32 * ((nsmall[i] - 1) // 32 - 1) + 1
+        if nsmall[i] <= 0:
+            raise util.PluginDialogException("psize: memory ceiling "
+                f"{c['gmemceil']} MB is too small.")
+
+    zofac = 1 + 2 * c["ofrac"]
+    procgrid = []
+    for i in range(3):
+        np_i = n[i] / float(nsmall[i])
+        if np_i > 1:
+            np_i = int(zofac * n[i] / nsmall[i] + 1.0)
+        procgrid.append(int(np_i))
+
+    nfocus = 0
+    for i in range(3):
+        nfoc = int(math.log((flen[i] / procgrid[i]) / clen[i]) / math.log(c["redfac"]) + 1.0)
+        nfocus = max(nfocus, nfoc)
+    if nfocus > 0:
+        nfocus += 1
+
+    return dict(mol_dim=olen, center=center, coarse_dim=clen, fine_dim=flen,
+        fine_grid_points=n, nsmall=nsmall, procgrid=procgrid, nfocus=nfocus)
+
+def run_psize(pqr_filename, **constants):
+    """Equivalent of psize.py's Psize().runPsize(pqr_filename)."""
+    mins, maxs, charge, n_atoms = parse_pqr_extents(pqr_filename)
+    if n_atoms == 0:
+        raise util.PluginDialogException(f"No atoms found in PQR file {pqr_filename}.")
+    result = PsizeResult(n_atoms=n_atoms, charge=float(charge),
+        **psize_from_extents(mins.tolist(), maxs.tolist(), **constants))
+    _log.debug(f"psize: {result}")
+    return result
@@ -0,0 +1,56 @@
+"""
+Exceptions and helpers shared by the core and the Qt layer, which re-exports
+them from util.py.
+"""
+import enum
+import typing
+
+# ------------------------------------------------------------------------------
+
+def labeled_enum_factory(cls_name, cls_values):
+    # coerce cls_values to a dict of enum names : comboBox labels
+    if isinstance(cls_values, str):
+        cls_values = cls_values.split()
+    if isinstance(cls_values, typing.Sequence):
+        cls_values = {v:v for v in cls_values}
+
+    # start=0 to support cast from int -- comboBox index starts at 0
+    cls_ = enum.Enum(cls_name, tuple(cls_values.keys()), start=0)
+    # add methods
+    def _str(self):
+        return self.name
+    cls_.__str__ = _str
+    def _int(self):
+        return self.value
+    cls_.__int__ = _int
+
+    def _init_combobox(self, comboBox):
+        comboBox.clear()
+        for v in cls_values.values():
+            comboBox.addItem(v)
+        comboBox.setCurrentIndex(int(self))
+    cls_.init_combobox = _init_combobox
+
+    # signals/slots will be assigned when this is used as a field in a decorated Model
+    # Enum is not itself a QObject, and has no signals/slots of its own
+    return cls_
+
+# ------------------------------------------------------------------------------
+class PluginException(Exception):
+    """Base class for all exceptions raised by plugin's code.
+    """
+    pass
+
+class NoPDBException(PluginException):
+    pass
+
+class CancelledException(PluginException):
+    """Raised inside a running calculation when the user has cancelled it.
+    """
+    pass
+
+class PluginDialogException(PluginException):
+    """Base class for any exception which will be handled at the top level of
+    the plugin by creating a dialog box.
+    """
+    pass
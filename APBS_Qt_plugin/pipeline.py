@@ -0,0 +1,117 @@
+"""
+Runs the stages of the full calculation on a worker thread, so that the PyMol
+GUI stays responsive.
+
+Stages are plain callables. Any pymol.cmd calls they make go through
+pymol_api.PyMolModel, which marshals them back to the main thread; everything
+else (file I/O, external binaries) runs on the worker.
+"""
+import threading
+
+import logging
+_log = logging.getLogger(__name__)
+
+from pymol.Qt import QtCore
+from . import util
+
+# ------------------------------------------------------------------------------
+
+class PipelineWorker(util.PYQT_QOBJECT):
+    """Runs a sequence of (label, callable) stages in order, emitting progress
+    Signals as it goes. Cancellation is cooperative: it's checked between
+    stages, and long-running stages can poll `cancel_event` or call
+    `check_cancelled()` themselves.
+    """
+    stage_update = util.PYQT_SIGNAL(str)
+    progress_update = util.PYQT_SIGNAL(int) # percent, over all stages
+    finished = util.PYQT_SIGNAL()
+    failed = util.PYQT_SIGNAL(str)
+    cancelled = util.PYQT_SIGNAL()
+
+    def __init__(self, stages):
+        super(PipelineWorker, self).__init__()
+        self.stages = list(stages)
+        self.cancel_event = threading.Event()
+        self._stage_idx = 0
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise util.CancelledException
+
+    @util.PYQT_SLOT(float)
+    def on_stage_progress(self, fraction):
+        """Progress within the current stage, as a fraction in [0, 1]."""
+        fraction = min(max(fraction, 0.), 1.)
+        self.progress_update.emit(
+            int(100. * (self._stage_idx + fraction) / len(self.stages))
+        )
+
+    @util.PYQT_SLOT()
+    def run(self):
+        try:
+            for idx, (label, func) in enumerate(self.stages):
+                self.check_cancelled()
+                self._stage_idx = idx
+                _log.info(f"Pipeline stage {idx + 1}/{len(self.stages)}: {label}")
+                self.stage_update.emit(label)
+                self.on_stage_progress(0.)
+                # models changed by the stage notify views once, when it's done
+                with util.coalesce_updates():
+                    func()
+            self.check_cancelled()
+        except util.CancelledException:
+            _log.info("Pipeline cancelled.")
+            self.cancelled.emit()
+        except Exception as exc:
+            _log.exception("Pipeline stage failed.")
+            self.failed.emit(str(exc) or type(exc).__name__)
+        else:
+            self._stage_idx = len(self.stages)
+            self.on_stage_progress(0.)
+            self.finished.emit()
+
+class PipelineExecutor(util.PYQT_QOBJECT):
+    """Owns the worker thread for a PipelineWorker. Only one pipeline may run
+    at a time.
+    """
+    def __init__(self, parent=None):
+        super(PipelineExecutor, self).__init__(parent)
+        self.thread = None
+        self.worker = None
+
+    @property
+    def is_running(self):
+        return self.thread is not None and self.thread.isRunning()
+
+    def create_worker(self, stages):
+        """Create a worker for `stages`. Callers connect to its Signals, which
+        are delivered to the main thread via queued connections, before
+        passing it to start(), so that none are missed.
+        """
+        if self.is_running:
+            raise util.PluginDialogException("A calculation is already running.")
+        return PipelineWorker(stages)
+
+    def start(self, worker):
+        """Start `worker`, made by create_worker(), on a new thread."""
+        if self.is_running:
+            raise util.PluginDialogException("A calculation is already running.")
+
+        self.worker = worker
+        self.thread = QtCore.QThread()
+        self.worker.moveToThread(self.thread)
+
+        self.thread.started.connect(self.worker.run)
+        for signal in (self.worker.finished, self.worker.failed, self.worker.cancelled):
+            signal.connect(self.thread.quit)
+        self.thread.finished.connect(self.worker.deleteLater)
+        self.thread.start()
+        return self.worker
+
+    @util.PYQT_SLOT()
+    def cancel(self):
+        # don't wait() on the thread here: stages may be blocked on a pymol.cmd
+        # call that needs the main thread's event loop to complete.
+        if self.worker is not None and self.is_running:
+            _log.info("Cancelling pipeline.")
+            self.worker.cancel_event.set()
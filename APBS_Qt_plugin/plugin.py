@@ -1,12 +1,16 @@
 """
 Top-level plugin state and logic.
 """
+import functools
 import logging
+import time
 _log = logging.getLogger(__name__)
 
-from pymol.Qt import QtWidgets
+from pymol.Qt import (QtCore, QtWidgets)
 from .ui.plugin_dialog_ui import Ui_plugin_dialog
-from . import (pymol_api, pqr, apbs, visualization, util)
+import attrs
+from . import (pymol_api, pqr, apbs, visualization, pipeline, util)
+from .core import memory
 
 # ------------------------------------------------------------------------------
 # Models
@@ -14,22 +18,90 @@ from . import (pymol_api, pqr, apbs, visualization, util)
 @util.attrs_define
 class PluginModel(util.BaseModel):
     pqr_model: util.BaseModel
+    grid_model: util.BaseModel
     apbs_model: util.BaseModel
     viz_model: util.BaseModel
+    executor: pipeline.PipelineExecutor = attrs.Factory(pipeline.PipelineExecutor)
+
+    is_running: bool = False
+    run_stage: str = ""
+    run_progress: int = 0
+
+    # emitted with error text if a stage of the calculation raised
+    run_failed = util.PYQT_SIGNAL(str)
+
+    def __attrs_post_init__(self):
+        super().__attrs_post_init__()
+        self._worker = None # PipelineWorker of the current run
+
+    def stages(self):
+        """Steps of the full calculation, as (label, callable) pairs.
+        """
+        return [
+            ("Generating PQR file", self.pqr_model.write_PQR_file),
+            ("Calculating grid", self.set_grid_params),
+            ("Writing APBS input file", lambda: self.apbs_model.write_APBS_input_file(
+                self.pqr_model.pqr_out_file, self.grid_model
+            )),
+            ("Running APBS", lambda: self.apbs_model.run_apbs_cached(
+                self.pqr_model.pqr_out_file
+            )),
+            ("Loading potential map", self.load_map),
+            ("Updating visualization", self.viz_model.update)
+        ]
+
+    def set_grid_params(self):
+        # size the grid using the memory estimate for the chosen solver mode
+        self.grid_model.apbs_mode = self.apbs_model.apbs_mode.name
+        self.grid_model.set_grid_params(self.pqr_model.pqr_out_file)
+        # kept for recalculating with either method from the grid dialog
+        for model in self.grid_model.models:
+            model.pqr_filename = str(self.pqr_model.pqr_out_file)
+
+    def load_map(self):
+        stats = self.apbs_model.load_apbs_map()
+        self.viz_model.map_name = self.apbs_model.apbs_map_name
+        if self.viz_model.auto_levels:
+            self.viz_model.set_default_levels(stats)
 
     @util.PYQT_SLOT()
     def run(self):
-        """Run the full calculation.
+        """Run the full calculation on a worker thread.
         """
-        # TODO: exception handling!!
-        try:
-            self.pqr_model.write_PQR_file()
-            self.apbs_model.write_APBS_input_file(self.pqr_model.pqr_out_file, self.grid_model)
-            self.apbs_model.run_apbs()
-            self.apbs_model.load_apbs_map()
-            self.viz_model.update()
-        except Exception as exc:
-            raise util.PluginDialogException from exc
+        if self.is_running:
+            return
+        worker = self.executor.create_worker(self.stages())
+        worker.stage_update.connect(self.on_run_stage_update)
+        worker.progress_update.connect(self.on_run_progress_update)
+        worker.finished.connect(self.on_run_finished)
+        worker.cancelled.connect(self.on_run_finished)
+        worker.failed.connect(self.on_run_error)
+        # APBS is the slowest stage, so report progress within it
+        self.apbs_model.runner.progress_update.connect(worker.on_stage_progress)
+        self._worker = worker
+        with self.batch_update():
+            self.run_progress = 0
+            self.is_running = True
+        self.executor.start(worker)
+
+    @util.PYQT_SLOT()
+    def cancel(self):
+        self.executor.cancel()
+        self.apbs_model.runner.kill()
+
+    @util.PYQT_SLOT()
+    def on_run_finished(self):
+        if self._worker is not None:
+            self.apbs_model.runner.progress_update.disconnect(self._worker.on_stage_progress)
+            self._worker = None
+        with self.batch_update():
+            self.is_running = False
+            self.run_stage = ""
+
+    @util.PYQT_SLOT(str)
+    def on_run_error(self, msg):
+        self.on_run_finished()
+        self.run_failed.emit(msg)
 
 # ------------------------------------------------------------------------------
 # Views
@@ -39,6 +111,20 @@ class PluginView(QtWidgets.QDialog, Ui_plugin_dialog):
         super(PluginView, self).__init__(parent)
         self.setupUi(self)
 
+    @util.PYQT_SLOT(bool)
+    def on_is_running_update(self, b):
+        # run button doubles as cancel button while calculation is in progress
+        self.run_button.setText("Cancel" if b else "Run")
+        self.run_progressBar.setVisible(b)
+
+    @util.PYQT_SLOT(str)
+    def on_run_stage_update(self, stage):
+        self.setWindowTitle(f"APBS Tools - {stage}..." if stage else "APBS Tools")
+
+    @util.PYQT_SLOT(int)
+    def on_run_progress_update(self, percent):
+        self.run_progressBar.setValue(percent)
+
 # ------------------------------------------------------------------------------
 # Controllers
 
@@ -55,8 +141,12 @@ class PluginController(util.BaseController):
             pymol_controller = self.pymol_controller,
             view = self.view.pqr_groupBox
         )
+        # read once, and shared by the grid and APBS models so grid sizing
+        # uses the peaks measured by each run
+        self.memory_model = memory.MemoryModel.load()
         self.abps_controller = apbs.APBSGroupBoxController(
             pymol_controller = self.pymol_controller,
+            memory_model = self.memory_model,
             view = self.view.apbs_groupBox
         )
         self.viz_controller = visualization.VizGroupBoxController(
@@ -66,11 +156,45 @@ class PluginController(util.BaseController):
 
         self.model = PluginModel(
             pqr_model = self.pqr_controller.model,
+            grid_model = self.abps_controller.grid_controller.model,
             apbs_model = self.abps_controller.model,
             viz_model = self.viz_controller.model
         )
-        self.view.run_button.clicked.connect(self.model.run)
+        self.view.run_button.clicked.connect(self.on_run_button_clicked)
+        self.view.rejected.connect(self.model.cancel)
+        util.connect_signal(self.model, "is_running", self.view.on_is_running_update)
+        util.connect_signal(self.model, "run_stage", self.view.on_run_stage_update)
+        util.connect_signal(self.model, "run_progress", self.view.on_run_progress_update)
+        self.model.run_failed.connect(self.on_run_failed)
+        # remove the APBS model's temporary working directory when pymol exits
+        app = QtCore.QCoreApplication.instance()
+        if app is not None:
+            app.aboutToQuit.connect(self.abps_controller.model.cleanup)
         self.model.refresh()
 
-    def show(self):
+    @util.PYQT_SLOT()
+    def on_run_button_clicked(self):
+        if self.model.is_running:
+            self.model.cancel()
+        else:
+            self.model.run()
+
+    @util.PYQT_SLOT(str)
+    def on_run_failed(self, msg):
+        util.show_error_dialog(msg, parent=self.view)
+
+    def show(self, t_start=None):
+        """Show the plugin dialog. Option dialogs aren't built until they're
+        opened, and pymol's object list isn't read until the dialog is up. If
+        given, `t_start` is the time.perf_counter() value when the plugin was
+        launched, and the time until the dialog is drawn is logged.
+        """
         self.view.show()
+        # timers fire once the event loop has drawn the dialog
+        if t_start is not None:
+            QtCore.QTimer.singleShot(0, functools.partial(self.log_startup_time, t_start))
+        QtCore.QTimer.singleShot(0, self.pymol_controller.load_sel_values)
+
+    def log_startup_time(self, t_start):
+        _log.info(f"APBS Tools dialog shown in "
+            f"{1000. * (time.perf_counter() - t_start):.0f} ms.")
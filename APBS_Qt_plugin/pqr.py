@@ -3,15 +3,19 @@ Model, view and controller for PQR file generation configuration.
 """
 import os
 import pathlib
-import re
 import shlex
+import subprocess
+import sys
 
 import logging
 _log = logging.getLogger(__name__)
 
 from . import pymol_api, util
+from .core import pqr as core_pqr
 from .ui.views import VizGroupBoxView
 
+# ------------------------------------------------------------------------------
+
 # ------------------------------------------------------------------------------
 # Models
 
@@ -26,42 +30,22 @@ class PQRBaseModel(util.BaseModel):
 
     def write_selection_to_file(self, sel, path):
         """Write the state of selection `sel` to a text file at `path`. File
-        format is set automatically from extension.
-        """
-        temp_mol_obj = self.pymol_cmd.get_unused_name()
-        self.pymol_cmd.create(temp_mol_obj, sel)
-
-        # Make sure that everything fits into the correct columns (rounding)
-        self.pymol_cmd.alter_state(
-            1, 'all', '(x,y,z)=float("%.3f"%x),float("%.3f"%y),float("%.3f"%z)'
-        )
-        # Get rid of chain, occupancy and b-factor information
-        self.pymol_cmd.alter(temp_mol_obj, 'chain=""')
-        self.pymol_cmd.alter(temp_mol_obj, 'b=0')
-        self.pymol_cmd.alter(temp_mol_obj, 'q=0')
+        format (pdb or pqr) is set automatically from extension.
 
-        self.pymol_cmd.save(path, temp_mol_obj)
-        self.pymol_cmd.delete(temp_mol_obj)
+        Records are formatted by PyMol's own writer in a single call (coordinates
+        are written to 3 decimal places, so fit the fixed columns), and chain,
+        occupancy and b-factor information is then removed from the text in
+        bulk. Unlike copying to a temp object and `alter`ing it, this doesn't
+        modify the PyMol session.
+        """
+        fmt = os.path.splitext(str(path))[1].lstrip('.').lower() or 'pdb'
+        text = self.pymol_cmd.get_str(fmt, sel)
+        with open(path, 'wb') as f:
+            f.write(core_pqr.strip_chain_and_b_factors(text, fmt))
 
     @staticmethod
     def clean_pqr_columns(pqr_txt):
-        """Cleanup on contents of generated PQR files.
-
-        pdb2pqr will happily write out a file where the coordinate
-        columns overlap if you have -100.something as one of the
-        coordinates, like
-
-        90.350  97.230-100.010
-
-        and so will PyMOL. We can't just assume that it's 0-1
-        because pdb2pqr will debump things and write them out with
-        3 digits post-decimal.
-        """
-        # APBS accepts whitespace-delimited columns
-        coord_regex = r'([- 0-9]{4}\.[ 0-9]{3})'
-        source_regex = re.compile(r'^(ATOM  |HETATM)(........................)' + 3*coord_regex)
-        target_regex = re.compile(r'\1\2 \3 \4 \5')
-        return re.sub(source_regex, target_regex, pqr_txt, flags=re.M)
+        return core_pqr.clean_pqr_columns(pqr_txt)
 
 @util.attrs_define
 class PPQRDB2PQRModel(PQRBaseModel):
@@ -74,12 +58,7 @@ class PPQRDB2PQRModel(PQRBaseModel):
 
     @staticmethod
     def get_unassigned_atoms(pqr_txt):
-        """
-        Return string of unassigned atoms, identified via warning text in comments
-        in output.
-        """
-        unassigned = re.compile(r'REMARK   5 *(\d+) \w* in').findall(pqr_txt)
-        return '+'.join(unassigned)
+        return core_pqr.get_unassigned_atoms(pqr_txt)
 
     def write_PQR_file(self):
         """Use pdb2pqr to generate a PQR file.
@@ -115,18 +94,9 @@ class PPQRDB2PQRModel(PQRBaseModel):
                 "for more information.\n"
             )
 
-        if self.prepare_pqr:
-            with open(self.pqr_out_file, 'a+') as f:
-                pqr_text = f.read()
-                pqr_text = self.clean_pqr_columns(pqr_text)
-                unassigned_atoms = self.get_unassigned_atoms(pqr_text)
-                f.seek(0)
-                f.write(pqr_text)
-                f.truncate()
-        else:
-            with open(self.pqr_out_file, 'r') as f:
-                pqr_text = f.read()
-                unassigned_atoms = self.get_unassigned_atoms(pqr_text)
+        unassigned_atoms = '+'.join(
+            core_pqr.clean_pqr_file(self.pqr_out_file, clean_columns=self.prepare_pqr)
+        )
 
         if unassigned_atoms:
             self.pymol_cmd.select('unassigned', f"ID {unassigned_atoms}")
@@ -181,13 +151,7 @@ class PQRPyMolModel(PQRBaseModel):
         self.pymol_cmd.set('retain_order', ret_order)
 
         self.write_selection_to_file(sel, self.pqr_out_file)
-
-        with open(self.pqr_out_file, 'a+') as f:
-            pqr_text = f.read()
-            pqr_text = self.clean_pqr_columns(pqr_text)
-            f.seek(0)
-            f.write(pqr_text)
-            f.truncate()
+        core_pqr.clean_pqr_file(self.pqr_out_file)
 
         missed_count = self.pymol_cmd.count_atoms(f"({sel}) and flag 23")
         if missed_count > 0:
@@ -210,10 +174,10 @@ class PQRController(util.BaseController):
             raise ValueError
 
         pdb2pqr_model = PPQRDB2PQRModel(
-            pymol_cmd = pymol_controller.model.pymol_instance
+            pymol_cmd = pymol_controller.model
         )
         pymol_model = PQRPyMolModel(
-            pymol_cmd = pymol_controller.model.pymol_instance
+            pymol_cmd = pymol_controller.model
         )
         self.model = util.MultiModel(pdb2pqr_model, pymol_model)
         if view is None:
@@ -9,12 +9,178 @@ import logging
 _log = logging.getLogger(__name__)
 
 import attrs
+import contextlib
+import fnmatch
+import functools
+import os
+import re
+import tempfile
+import time
+import numpy as np
 import pymol.cmd as pymol_cmd
 from . import util
+from .core import cache, dx, maparith
 
 # ------------------------------------------------------------------------------
 # Models
 
+# pymol.cmd functions which can delete, replace or modify map objects; calling
+# any of them through PyMolModel drops the maps cached by get_map()
+_MAP_CHANGING_CMDS = frozenset((
+    'delete', 'set_name', 'reinitialize', 'load_session', 'load', 'load_brick',
+    'load_map', 'fetch', 'map_new', 'map_set', 'map_double', 'map_halve', 'map_trim'
+))
+_FLOAT_MB = 1024. * 1024.
+
+# argument to cmd.delete that names a single object, rather than a pattern or
+# selection expression
+_PLAIN_OBJECT_NAME = re.compile(r'[\w.+-]+')
+
+def _matching_names(name, names):
+    """Those of `names` matched by `name`, which may be 'all' or a pymol name
+    pattern (a space-separated list of names with * and ? wildcards.)
+    """
+    if name == 'all':
+        return list(names)
+    matches = []
+    for pattern in name.split():
+        if _PLAIN_OBJECT_NAME.fullmatch(pattern):
+            if pattern in names:
+                matches.append(pattern)
+        else:
+            matches.extend(fnmatch.filter(list(names), pattern))
+    return matches
+
+# pymol.cmd functions whose calls are deferred until the end of a redraw
+# transaction (see PyMolModel.redraw_transaction().)
+_DEFERRED_CMDS = frozenset(('set', 'color', 'recolor', 'refresh'))
+
+def _deferred_call_key(name, args, kwargs):
+    """Key identifying what a deferred set() or color() call changes, so that
+    only the last of several calls with the same key is made. Also returns the
+    selection the call applies to.
+    """
+    kwargs = dict(kwargs)
+    if name == 'set':
+        # set(name, value, selection='', state=0, ...)
+        kwargs.pop('value', None)
+        args = args[:1] + args[2:]
+        selection = args[1] if len(args) > 1 else kwargs.get('selection', '')
+    else:
+        # color(color, selection='(all)', ...)
+        kwargs.pop('color', None)
+        args = args[1:]
+        selection = args[0] if args else kwargs.get('selection', '(all)')
+    return (name, args, tuple(sorted(kwargs.items()))), selection
+
+@attrs.define
+class ObjectIndex():
+    """Index of each PyMol object among the objects of its type, used to give
+    the visualization objects derived from it short names that are unique to
+    it. An object is given its position in cmd.get_names_of_type the first
+    time it's looked up (or the next unused index, if another object already
+    has that one) and keeps it until it's deleted or renamed, so derived names
+    don't change when other objects are deleted or reloaded.
+
+    Entries of objects deleted or renamed through PyMolModel are dropped by
+    `discard()`; PyMolModel.object_name_index() drops those of objects deleted
+    in the PyMol session outside of the plugin when they're next looked up.
+    """
+    _indices: dict = attrs.Factory(dict) # object type -> {name: index}
+
+    def index(self, names, obj_type, name):
+        """Return the index of object `name` among objects of `obj_type`, whose
+        names, in pymol's order, are `names`.
+        """
+        indices = self._indices.setdefault(obj_type, dict())
+        try:
+            return indices[name]
+        except KeyError:
+            pass
+        try:
+            idx = names.index(name)
+        except ValueError:
+            raise ValueError(f"No PyMol {obj_type} named '{name}'") from None
+        used = set(indices.values())
+        while idx in used:
+            idx += 1
+        indices[name] = idx
+        return idx
+
+    def discard(self, name):
+        """Drop objects matching `name`, which may be 'all' or a pymol name
+        pattern, from every object type.
+        """
+        for indices in self._indices.values():
+            for n in _matching_names(name, indices):
+                del indices[n]
+
+    def clear(self):
+        self._indices.clear()
+
+@attrs.define
+class MapEntry():
+    nbytes: int
+    source: str = "" # DX file the map can be reloaded from, if kept on disk
+    loaded: bool = True
+
+@attrs.define
+class MapRegistry():
+    """Maps loaded into the PyMol session by PyMolModel.load_dx(), with the
+    memory taken by each one's data, kept in least recently viewed order. Maps
+    unloaded to stay within a memory budget stay registered, with the file to
+    reload them from.
+
+    Maps deleted through PyMolModel are dropped by `discard()`; those deleted
+    in the PyMol session outside of the plugin are dropped the next time the
+    budget is enforced.
+    """
+    _entries: dict = attrs.Factory(dict) # name -> MapEntry, least recently viewed first
+
+    def get(self, name):
+        return self._entries.get(name)
+
+    def add(self, name, nbytes, source="", loaded=True):
+        """Register map `name` as the most recently viewed one."""
+        self._entries.pop(name, None)
+        self._entries[name] = MapEntry(nbytes=nbytes, source=source, loaded=loaded)
+
+    def touch(self, name):
+        """Mark map `name` as the most recently viewed one."""
+        self._entries[name] = self._entries.pop(name)
+
+    def discard(self, name):
+        """Drop maps matching `name`, which may be 'all' or a pymol name pattern
+        (a space-separated list of names with * and ? wildcards.)
+        """
+        for n in _matching_names(name, self._entries):
+            del self._entries[n]
+
+    def clear(self):
+        self._entries.clear()
+
+    def loaded_names(self):
+        return [name for name, entry in self._entries.items() if entry.loaded]
+
+    @property
+    def loaded_bytes(self):
+        return sum(e.nbytes for e in self._entries.values() if e.loaded)
+
+    def to_unload(self, max_bytes, keep=()):
+        """Names of loaded maps to unload, least recently viewed first, for the
+        rest to fit in `max_bytes`. The most recently viewed map and those in
+        `keep` are never unloaded, even if they don't fit by themselves.
+        """
+        total = self.loaded_bytes
+        names = []
+        for name in self.loaded_names()[:-1]:
+            if total <= max_bytes:
+                break
+            if name not in keep:
+                names.append(name)
+                total -= self._entries[name].nbytes
+        return names
+
 @util.attrs_define
 class PyMolModel(util.BaseModel):
     """Fields defining config state for the PyMol session that are
@@ -22,16 +188,324 @@ class PyMolModel(util.BaseModel):
     """
     sel_values: list = attrs.Factory(list)
     sel_idx: int = 0
+    object_index: ObjectIndex = attrs.Factory(ObjectIndex)
+    map_registry: MapRegistry = attrs.Factory(MapRegistry)
+    map_cache: cache.MapCache = attrs.Factory(cache.MapCache) # where unloaded maps are kept
+    max_map_memory: int = 4000 # MB, for maps loaded by load_dx()
     pymol_instance = pymol_cmd
 
+    # emitted with the name of a map loaded by load_dx() when its data is
+    # loaded or replaced, or it's unloaded or deleted, so that copies made
+    # from it can be dropped
+    map_changed = util.PYQT_SIGNAL(str)
+
+    def __attrs_post_init__(self):
+        super().__attrs_post_init__()
+        # state of open redraw_transaction()s
+        self._redraw_depth = 0
+        self._deferred_calls = dict() # key -> (cmd name, args, kwargs, selection)
+        self._deferred_recolor = dict() # selections to recolor (ordered set)
+        self._n_coalesced = 0
+        self._maps = dict() # (map name, state) -> DXMap, see get_map()
+        self._unloading = None # map being unloaded by _unload_map()
+
     def __getattr__(self, name):
-        """Pass through all method lookups to pymol.cmd.
+        """Pass through all method lookups to pymol.cmd. PyMol API calls made
+        from a worker thread (see pipeline.py) are marshalled to the main thread.
+        Inside a redraw_transaction(), calls to set, color, recolor and refresh
+        are deferred until it closes.
         """
         try:
             # Throws exception if not in prototype chain
             return object.__getattribute__(self, name)
         except AttributeError:
-            return getattr(self.pymol_instance, name)
+            if name in _DEFERRED_CMDS and self._redraw_depth > 0:
+                return functools.partial(self._defer_call, name)
+            return self._pymol_attr(name)
+
+    def _pymol_attr(self, name):
+        attr = getattr(self.pymol_instance, name)
+        if name in _MAP_CHANGING_CMDS:
+            attr = functools.partial(self._invalidating_call, name, attr)
+        if callable(attr) and not util.in_main_thread():
+            return functools.partial(util.run_in_main_thread, attr)
+        return attr
+
+    def _invalidating_call(self, cmd_name, func, *args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._maps.clear()
+            deleted = args[0] if args else kwargs.get('name')
+            if cmd_name == 'delete' and isinstance(deleted, str):
+                self._drop_deferred_calls(deleted.strip())
+                if self.map_registry.get(deleted.strip()) is not None:
+                    self.map_changed.emit(deleted.strip())
+                self.map_registry.discard(deleted.strip())
+                if deleted.strip() != self._unloading:
+                    self.object_index.discard(deleted.strip())
+            elif cmd_name == 'set_name':
+                old_name = args[0] if args else kwargs.get('old_name')
+                if isinstance(old_name, str):
+                    self.object_index.discard(old_name.strip())
+            elif cmd_name in ('reinitialize', 'load_session'):
+                self.object_index.clear()
+                self.map_registry.clear()
+
+    def _defer_call(self, name, *args, **kwargs):
+        if name == 'refresh':
+            return # done once, when the transaction closes
+        if name == 'recolor':
+            selection = args[0] if args else kwargs.get('selection', 'all')
+            if selection in self._deferred_recolor:
+                self._n_coalesced += 1
+            self._deferred_recolor[selection] = None
+            return
+        key, selection = _deferred_call_key(name, args, kwargs)
+        if self._deferred_calls.pop(key, None) is not None:
+            self._n_coalesced += 1
+        # re-insert, so that calls are made in order of their last occurrence
+        self._deferred_calls[key] = (name, args, kwargs, selection)
+
+    def _drop_deferred_calls(self, selection):
+        # set/color calls on an object that's been deleted would fail when the
+        # transaction closes
+        for key, call in list(self._deferred_calls.items()):
+            if call[3] == selection:
+                del self._deferred_calls[key]
+        self._deferred_recolor.pop(selection, None)
+
+    def _flush_deferred_calls(self):
+        calls = list(self._deferred_calls.values())
+        recolor = list(self._deferred_recolor)
+        self._deferred_calls.clear()
+        self._deferred_recolor.clear()
+        for name, args, kwargs, _ in calls:
+            self._pymol_attr(name)(*args, **kwargs)
+        for selection in recolor:
+            self._pymol_attr('recolor')(selection)
+        return len(calls) + len(recolor)
+
+    @contextlib.contextmanager
+    def redraw_transaction(self, label="PyMol update"):
+        """Context manager grouping a series of PyMol API calls into a single
+        scene update. Redraws are suspended while the block runs; set(), color()
+        and recolor() calls are deferred to the end of the block, where repeated
+        calls changing the same setting or color of the same selection are made
+        once, with their last value; then the scene is refreshed once.
+        Transactions may be nested, in which case all work is done when the
+        outermost one closes. Time taken by the block and by the final redraw
+        is logged under `label`.
+        """
+        self._redraw_depth += 1
+        if self._redraw_depth == 1:
+            t_start = time.perf_counter()
+            self._n_coalesced = 0
+            was_suspended = self._pymol_attr('get_setting_boolean')('suspend_updates')
+            if not was_suspended:
+                self._pymol_attr('set')('suspend_updates', 1)
+        try:
+            yield self
+        finally:
+            self._redraw_depth -= 1
+            if self._redraw_depth == 0:
+                t_flush = time.perf_counter()
+                try:
+                    n_calls = self._flush_deferred_calls()
+                finally:
+                    if not was_suspended:
+                        self._pymol_attr('set')('suspend_updates', 0)
+                    self._pymol_attr('refresh')()
+                t_end = time.perf_counter()
+                _log.debug(f"{label}: {1000. * (t_end - t_start):.1f} ms total, "
+                    f"{1000. * (t_end - t_flush):.1f} ms applying {n_calls} "
+                    f"deferred calls ({self._n_coalesced} coalesced) and redrawing.")
+
+    def object_name_index(self, obj_type, name):
+        """Return the stable index of object `name` among the pymol objects of
+        type `obj_type` (e.g. 'object:map'); see ObjectIndex.
+        """
+        # go through __getattr__, so the query is marshalled to the main thread
+        names = self.get_names_of_type(obj_type)
+        entry = self.map_registry.get(name)
+        if name not in names and (entry is None or entry.loaded):
+            # deleted or renamed in the session, bypassing delete() and set_name()
+            self.object_index.discard(name)
+        return self.object_index.index(names, obj_type, name)
+
+    def get_map(self, map_name, state=1):
+        """Return the data of pymol map object `map_name` as a core.dx.DXMap.
+        The map is copied out of pymol once, and kept until a map is deleted,
+        loaded or modified through this object; callers shouldn't modify it.
+        """
+        try:
+            return self._maps[(map_name, state)]
+        except KeyError:
+            pass
+        entry = self.map_registry.get(map_name)
+        if entry is not None and not entry.loaded:
+            self.ensure_map_loaded(map_name)
+        data = self.get_volume_field(map_name, state)
+        if data is None:
+            raise util.PluginDialogException(f"Couldn't get data of map '{map_name}'.")
+        data = np.asarray(data, dtype=np.float32)
+        # extent of a map object is the bounding box of its grid points
+        mins, maxs = (np.asarray(v, dtype=np.float64) for v in self.get_extent(map_name))
+        delta = (maxs - mins) / np.maximum(np.asarray(data.shape) - 1, 1)
+        dx_map = dx.DXMap(data=data, origin=tuple(mins.tolist()), delta=tuple(delta.tolist()))
+        self._maps[(map_name, state)] = dx_map
+        return dx_map
+
+    def load_dx(self, path, map_name):
+        """Load the DX file at `path` as pymol map `map_name`, replacing any
+        existing object of that name. The file is parsed with numpy (see
+        core/dx.py) and handed to pymol as a brick, so pymol doesn't parse the
+        text again. Returns the DXMap, which is also kept for get_map().
+
+        An existing map is replaced in place, as its first state, so it keeps
+        its place in the session's object list; pymol itself replaces any other
+        kind of object of that name.
+
+        The map is registered in `map_registry`, and the least recently viewed
+        maps are unloaded if needed to keep within `max_map_memory`.
+        """
+        try:
+            from chempy.brick import Brick
+        except ModuleNotFoundError:
+            raise util.PluginDialogException("load_dx couldn't import chempy.brick.")
+
+        try:
+            dx_map = dx.read_dx(path)
+        except (OSError, util.PluginException) as exc:
+            raise util.PluginDialogException(f"Couldn't read map {path}: {exc}")
+        brick = Brick.from_numpy(dx_map.data, dx_map.delta, dx_map.origin)
+        self.load_brick(brick, map_name, state=1)
+        self._maps[(map_name, 1)] = dx_map
+        _log.info(f"Loaded {dx_map.counts} map as '{map_name}'.")
+        self.map_changed.emit(map_name)
+        # files in the cache can be reloaded from, so needn't be written again
+        # when the map is unloaded
+        self.map_registry.add(map_name, dx_map.nbytes,
+            source=str(path) if self.map_cache.contains(path) else "")
+        self.enforce_map_memory(keep=(map_name,))
+        return dx_map
+
+    def ensure_map_loaded(self, map_name):
+        """Mark map `map_name` as viewed, and reload it if it was unloaded by
+        enforce_map_memory(). Maps not loaded by load_dx() are ignored.
+        """
+        entry = self.map_registry.get(map_name)
+        if entry is None:
+            return
+        self.map_registry.touch(map_name)
+        if entry.loaded:
+            return
+        if map_name in self.get_names_of_type('object:map'):
+            # replaced in the session by something we didn't load
+            self.map_registry.discard(map_name)
+            return
+        if not os.path.isfile(entry.source):
+            self.map_registry.discard(map_name)
+            raise util.PluginDialogException(f"Map '{map_name}' was unloaded to "
+                f"save memory, and its file {entry.source} has since been removed "
+                "(e.g. evicted from the map cache).")
+        _log.info(f"Reloading map '{map_name}' from {entry.source}.")
+        self.load_dx(entry.source, map_name)
+
+    def enforce_map_memory(self, keep=()):
+        """Unload the least recently viewed maps loaded by load_dx() until the
+        rest take no more than `max_map_memory` MB. Unloaded maps are deleted
+        from the session after making sure they're in `map_cache`, and reloaded
+        from there by ensure_map_loaded(). Maps in `keep` aren't unloaded.
+        """
+        present = set(self.get_names_of_type('object:map'))
+        for name in self.map_registry.loaded_names():
+            if name not in present:
+                self.map_registry.discard(name) # deleted outside the plugin
+        for name in self.map_registry.to_unload(self.max_map_memory * _FLOAT_MB, keep):
+            self._unload_map(name)
+
+    def _unload_map(self, map_name):
+        entry = self.map_registry.get(map_name)
+        if not (entry.source and os.path.isfile(entry.source)):
+            try:
+                dx_map = self.get_map(map_name)
+                entry.source = self.map_cache.put_map(self.map_cache.map_key(dx_map), dx_map)
+            except (OSError, util.PluginException) as exc:
+                _log.warning(f"Couldn't save map '{map_name}' to cache; "
+                    f"not unloading it: {exc}")
+                return
+        # keep the map's index, so it gets the same derived names when reloaded
+        self._unloading = map_name
+        try:
+            self.delete(map_name)
+        finally:
+            self._unloading = None
+        self.map_registry.add(map_name, entry.nbytes, source=entry.source, loaded=False)
+        _log.info(f"Unloaded map '{map_name}' ({entry.nbytes / _FLOAT_MB:.0f} MB) "
+            f"to {entry.source}.")
+
+    @util.PYQT_SLOT(int)
+    def on_max_map_memory_update(self, max_map_memory):
+        self.max_map_memory = max_map_memory
+        self.enforce_map_memory()
+
+    def load_map_expression(self, expression, map_name, sources=None, out_path=None):
+        """Evaluate map arithmetic `expression` (see core/maparith.py) and load
+        the result as pymol map `map_name`. Names in the expression are looked
+        up in `sources`, a dict of name: DX file path, and otherwise taken to be
+        pymol maps. DX files are streamed through, so only the result needs to
+        fit in memory. The result is written to `out_path` if given, else to a
+        temporary file. Returns the new map's statistics.
+        """
+        sources = dict(sources or {})
+        for name in maparith.map_names(expression) - set(sources):
+            if name not in self.get_names_of_type('object:map') \
+                and self.map_registry.get(name) is None:
+                raise util.PluginDialogException(f"Map expression '{expression}': "
+                    f"no map named '{name}'.")
+            sources[name] = self.get_map(name)
+        if out_path is None:
+            fd, path = tempfile.mkstemp(suffix='.dx', prefix='map_expression_')
+            os.close(fd)
+        else:
+            path = out_path
+        try:
+            try:
+                maparith.evaluate(expression, sources, path)
+            except (OSError, util.PluginException) as exc:
+                raise util.PluginDialogException(str(exc))
+            dx_map = self.load_dx(path, map_name)
+        finally:
+            if out_path is None:
+                os.remove(path)
+        return dx_map.get_stats()
+
+    def get_coords_and_radii(self, selection):
+        """Return coordinates (N x 3) and van der Waals radii (N,) of the atoms
+        in `selection`.
+        """
+        coords = self.get_coords(selection)
+        if coords is None:
+            return np.empty((0, 3)), np.empty(0)
+        radii = []
+        self.iterate(selection, 'radii.append(vdw)', space={'radii': radii})
+        return np.asarray(coords, dtype=np.float64), np.asarray(radii, dtype=np.float64)
+
+    def alter_atoms(self, selection, prop, values):
+        """Set property `prop` of the atoms in `selection` to `values`, given in
+        the order of get_coords(selection). `prop` is an atom attribute usable
+        in cmd.alter expressions, e.g. 'b' or 'q', or a user-defined property
+        written as 'p.<name>'. Done in a single cmd.alter call. Raises
+        PluginException if there isn't one value per atom.
+        """
+        values = np.asarray(values, dtype=np.float64).ravel().tolist()
+        n_atoms = self.count_atoms(selection)
+        if len(values) != n_atoms:
+            raise util.PluginException(f"Selection '{selection}' has {n_atoms} "
+                f"atoms but {len(values)} values for '{prop}'.")
+        values = iter(values)
+        self.alter(selection, f"{prop} = next(_values)", space={'_values': values})
 
     @property
     def selection(self):
@@ -84,11 +558,11 @@ class PyMolController(util.PYQT_QOBJECT):
         # changes to state to pymol_instance "model"
         self.view = view
 
-        # init model and combobox entries
-        self.get_pymol_sel_values()
+        # combobox follows changes to the list; entries are filled in by
+        # load_sel_values(), since listing objects is slow in large sessions
         self.view.clear()
-        for s in self.model.sel_values:
-            self.view.addItem(s)
+        self.model.sel_values_changed.connect(self.on_sel_values_changed)
+        self._sel_values_loaded = False
 
         # view (comboBox) <-> model
         util.biconnect(self.view, self.model, "sel_idx")
@@ -97,6 +571,35 @@ class PyMolController(util.PYQT_QOBJECT):
         # init view from model values
         self.model.refresh()
 
+    @util.PYQT_SLOT(object)
+    def on_sel_values_changed(self, change):
+        """Apply a ListChange to the selection comboBox's entries, rather than
+        repopulating it.
+        """
+        values = self.model.sel_values
+        if change.n_removed is None:
+            self.view.clear()
+            self.view.addItems(list(values))
+            return
+        for _ in range(change.n_removed):
+            self.view.removeItem(change.start)
+        for i in range(change.start, change.start + change.n_inserted):
+            self.view.insertItem(i, values[i])
+
+    @util.PYQT_SLOT()
+    def load_sel_values(self):
+        """Populate selection values from pymol, if that hasn't been done yet.
+        """
+        if not self._sel_values_loaded:
+            self._sel_values_loaded = True
+            # filling the comboBox changes its text, which isn't a custom
+            # selection (previously this ran before editTextChanged was connected)
+            was_blocked = self.view.blockSignals(True)
+            try:
+                self.get_pymol_sel_values()
+            finally:
+                self.view.blockSignals(was_blocked)
+
     def get_pymol_sel_values(self):
         """Populate selection values based on current pymol state.
         """
@@ -119,10 +622,16 @@ class PyMolController(util.PYQT_QOBJECT):
         # remove enclosing parentheses, if any; restored by pymol_selection()
         value_str = value_str.strip('()')
 
-        new_values = self.model._get_default_sel_values()
-        new_values.append(value_str)
-        self.model.sel_values = new_values
-        self.model.sel_idx = len(new_values)
+        default_values = self.model._get_default_sel_values()
+        sel_values = self.model.sel_values
+        with self.model.batch_update():
+            if sel_values[:len(default_values)] == default_values:
+                # only the custom entry changes
+                del sel_values[len(default_values):]
+                sel_values.append(value_str)
+            else:
+                self.model.sel_values = default_values + [value_str]
+            self.model.sel_idx = len(self.model.sel_values) - 1
 
 
 
@@ -43,6 +43,7 @@ class Ui_other_viz_dialog(object):
         self.pos_iso_color_lineEdit.setObjectName("pos_iso_color_lineEdit")
         self.gridLayout.addWidget(self.pos_iso_color_lineEdit, 2, 1, 1, 1, QtCore.Qt.AlignVCenter)
         self.pos_iso_doubleSpinBox = QtWidgets.QDoubleSpinBox(self.groupBox_2)
+        self.pos_iso_doubleSpinBox.setMaximum(9999.99)
         self.pos_iso_doubleSpinBox.setObjectName("pos_iso_doubleSpinBox")
         self.gridLayout.addWidget(self.pos_iso_doubleSpinBox, 1, 1, 1, 1)
         self.gridLayout_5.addLayout(self.gridLayout, 0, 0, 1, 1)
@@ -68,6 +69,8 @@ class Ui_other_viz_dialog(object):
         self.neg_iso_checkBox.setObjectName("neg_iso_checkBox")
         self.gridLayout_2.addWidget(self.neg_iso_checkBox, 0, 0, 1, 2)
         self.neg_iso_doubleSpinBox = QtWidgets.QDoubleSpinBox(self.groupBox_3)
+        self.neg_iso_doubleSpinBox.setMinimum(-9999.99)
+        self.neg_iso_doubleSpinBox.setMaximum(0.0)
         self.neg_iso_doubleSpinBox.setObjectName("neg_iso_doubleSpinBox")
         self.gridLayout_2.addWidget(self.neg_iso_doubleSpinBox, 1, 1, 1, 1)
         self.gridLayout_4.addLayout(self.gridLayout_2, 0, 0, 1, 1)
@@ -87,8 +90,34 @@ class Ui_other_viz_dialog(object):
         self.fieldlines_checkBox = QtWidgets.QCheckBox(self.groupBox)
         self.fieldlines_checkBox.setObjectName("fieldlines_checkBox")
         self.gridLayout_3.addWidget(self.fieldlines_checkBox, 0, 0, 1, 2)
+        self.label_8 = QtWidgets.QLabel(self.groupBox)
+        self.label_8.setObjectName("label_8")
+        self.gridLayout_3.addWidget(self.label_8, 2, 0, 1, 1, QtCore.Qt.AlignRight|QtCore.Qt.AlignVCenter)
+        self.max_fieldlines_spinBox = QtWidgets.QSpinBox(self.groupBox)
+        self.max_fieldlines_spinBox.setMinimum(1)
+        self.max_fieldlines_spinBox.setMaximum(100000)
+        self.max_fieldlines_spinBox.setSingleStep(100)
+        self.max_fieldlines_spinBox.setObjectName("max_fieldlines_spinBox")
+        self.gridLayout_3.addWidget(self.max_fieldlines_spinBox, 2, 1, 1, 1)
         self.gridLayout_6.addLayout(self.gridLayout_3, 0, 0, 1, 1)
         self.verticalLayout.addWidget(self.groupBox)
+        self.groupBox_4 = QtWidgets.QGroupBox(other_viz_dialog)
+        self.groupBox_4.setObjectName("groupBox_4")
+        self.gridLayout_8 = QtWidgets.QGridLayout(self.groupBox_4)
+        self.gridLayout_8.setObjectName("gridLayout_8")
+        self.gridLayout_7 = QtWidgets.QGridLayout()
+        self.gridLayout_7.setObjectName("gridLayout_7")
+        self.label_7 = QtWidgets.QLabel(self.groupBox_4)
+        self.label_7.setTextFormat(QtCore.Qt.PlainText)
+        self.label_7.setObjectName("label_7")
+        self.gridLayout_7.addWidget(self.label_7, 0, 0, 1, 1, QtCore.Qt.AlignRight|QtCore.Qt.AlignVCenter)
+        self.map_memory_spinBox = QtWidgets.QSpinBox(self.groupBox_4)
+        self.map_memory_spinBox.setMaximum(999999)
+        self.map_memory_spinBox.setSingleStep(500)
+        self.map_memory_spinBox.setObjectName("map_memory_spinBox")
+        self.gridLayout_7.addWidget(self.map_memory_spinBox, 0, 1, 1, 1)
+        self.gridLayout_8.addLayout(self.gridLayout_7, 0, 0, 1, 1)
+        self.verticalLayout.addWidget(self.groupBox_4)
         self.dialog_buttons = QtWidgets.QDialogButtonBox(other_viz_dialog)
         self.dialog_buttons.setStandardButtons(QtWidgets.QDialogButtonBox.Cancel|QtWidgets.QDialogButtonBox.Ok)
         self.dialog_buttons.setObjectName("dialog_buttons")
@@ -99,6 +128,8 @@ class Ui_other_viz_dialog(object):
         self.label_3.setBuddy(self.neg_iso_doubleSpinBox)
         self.label_4.setBuddy(self.neg_iso_color_lineEdit)
         self.label_6.setBuddy(self.fieldlines_ramp_lineEdit)
+        self.label_8.setBuddy(self.max_fieldlines_spinBox)
+        self.label_7.setBuddy(self.map_memory_spinBox)
 
         self.retranslateUi(other_viz_dialog)
         QtCore.QMetaObject.connectSlotsByName(other_viz_dialog)
@@ -118,3 +149,8 @@ class Ui_other_viz_dialog(object):
         self.groupBox.setTitle(_translate("other_viz_dialog", "Field lines"))
         self.label_6.setText(_translate("other_viz_dialog", "Ramp:"))
         self.fieldlines_checkBox.setText(_translate("other_viz_dialog", "Display"))
+        self.label_8.setText(_translate("other_viz_dialog", "Max. lines:"))
+        self.max_fieldlines_spinBox.setToolTip(_translate("other_viz_dialog", "Number of field lines seeded on the molecular surface."))
+        self.groupBox_4.setTitle(_translate("other_viz_dialog", "Loaded maps"))
+        self.label_7.setText(_translate("other_viz_dialog", "Memory (MB):"))
+        self.map_memory_spinBox.setToolTip(_translate("other_viz_dialog", "Least recently viewed maps are unloaded to the map cache, and reloaded when viewed again, to keep maps in the session within this size."))
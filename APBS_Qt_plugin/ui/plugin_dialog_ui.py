@@ -31,6 +31,11 @@ class Ui_plugin_dialog(object):
         self.run_button.setDefault(True)
         self.run_button.setObjectName("run_button")
         self.gridLayout.addWidget(self.run_button, 2, 1, 1, 1)
+        self.run_progressBar = QtWidgets.QProgressBar(plugin_dialog)
+        self.run_progressBar.setVisible(False)
+        self.run_progressBar.setProperty("value", 0)
+        self.run_progressBar.setObjectName("run_progressBar")
+        self.gridLayout.addWidget(self.run_progressBar, 3, 0, 1, 3)
         spacerItem = QtWidgets.QSpacerItem(40, 20, QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Minimum)
         self.gridLayout.addItem(spacerItem, 2, 0, 1, 1)
         self.label_2 = QtWidgets.QLabel(plugin_dialog)
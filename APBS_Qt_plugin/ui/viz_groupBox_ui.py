@@ -51,8 +51,13 @@ class Ui_viz_GroupBox(object):
         self.viz_map_comboBox.setObjectName("viz_map_comboBox")
         self.gridLayout_5.addWidget(self.viz_map_comboBox, 2, 1, 1, 2, QtCore.Qt.AlignVCenter)
         self.viz_range_doubleSpinBox = QtWidgets.QDoubleSpinBox(viz_GroupBox)
+        self.viz_range_doubleSpinBox.setMaximum(9999.99)
         self.viz_range_doubleSpinBox.setObjectName("viz_range_doubleSpinBox")
         self.gridLayout_5.addWidget(self.viz_range_doubleSpinBox, 3, 1, 1, 1, QtCore.Qt.AlignVCenter)
+        self.auto_levels_checkBox = QtWidgets.QCheckBox(viz_GroupBox)
+        self.auto_levels_checkBox.setChecked(True)
+        self.auto_levels_checkBox.setObjectName("auto_levels_checkBox")
+        self.gridLayout_5.addWidget(self.auto_levels_checkBox, 3, 2, 1, 1, QtCore.Qt.AlignVCenter)
         self.label_2 = QtWidgets.QLabel(viz_GroupBox)
         self.label_2.setTextFormat(QtCore.Qt.PlainText)
         self.label_2.setObjectName("label_2")
@@ -83,6 +88,8 @@ class Ui_viz_GroupBox(object):
         self.label_10.setText(_translate("viz_GroupBox", "Projects the electrostatic potential onto the molecular surface"))
         self.viz_surface_checkBox.setText(_translate("viz_GroupBox", "Molecular Surface Visualization"))
         self.label_9.setText(_translate("viz_GroupBox", "Range: +/-"))
+        self.auto_levels_checkBox.setToolTip(_translate("viz_GroupBox", "Set the range and isosurface levels from the values of each map loaded. Turned off when a level is edited."))
+        self.auto_levels_checkBox.setText(_translate("viz_GroupBox", "Auto"))
         self.other_viz_options_button.setText(_translate("viz_GroupBox", "Options..."))
         self.label_2.setText(_translate("viz_GroupBox", "Map:"))
         self.label_8.setText(_translate("viz_GroupBox", "Output Ramp:"))
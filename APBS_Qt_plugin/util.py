@@ -3,15 +3,20 @@ Utility classes and functions.
 """
 import attrs
 import collections
+import collections.abc
+import contextlib
 import enum
 import functools
 import logging
 import pathlib
-import typing
+import threading
 
 _log = logging.getLogger(__name__)
 
 from pymol.Qt import (QtCore, QtWidgets)
+# defined Qt-free for use by core; re-exported here
+from .core.util import (labeled_enum_factory, PluginException, NoPDBException,
+    CancelledException, PluginDialogException)
 
 # ------------------------------------------------------------------------------
 # Qt convenience classes
@@ -23,6 +28,63 @@ PYQT_SIGNAL = QtCore.pyqtSignal
 PYQT_SLOT = QtCore.pyqtSlot
 PYQT_QOBJECT = QtCore.QObject
 
+def in_main_thread():
+    """True if called from the thread running the Qt event loop (or if there's
+    no QApplication, in which case there's nothing to marshal to.)
+    """
+    app = QtCore.QCoreApplication.instance()
+    return app is None or QtCore.QThread.currentThread() == app.thread()
+
+class _MainThreadInvoker(PYQT_QOBJECT):
+    """Helper object living on the main thread; emitting `invoke` from any other
+    thread blocks that thread until the callable has been run by the main event
+    loop.
+    """
+    invoke = PYQT_SIGNAL(object)
+
+    def __init__(self):
+        super(_MainThreadInvoker, self).__init__()
+        self.moveToThread(QtCore.QCoreApplication.instance().thread())
+        self.invoke.connect(self.on_invoke, QtCore.Qt.BlockingQueuedConnection)
+
+    @PYQT_SLOT(object)
+    def on_invoke(self, call):
+        call()
+
+_MAIN_THREAD_INVOKER = None
+
+def run_in_main_thread(func, *args, **kwargs):
+    """Call `func` on the main thread and return its result, re-raising any
+    exception in the calling thread. Direct call if we're already on the main
+    thread.
+    """
+    global _MAIN_THREAD_INVOKER
+    if in_main_thread():
+        return func(*args, **kwargs)
+
+    if _MAIN_THREAD_INVOKER is None:
+        _MAIN_THREAD_INVOKER = _MainThreadInvoker()
+    result = dict()
+    def _call():
+        try:
+            result['value'] = func(*args, **kwargs)
+        except BaseException as exc:
+            result['exc'] = exc
+    _MAIN_THREAD_INVOKER.invoke.emit(_call)
+    if 'exc' in result:
+        raise result['exc']
+    return result.get('value', None)
+
+def show_error_dialog(msg, details="", parent=None):
+    """Modal error message box, as used for uncaught PluginDialogExceptions."""
+    QMB = QtWidgets.QMessageBox
+    if parent is None:
+        parent = QtWidgets.QApplication.focusWidget()
+    msgbox = QMB(QMB.Critical, 'Error', msg or 'unknown error', QMB.Close, parent)
+    if details:
+        msgbox.setDetailedText(details)
+    msgbox.exec_()
+
 # ------------------------------------------------------------------------------
 # Auto-generate Properties and Signals for fields on model classes
 # PyQt docs state that Signals can't be defined dynamically; this isn't true
@@ -30,7 +92,7 @@ PYQT_QOBJECT = QtCore.QObject
 
 class PropertyNames(collections.namedtuple(
     'PropertyNames',
-    ('name', 'signal_name', 'slot_name')
+    ('name', 'signal_name', 'slot_name', 'change_signal_name')
 )):
     """Use rigid naming conventions, defined in one place, for the naming of
     auto-generated Signals, Slots and other attributes.
@@ -45,13 +107,108 @@ class PropertyNames(collections.namedtuple(
         return cls(
             name = name,
             signal_name = name + '_update',
-            slot_name = 'on_' + name + '_update'
+            slot_name = 'on_' + name + '_update',
+            change_signal_name = name + '_changed'
         )
 
+class ListChange(collections.namedtuple(
+    'ListChange',
+    ('start', 'n_removed', 'n_inserted')
+)):
+    """Change to a list-valued field, emitted on its *_changed Signal: items
+    [start, start + n_removed) of the old list were replaced by items
+    [start, start + n_inserted) of the new list. `n_removed` is None if the
+    whole list was replaced.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def reset(cls, new_len):
+        return cls(0, None, new_len)
+
+    def then(self, other):
+        """Single change equivalent to (at least covering) this change followed
+        by `other`.
+        """
+        if other.n_removed is None:
+            return other
+        start = min(self.start, other.start)
+        # end of the affected range in the intermediate list, mapped back to
+        # the old list and forward to the new one
+        end = max(self.start + self.n_inserted, other.start + other.n_removed)
+        if self.n_removed is None:
+            n_removed = None
+        else:
+            n_removed = end + (self.n_removed - self.n_inserted) - start
+        return ListChange(start, n_removed, end + (other.n_inserted - other.n_removed) - start)
+
+class DictChange(collections.namedtuple('DictChange', ('keys',))):
+    """Change to a dict-valued field, emitted on its *_changed Signal: `keys`
+    were set or deleted (membership in the new dict tells which.) `keys` is None
+    if the whole dict was replaced.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def reset(cls):
+        return cls(None)
+
+    def then(self, other):
+        if self.keys is None or other.keys is None:
+            return DictChange(None)
+        return DictChange(tuple(dict.fromkeys(self.keys + other.keys)))
+
+def _normalize_index(i, n):
+    # index as list.insert/pop would interpret it, for a list of length n
+    i = int(i)
+    return max(i + n, 0) if i < 0 else min(i, n)
+
+def _describe_list_change(method_name, args, n_before, n_after, pre):
+    # ListChange for a call of a mutating list method
+    if method_name in ('append', 'extend', '__iadd__'):
+        return ListChange(n_before, 0, n_after - n_before)
+    if method_name == 'insert':
+        return ListChange(_normalize_index(args[0], n_before), 0, 1)
+    if method_name == 'pop':
+        return ListChange(_normalize_index(args[0] if args else -1, n_before), 1, 0)
+    if method_name == 'remove':
+        return ListChange(pre, 1, 0)
+    if method_name in ('__delitem__', '__setitem__'):
+        key = args[0]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(n_before)
+            if step == 1:
+                n_removed = max(stop - start, 0)
+                return ListChange(start, n_removed, n_after - n_before + n_removed)
+        else:
+            i = _normalize_index(key, n_before)
+            return ListChange(i, 1, 0 if method_name == '__delitem__' else 1)
+    # __imul__, reverse, sort, extended slices
+    return ListChange(0, n_before, n_after)
+
+def _describe_dict_change(method_name, args, kwargs, result, pre):
+    # DictChange for a call of a mutating dict method, or None if nothing changed
+    if method_name in ('__setitem__', '__delitem__'):
+        return DictChange((args[0], ))
+    if method_name == 'pop':
+        return DictChange((args[0], )) if pre else None
+    if method_name == 'setdefault':
+        return None if pre else DictChange((args[0], ))
+    if method_name == 'popitem':
+        return DictChange((result[0], ))
+    if method_name in ('update', '__ior__'):
+        if args and not isinstance(args[0], collections.abc.Mapping):
+            return DictChange(None) # iterable of pairs, already consumed
+        keys = tuple(args[0].keys()) if args else ()
+        return DictChange(keys + tuple(kwargs.keys()))
+    # clear
+    return DictChange(None)
+
 class MakeNotified:
     """From https://stackoverflow.com/a/66266877.
     Defines logic for triggering Signals on mutating operations on `list`- and
-    `dict`-valued fields.
+    `dict`-valued fields. The wrapped container calls its `notify` callable
+    after each mutation, with a ListChange or DictChange describing it.
     """
     change_methods = {
         list: ['__delitem__', '__iadd__', '__imul__', '__setitem__', 'append',
@@ -67,11 +224,11 @@ class MakeNotified:
         self.notified_class = {type_: self.make_notified_class(type_)
                                for type_ in [list, dict]}
 
-    def __call__(self, seq, signal):
+    def __call__(self, seq, notify):
         """Returns a notifying version of the supplied list or dict."""
         notified_class = self.notified_class[type(seq)]
         notified_seq = notified_class(seq)
-        notified_seq.signal = signal
+        notified_seq.notify = notify
         return notified_seq
 
     @classmethod
@@ -85,55 +242,131 @@ class MakeNotified:
 
     @staticmethod
     def make_notified_method(method, parent):
+        method_name = method.__name__
+        parent_method = getattr(parent, method_name)
         @functools.wraps(method)
         def notified_method(self, *args, **kwargs):
-            result = getattr(parent, method.__name__)(self, *args, **kwargs)
-            self.signal.emit(self)
+            # state needed to describe the change that isn't available after it
+            pre = None
+            if method_name == 'remove':
+                pre = parent.index(self, *args) if args[0] in self else None
+            elif method_name in ('pop', 'setdefault') and parent is dict:
+                pre = args[0] in self
+            n_before = len(self)
+            result = parent_method(self, *args, **kwargs)
+            if parent is list:
+                change = _describe_list_change(method_name, args, n_before, len(self), pre)
+            else:
+                change = _describe_dict_change(method_name, args, kwargs, result, pre)
+            if change is not None:
+                self.notify(change=change)
             return result
         return notified_method
 
 _MAKE_NOTIFIED = MakeNotified()
 
-def attr_setter_emit(obj, attr_obj, value):
-    """Emit corresponding Signal when field (attrs Attribute) is set to a new
-    value.
+class FieldSignalInfo(collections.namedtuple(
+    'FieldSignalInfo',
+    ('names', 'coerce')
+)):
+    """Everything needed to emit a field's Signals, resolved once per field
+    when the Model class is created: its PropertyNames, and the callable that
+    coerces values to the Signal's argument type (None if that can only be
+    determined from the Signal itself.)
     """
-    p = PropertyNames.from_name(attr_obj.name)
-    signal = getattr(obj, p.signal_name)
-    if type(value) in (list, dict):
-        value = _MAKE_NOTIFIED(value, signal)
-        signal.emit(value)
-    else:
-        # coerce from field's type
-        # TODO: case when Signal is a tupe of values?
-        old_val = getattr(obj, attr_obj.name)
+    __slots__ = ()
+
+    @classmethod
+    def from_field(cls, f):
+        signal_type = _coerce_type_to_signal(f.type)
+        return cls(
+            names = PropertyNames.from_name(f.name),
+            coerce = _SIGNAL_TYPE_COERCIONS.get(signal_type, None)
+        )
+
+def make_setter_emit(f):
+    """Return the on_setattr hook for field (attrs Attribute) `f`: emits the
+    field's Signal when it's set to a new value. Field names and Signal types
+    are resolved here, rather than on each assignment.
+    """
+    name = f.name
+    info = FieldSignalInfo.from_field(f)
+
+    def setter_emit(obj, attr_obj, value):
+        if type(value) in (list, dict):
+            value = _MAKE_NOTIFIED(value, functools.partial(obj.emit_update, name))
+            if isinstance(value, list):
+                change = ListChange.reset(len(value))
+            else:
+                change = DictChange.reset()
+            obj.emit_update(name, value, change=change)
+            return value
+        old_val = getattr(obj, name)
         if old_val != value:
-            obj.wrapped_emit(p.name, value)
-    return value
+            obj._dirty.add(name)
+            if obj._batch_depth > 0 or _coalescing():
+                obj.emit_update(name, value, old_val)
+            else:
+                # TODO: case when Signal is a tupe of values?
+                obj._emit_field_signal(info, value)
+        return value
+    return setter_emit
+
+# Deferral of *_update Signals: see BaseModel.batch_update() and coalesce_updates()
+
+_NO_VALUE = object() # sentinel: no previous value to compare against
+_COALESCE = threading.local() # app-wide batch state, per thread
+
+def _coalescing():
+    return getattr(_COALESCE, 'depth', 0) > 0
+
+@contextlib.contextmanager
+def coalesce_updates():
+    """App-wide version of `BaseModel.batch_update()`: defer *_update Signals of
+    every model changed by this thread until the outermost block exits, then
+    emit each changed field once, with its final value.
+    """
+    depth = getattr(_COALESCE, 'depth', 0)
+    if depth == 0:
+        _COALESCE.models = dict() # id -> model, in order of first change
+    _COALESCE.depth = depth + 1
+    try:
+        yield
+    finally:
+        _COALESCE.depth = depth
+        if depth == 0:
+            models, _COALESCE.models = _COALESCE.models, None
+            for model in models.values():
+                model.flush_updates()
+
+def _has_signal(f):
+    # fields that are a composition of other Models don't get Signals
+    return not (attrs.has(f.type) or issubclass(f.type, PYQT_QOBJECT))
 
 def _attr_field_transformer(cls, fields):
-    """Insert `attr_setter_emit` into list of methods called when field (attrs
-    Attribute) is set to a new value.
+    """Insert a `make_setter_emit` hook into list of methods called when field
+    (attrs Attribute) is set to a new value. Converter/validator steps are only
+    included for fields that have them, so that for most fields the hook is
+    called directly.
     """
     new_fields = []
     for f in fields:
-        if attrs.has(f.type) or issubclass(f.type, PYQT_QOBJECT):
-            new_fields.append(f) # no-op for fields that are a composition of other Models
+        if not _has_signal(f):
+            new_fields.append(f)
             continue
 
+        setters = []
+        if f.converter is not None:
+            setters.append(attrs.setters.convert)
+        if f.validator is not None:
+            setters.append(attrs.setters.validate)
         if f.on_setattr:
-            new_setattr = attrs.setters.pipe(
-                attrs.setters.convert,
-                attrs.setters.validate,
-                f.on_setattr,
-                attr_setter_emit
-            )
+            setters.append(f.on_setattr)
+        setters.append(make_setter_emit(f))
+        if len(setters) == 1:
+            new_setattr = setters[0]
         else:
-            new_setattr = attrs.setters.pipe(
-                attrs.setters.convert,
-                attrs.setters.validate,
-                attr_setter_emit
-            )
+            new_setattr = attrs.setters.pipe(*setters)
         new_fields.append(f.evolve(on_setattr=new_setattr))
     return new_fields
 
@@ -177,6 +410,12 @@ def _coerce_type_to_signal(t):
             new_t = v
     return new_t
 
+# python type to coerce values to, for the Signal argument types in use
+_SIGNAL_TYPE_COERCIONS = {
+    'QVariantList': list, 'QVariantMap': dict,
+    bool: bool, int: int, float: float, str: str
+}
+
 def _type_from_signal(signal):
     sigs = getattr(signal, "signatures", None)
     if sigs:
@@ -211,37 +450,163 @@ class AutoSignalSlotMetaclass(type(PYQT_QOBJECT)):
             # with slots=True, we get called twice. First call is before attrs
             # decorator so we need to pass through; make definitions on second call.
 
+            field_info = dict()
             for f in attrs_['__attrs_attrs__']:
-                if attrs.has(f.type) or issubclass(f.type, PYQT_QOBJECT):
+                if not _has_signal(f):
                     # don't define new signals/slots for nested Model objects
                     continue
 
                 signal_type = _coerce_type_to_signal(f.type)
-                p = PropertyNames.from_name(f.name)
+                field_info[f.name] = FieldSignalInfo.from_field(f)
+                p = field_info[f.name].names
                 if p.signal_name not in attrs_:
                     # auto-generate signal
                     attrs_[p.signal_name] = PYQT_SIGNAL(signal_type, name=p.signal_name)
+                if issubclass(f.type, (list, dict)) and p.change_signal_name not in attrs_:
+                    # containers also get a signal describing each change
+                    attrs_[p.change_signal_name] = PYQT_SIGNAL(
+                        object, name=p.change_signal_name
+                    )
 
                 if p.slot_name not in attrs_:
                     # auto-generate slot. Each slot has to be a unique callable with specific
                     # signature, so we can't use stuff on PropertyWrapper and instead
-                    # need to define new, separate setter methods as synonyms.
-                    @PYQT_SLOT(signal_type)
-                    def _dummy_slot(self, value):
-                        setattr(self, p.name, value)
+                    # need to define new, separate setter methods as synonyms, named
+                    # after the slot since PyQt resolves decorated slots by name.
+                    @PYQT_SLOT(signal_type, name=p.slot_name)
+                    def _dummy_slot(self, value, _name=p.name):
+                        setattr(self, _name, value)
                     attrs_[p.slot_name] = _dummy_slot
+            # looked up on emit, instead of re-deriving names and types
+            attrs_['_field_info'] = field_info
 
         return super(AutoSignalSlotMetaclass, cls).__new__(cls, name, bases, attrs_)
 
 class BaseModel(PYQT_QOBJECT, metaclass = AutoSignalSlotMetaclass):
     """Base class for our Model classes.
     """
+    _field_info = dict() # set by metaclass on each attrs subclass
+
     def __attrs_pre_init__(self, *args, **kwargs):
         super().__init__() # required to call init on QObject
+        self._bound_signals = dict() # signal name -> bound signal
+        # fields changed, or with views connected, since the last refresh()
+        self._dirty = set()
+        self._batch_depth = 0
+        # field name -> value before the first deferred change
+        self._pending_updates = dict()
+        # field name -> combined ListChange or DictChange of deferred changes
+        self._pending_changes = dict()
+
+    def __attrs_post_init__(self):
+        # initial values haven't been sent to any view yet
+        self._dirty.update(self._field_info)
+        # values set by __init__ don't go through the setters; wrap
+        # containers so that in-place changes are notified
+        for f in attrs.fields(type(self)):
+            value = getattr(self, f.name)
+            if type(value) in (list, dict):
+                object.__setattr__(self, f.name, _MAKE_NOTIFIED(
+                    value, functools.partial(self.emit_update, f.name)
+                ))
+
+    def emit_update(self, name, value=_NO_VALUE, old_value=_NO_VALUE, change=None):
+        """Emit the Signal for field `name` being set to `value` (default: its
+        current value), or if a batch is open, defer it until the batch closes.
+        For list- and dict-valued fields, `change` describes the mutation.
+        """
+        self._dirty.add(name)
+        if self._batch_depth > 0 or _coalescing():
+            if name not in self._pending_updates:
+                self._pending_updates[name] = old_value
+            if change is not None:
+                prev = self._pending_changes.get(name, None)
+                self._pending_changes[name] = change if prev is None else prev.then(change)
+            if self._batch_depth == 0:
+                _COALESCE.models.setdefault(id(self), self)
+            return
+        if value is _NO_VALUE:
+            value = getattr(self, name)
+        self._emit_now(name, value, change)
+
+    def _signal(self, signal_name):
+        # bound signal, cached per instance
+        try:
+            return self._bound_signals[signal_name]
+        except KeyError:
+            signal = getattr(self, signal_name, None)
+            self._bound_signals[signal_name] = signal
+            return signal
+
+    def _field_names(self, name):
+        info = self._field_info.get(name, None)
+        return info.names if info is not None else PropertyNames.from_name(name)
+
+    def _emit_field_signal(self, info, value):
+        signal = self._signal(info.names.signal_name)
+        if signal is None:
+            return
+        if info.coerce is not None:
+            signal.emit(info.coerce(value))
+        else:
+            signal.emit(_type_from_signal(signal)(value))
+
+    def _emit_now(self, name, value, change):
+        if change is not None:
+            p = self._field_names(name)
+            change_signal = self._signal(p.change_signal_name)
+            if change_signal is not None:
+                change_signal.emit(change)
+                # skip converting the whole container if nobody needs it
+                if not self._has_receivers(p.signal_name):
+                    return
+        self.wrapped_emit(name, value)
+
+    def _has_receivers(self, signal_name):
+        try:
+            return self.receivers(self._signal(signal_name)) > 0
+        except Exception:
+            # receivers() not supported for this binding; assume connected
+            return True
+
+    def flush_updates(self):
+        """Emit deferred Signals: once per changed field, with its current value.
+        Fields that were changed and then set back to their original value
+        aren't emitted.
+        """
+        pending, self._pending_updates = self._pending_updates, dict()
+        changes, self._pending_changes = self._pending_changes, dict()
+        for name, old_value in pending.items():
+            value = getattr(self, name)
+            if old_value is _NO_VALUE or old_value != value:
+                self._emit_now(name, value, changes.get(name, None))
+
+    @contextlib.contextmanager
+    def batch_update(self):
+        """Context manager deferring this model's *_update Signals until the
+        block exits; then each changed field is emitted once, with its final
+        value. Blocks may be nested, and should be opened on the thread that
+        makes the changes.
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                if _coalescing():
+                    # app-wide batch still open; flush with the other models
+                    _COALESCE.models.setdefault(id(self), self)
+                else:
+                    self.flush_updates()
 
     def wrapped_emit(self, name, value):
+        info = self._field_info.get(name, None)
+        if info is not None and not hasattr(value, "coerce_to_signal"):
+            self._emit_field_signal(info, value)
+            return
         p = PropertyNames.from_name(name)
-        signal = getattr(self, p.signal_name, None)
+        signal = self._signal(p.signal_name)
         # assume that pyqtSignal auto-coerces argument
         if signal:
             if hasattr(value, "coerce_to_signal"):
@@ -250,19 +615,44 @@ class BaseModel(PYQT_QOBJECT, metaclass = AutoSignalSlotMetaclass):
                 val = _type_from_signal(signal)(value)
             signal.emit(val)
 
-    def refresh(self):
+    def mark_dirty(self, *names):
+        """Flag fields to be re-sent by the next refresh(), e.g. because a new
+        view was connected to them.
+        """
+        self._dirty.update(names)
+
+    def refresh(self, force=False):
         """Hacky but necessary way to sync up associated Views with the Model. Model
         needs to be instantiated before it's connect()ed to views, but this means
         views don't know about inital values of model fields. To fix this, provide
-        a method to manually fire all *_update signals for all model fields.
+        a method to manually fire *_update signals for model fields.
+
+        Only fields that changed or had a view connected (via connect_signal())
+        since the last refresh are sent, so that controllers sharing a Model
+        don't replay each other's slots. `force` sends every field, for views
+        connected by other means.
         """
-        for f in attrs.fields(type(self)):
-            self.wrapped_emit(f.name, getattr(self, f.name))
+        if force:
+            names = list(self._field_info)
+        else:
+            names = [name for name in self._field_info if name in self._dirty]
+        self._dirty.clear()
+        for name in names:
+            value = getattr(self, name)
+            if isinstance(value, list):
+                self._emit_now(name, value, ListChange.reset(len(value)))
+            elif isinstance(value, dict):
+                self._emit_now(name, value, DictChange.reset())
+            else:
+                self.wrapped_emit(name, value)
 
 
 def connect_signal(obj_w_signal, prop_name, slot):
     p = PropertyNames.from_name(prop_name)
     getattr(obj_w_signal, p.signal_name).connect(slot)
+    if isinstance(obj_w_signal, BaseModel):
+        # new view hasn't seen the current value; send it on next refresh()
+        obj_w_signal.mark_dirty(prop_name)
 
 def connect_slot(signal, obj_w_slot, prop_name):
     p = PropertyNames.from_name(prop_name)
@@ -292,6 +682,28 @@ class BaseController(PYQT_QOBJECT):
     """
     pass
 
+class DialogController(BaseController):
+    """Base class for Controllers of option dialogs. The dialog's View is only
+    constructed (running its setupUi) and connected to the Model when it's
+    first opened; subclasses do this in `init_view()`.
+    """
+    def __init__(self):
+        super(DialogController, self).__init__()
+        self._view = None
+
+    @property
+    def view(self):
+        if self._view is None:
+            self._view = self.init_view()
+        return self._view
+
+    def init_view(self):
+        """Construct the dialog View, connect it to the Model and return it."""
+
+    @PYQT_SLOT()
+    def exec_(self):
+        self.view.exec_()
+
 @attrs_define
 class _MultiModelIndex(BaseModel):
     """Index for MultiModel class, wrapped to emit Signals on changed."""
@@ -305,8 +717,8 @@ class MultiModel():
         self.multimodel = _MultiModelIndex(index=index)
         self.models = models
 
-    def refresh(self):
-        self.multimodel.refresh()
+    def refresh(self, force=False):
+        self.multimodel.refresh(force=force)
 
     def __getattr__(self, name):
         """Pass through all attribute access to the currently selected Model.
@@ -327,53 +739,3 @@ class MultiModel():
                 raise AttributeError(name)
         else:
             object.__setattr__(self, name, value)
-
-# ------------------------------------------------------------------------------
-
-def labeled_enum_factory(cls_name, cls_values):
-    # coerce cls_values to a dict of enum names : comboBox labels
-    if isinstance(cls_values, str):
-        cls_values = cls_values.split()
-    if isinstance(cls_values, typing.Sequence):
-        cls_values = {v:v for v in cls_values}
-
-    # start=0 to support cast from int -- comboBox index starts at 0
-    cls_ = enum.Enum(cls_name, tuple(cls_values.keys()), start=0)
-    # add methods
-    def _str(self):
-        return self.name
-    cls_.__str__ = _str
-    def _int(self):
-        return self.value
-    cls_.__int__ = _int
-
-    def _init_combobox(self, comboBox):
-        comboBox.clear()
-        for v in cls_values.values():
-            # unsure if this will actually mark strings as translatable, or needs
-            # to be in a QObject
-            comboBox.addItem(QtCore.QT_TR_NOOP(v))
-        comboBox.setCurrentIndex(int(self))
-    cls_.init_combobox = _init_combobox
-
-    # signals/slots will be assigned when this is used as a field in a decorated Model
-    # Enum is not itself a QObject, and has no signals/slots of its own
-    return cls_
-
-# ------------------------------------------------------------------------------
-class PluginException(Exception):
-    """Base class for all exceptions raised by plugin's code.
-    """
-    pass
-
-class NoPsizeException(PluginException):
-    pass
-
-class NoPDBException(PluginException):
-    pass
-
-class PluginDialogException(PluginException):
-    """Base class for any exception which will be handled at the top level of
-    the plugin by creating a dialog box.
-    """
-    pass
@@ -5,13 +5,35 @@ calculated potential back in PyMol.
 import logging
 _log = logging.getLogger(__name__)
 
+import functools
+import time
+import numpy as np
+import pymol
+from pymol import cgo
 from . import pymol_api, util
-from pymol.Qt import QtWidgets
+from .core import dx, fieldlines
+from pymol.Qt import QtCore, QtWidgets
 from .ui.other_viz_dialog_ui import Ui_other_viz_dialog
 from .ui.views import VizGroupBoxView
 
 # ------------------------------------------------------------------------------
 
+# While an isosurface level is being changed (e.g. by dragging its spinbox),
+# redraw the surface from a half-resolution copy of the map at most this often,
+ISO_PREVIEW_INTERVAL_MS = 100
+# and redraw it from the full map once the level hasn't changed for this long.
+ISO_SETTLE_MS = 300
+
+def _redraw_transaction(method):
+    """Decorator running a VisualizationModel method in a single PyMol redraw
+    transaction (see PyMolModel.redraw_transaction().)
+    """
+    @functools.wraps(method)
+    def _wrapped(self, *args, **kwargs):
+        with self.pymol_cmd.redraw_transaction(method.__name__):
+            return method(self, *args, **kwargs)
+    return _wrapped
+
 @util.attrs_define
 class VisualizationModel(util.BaseModel):
     pymol_cmd: pymol_api.PyMolModel
@@ -32,31 +54,162 @@ class VisualizationModel(util.BaseModel):
     neg_surf_val: float = 0.0
     neg_surf_color: str = 'red'
     show_fieldlines: bool = False
+    max_fieldlines: int = 1000
+    # set mol_surf and isosurface levels from each map loaded; turned off
+    # when the user edits a level
+    auto_levels: bool = True
+
+    def __attrs_post_init__(self):
+        super().__attrs_post_init__()
+        self._preview_map_src = None # map the preview map was made from
+        self._preview_map = None
+        self._iso_updates = {
+            'pos': self.updatePosSurface, 'neg': self.updateNegSurface
+        }
+        self._iso_last_preview = {k: 0. for k in self._iso_updates}
+        self._iso_settle_timers = dict()
+        for k in self._iso_updates:
+            timer = QtCore.QTimer(self)
+            timer.setSingleShot(True)
+            timer.setInterval(ISO_SETTLE_MS)
+            timer.timeout.connect(functools.partial(self._on_iso_settled, k))
+            self._iso_settle_timers[k] = timer
+        self.pymol_cmd.map_changed.connect(self.on_map_changed)
+
+    @_redraw_transaction
+    def update(self):
+        """Redraw all enabled visualizations, e.g. after a new map is loaded.
+        """
+        self._drop_preview_map()
+        if self.do_mol_viz:
+            self.updateMolSurface()
+        if self.show_pos_iso:
+            self.updatePosSurface()
+        if self.show_neg_iso:
+            self.updateNegSurface()
+        if self.show_fieldlines:
+            self.updateFieldLines()
 
+    def set_default_levels(self, stats=None):
+        """Set the surface color ramp range and isosurface levels from
+        percentiles of the map's values (see core/mapstats.py.) `stats` are
+        those of the current map, if already known, e.g. from reading its DX
+        file; otherwise they're computed from the map's data.
+        """
+        if stats is None:
+            stats = self.pymol_cmd.get_map(self.map_name).get_stats()
+        mol_surf, pos_surf_val, neg_surf_val = stats.default_levels()
+        with self.batch_update():
+            self.mol_surf = round(mol_surf, 2)
+            self.pos_surf_val = round(pos_surf_val, 2)
+            self.neg_surf_val = round(neg_surf_val, 2)
+        _log.debug(f"Levels for map '{self.map_name}': ramp +/-{self.mol_surf}, "
+            f"isosurfaces {self.neg_surf_val}, {self.pos_surf_val}")
+
+    def _set_level(self, name, value):
+        # a level typed in by the user isn't overwritten by the next map's
+        # default levels; views echoing the model's value back don't count
+        if value != getattr(self, name):
+            self.auto_levels = False
+        setattr(self, name, value)
+
+    @util.PYQT_SLOT(float)
+    def on_mol_surf_update(self, value):
+        self._set_level('mol_surf', value)
+
+    def show_map_expression(self, expression, map_name, sources=None):
+        """Load the result of map arithmetic `expression` (e.g. "A - B"; see
+        PyMolModel.load_map_expression()) as map `map_name` and make it the
+        current map.
+        """
+        stats = self.pymol_cmd.load_map_expression(expression, map_name, sources)
+        self.map_name = map_name
+        if self.auto_levels:
+            self.set_default_levels(stats)
+        self.update()
+
+    def _object_name(self, prefix, obj_type, name):
+        """Name for a visualization object derived from pymol object `name`,
+        distinguished by its stable index among objects of `obj_type`.
+        """
+        idx = self.pymol_cmd.object_name_index(obj_type, name)
+        return '_'.join((prefix, str(idx), str(self.vis_group)))
+
+    @property
+    def preview_map_name(self):
+        """Name of a half-resolution copy of the current map, used to draw
+        isosurfaces while their levels are changing. It's made on first use after
+        each call to update(); if pymol can't make it, the full map is used.
+        Only one preview is kept: it's deleted when it's remade from another
+        map, on update(), and when its map is replaced, unloaded or deleted.
+        """
+        if self._preview_map_src != self.map_name:
+            self._drop_preview_map()
+            self.pymol_cmd.ensure_map_loaded(self.map_name)
+            preview_name = self._object_name('_iso_preview', 'object:map', self.map_name)
+            try:
+                self.pymol_cmd.delete(preview_name)
+                self.pymol_cmd.copy(preview_name, self.map_name)
+                self.pymol_cmd.map_halve(preview_name)
+                self.pymol_cmd.disable(preview_name)
+            except (AttributeError, pymol.CmdException) as exc:
+                _log.warning(f"Couldn't make preview of map '{self.map_name}': {exc}")
+                self.pymol_cmd.delete(preview_name)
+                preview_name = self.map_name
+            self._preview_map_src = self.map_name
+            self._preview_map = preview_name
+        return self._preview_map
+
+    def _drop_preview_map(self):
+        if self._preview_map not in (None, self._preview_map_src):
+            self.pymol_cmd.delete(self._preview_map)
+        self._preview_map_src = self._preview_map = None
+
+    @util.PYQT_SLOT(str)
+    def on_map_changed(self, map_name):
+        if map_name == self._preview_map_src:
+            self._drop_preview_map()
+
+    def _on_iso_level_changed(self, k):
+        """Redraw isosurface `k` ('pos' or 'neg') for a new level: from the
+        preview map if it hasn't been drawn in the last ISO_PREVIEW_INTERVAL_MS,
+        and from the full map once the level has settled.
+        """
+        now = time.perf_counter()
+        if 1000. * (now - self._iso_last_preview[k]) >= ISO_PREVIEW_INTERVAL_MS:
+            self._iso_last_preview[k] = now
+            self._iso_updates[k](self.preview_map_name)
+        # (re)starting the timer drops the full-resolution redraw for the
+        # previous level, if it hadn't been done yet
+        self._iso_settle_timers[k].start()
+
+    def _on_iso_settled(self, k):
+        if (self.show_pos_iso if k == 'pos' else self.show_neg_iso):
+            self._iso_updates[k]()
 
     @property # allow to set manually?
     def ramp_name(self):
-        # return 'e_lvl'
-        # [i for i in self.pymol_cmd.get_names() if self.pymol_cmd.get_type(i) == 'object:molecule']
-        names = self.pymol_cmd.get_names_of_type('object:molecule')
-        idx = names.index(self.molecule)
-        return '_'.join(('e_lvl', str(idx), str(self.vis_group)))
+        return self._object_name('e_lvl', 'object:molecule', self.molecule)
 
     def updateRamp(self):
         ramp_name = self.ramp_name
         surf_range = [- self.mol_surf, 0.0, self.mol_surf]
-        _log.debug(" APBS Tools: range is", surf_range)
+        _log.debug(f"APBS Tools: range is {surf_range}")
         self.pymol_cmd.delete(ramp_name)
+        self.pymol_cmd.ensure_map_loaded(self.map_name)
         self.pymol_cmd.ramp_new(ramp_name, self.map_name, surf_range)
         self.pymol_cmd.set('surface_color', ramp_name, self.molecule)
 
     @util.PYQT_SLOT(bool)
+    @_redraw_transaction
     def on_do_mol_viz_update(self, b):
+        self.do_mol_viz = b
         if b:
             self.updateMolSurface()
         else:
             self.pymol_cmd.hide('surface', self.molecule)
 
+    @_redraw_transaction
     def updateMolSurface(self):
         molecule_name = self.molecule
         self.updateRamp()
@@ -67,20 +220,19 @@ class VisualizationModel(util.BaseModel):
             self.pymol_cmd.set('surface_solvent', 0, molecule_name)
             self.pymol_cmd.set('surface_ramp_above_mode', self.potential_at_sas, molecule_name)
         self.pymol_cmd.show('surface', molecule_name)
-        self.pymol_cmd.refresh()
         self.pymol_cmd.recolor(molecule_name)
 
 # ------------------------------------
 
     @property # allow to set manually?
     def positive_iso_name(self):
-        # [i for i in self.pymol_cmd.get_names() if self.pymol_cmd.get_type(i) == 'object:map']
-        names = self.pymol_cmd.get_names_of_type('object:map')
-        idx = names.index(self.map_name)
-        return '_'.join(('iso_pos', str(idx), str(self.vis_group)))
+        return self._object_name('iso_pos', 'object:map', self.map_name)
 
     @util.PYQT_SLOT(bool)
+    @_redraw_transaction
     def on_show_pos_iso_update(self, b):
+        self.show_pos_iso = b
+        self._iso_settle_timers['pos'].stop()
         if b:
             self.do_other_viz = True
             self.updatePosSurface()
@@ -89,10 +241,22 @@ class VisualizationModel(util.BaseModel):
             if not self.show_neg_iso and not self.show_fieldlines:
                 self.do_other_viz = False
 
-    def updatePosSurface(self):
-        surf_name = self.positive_iso_name()
+    @util.PYQT_SLOT(float)
+    def on_pos_surf_val_update(self, value):
+        self._set_level('pos_surf_val', value)
+        if self.show_pos_iso:
+            self._on_iso_level_changed('pos')
+
+    @_redraw_transaction
+    def updatePosSurface(self, map_name=None):
+        """Draw the positive isosurface of
+        `map_name` (default: the current map.)
+        """
+        surf_name = self.positive_iso_name
         self.pymol_cmd.delete(surf_name)
-        self.pymol_cmd.isosurface(surf_name, self.map_name, self.pos_surf_val)
+        self.pymol_cmd.ensure_map_loaded(self.map_name)
+        self.pymol_cmd.isosurface(surf_name, map_name or self.map_name,
+            self.pos_surf_val)
         self.pymol_cmd.color(self.pos_surf_color, surf_name)
         self.pymol_cmd.show('everything', surf_name)
 
@@ -101,13 +265,13 @@ class VisualizationModel(util.BaseModel):
 
     @property # allow to set manually?
     def negative_iso_name(self):
-        # [i for i in self.pymol_cmd.get_names() if self.pymol_cmd.get_type(i) == 'object:map']
-        names = self.pymol_cmd.get_names_of_type('object:map')
-        idx = names.index(self.map_name)
-        return '_'.join(('iso_neg', str(idx), str(self.vis_group)))
+        return self._object_name('iso_neg', 'object:map', self.map_name)
 
     @util.PYQT_SLOT(bool)
+    @_redraw_transaction
     def on_show_neg_iso_update(self, b):
+        self.show_neg_iso = b
+        self._iso_settle_timers['neg'].stop()
         if b:
             self.do_other_viz = True
             self.updateNegSurface()
@@ -116,10 +280,22 @@ class VisualizationModel(util.BaseModel):
             if not self.show_pos_iso and not self.show_fieldlines:
                 self.do_other_viz = False
 
-    def updateNegSurface(self):
-        surf_name = self.neg_iso_name
+    @util.PYQT_SLOT(float)
+    def on_neg_surf_val_update(self, value):
+        self._set_level('neg_surf_val', value)
+        if self.show_neg_iso:
+            self._on_iso_level_changed('neg')
+
+    @_redraw_transaction
+    def updateNegSurface(self, map_name=None):
+        """Draw the negative isosurface of
+        `map_name` (default: the current map.)
+        """
+        surf_name = self.negative_iso_name
         self.pymol_cmd.delete(surf_name)
-        self.pymol_cmd.isosurface(surf_name, self.map.getvalue(), self.neg_surf_val)
+        self.pymol_cmd.ensure_map_loaded(self.map_name)
+        self.pymol_cmd.isosurface(surf_name, map_name or self.map_name,
+            self.neg_surf_val)
         self.pymol_cmd.color(self.neg_surf_color, surf_name)
         self.pymol_cmd.show('everything', surf_name)
 
@@ -128,13 +304,12 @@ class VisualizationModel(util.BaseModel):
 
     @property # allow to set manually?
     def grad_name(self):
-        # [i for i in self.pymol_cmd.get_names() if self.pymol_cmd.get_type(i) == 'object:molecule']
-        names = self.pymol_cmd.get_names_of_type('object:molecule')
-        idx = names.index(self.molecule)
-        return '_'.join(('grad', str(idx), str(self.vis_group)))
+        return self._object_name('grad', 'object:molecule', self.molecule)
 
     @util.PYQT_SLOT(bool)
+    @_redraw_transaction
     def on_show_fieldlines_update(self, b):
+        self.show_fieldlines = b
         if b:
             self.do_other_viz = True
             self.updateFieldLines()
@@ -143,16 +318,99 @@ class VisualizationModel(util.BaseModel):
             if not self.show_pos_iso and not self.show_neg_iso:
                 self.do_other_viz = False
 
+    @_redraw_transaction
     def updateFieldLines(self):
+        """Draw field lines of the current map as a CGO object, seeded on the
+        solvent-accessible surface of the molecule and colored by potential on
+        the same scale as the molecular surface.
+        """
+        t_start = time.perf_counter()
         grad_name = self.grad_name
-        _log.debug("updateFieldLines: IN update")
-        self.pymol_cmd.gradient(grad_name, self.map_name)
-        _log.debug("updateFieldLines: Made gradient")
-        self.updateRamp()
-        _log.debug("updateFieldLines: Updated ramp")
-        self.pymol_cmd.color(self.ramp_name, grad_name)
-        _log.debug("updateFieldLines: set colors")
-        self.pymol_cmd.show('mesh', grad_name)
+        self.pymol_cmd.ensure_map_loaded(self.map_name)
+        dx_map = self.pymol_cmd.get_map(self.map_name)
+        coords, radii = self.pymol_cmd.get_coords_and_radii(self.molecule)
+        seeds = fieldlines.surface_seeds(coords, radii, self.max_fieldlines)
+        lines = fieldlines.trace_field_lines(dx_map, seeds)
+        self.pymol_cmd.delete(grad_name)
+        if not lines:
+            _log.warning(f"No field lines found for '{self.molecule}' in map "
+                f"'{self.map_name}'.")
+            return
+        self.pymol_cmd.load_cgo(self._field_lines_cgo(dx_map, lines), grad_name)
+        _log.debug(f"updateFieldLines: {len(lines)} lines in "
+            f"{1000. * (time.perf_counter() - t_start):.0f} ms")
+
+    def _field_lines_cgo(self, dx_map, lines):
+        # one LINE_STRIP per line, with a COLOR before each VERTEX
+        verts = np.concatenate(lines)
+        potential = dx.sample_points(dx_map, verts)
+        v_max = self.mol_surf or float(np.abs(potential).max())
+        colors = fieldlines.ramp_colors(potential, v_max)
+        body = np.empty((len(verts), 8), dtype=np.float64)
+        body[:, 0] = cgo.COLOR
+        body[:, 1:4] = colors
+        body[:, 4] = cgo.VERTEX
+        body[:, 5:8] = verts
+        line_cgo = []
+        start = 0
+        for line in lines:
+            stop = start + len(line)
+            line_cgo.extend((cgo.BEGIN, cgo.LINE_STRIP))
+            line_cgo.extend(body[start:stop].ravel().tolist())
+            line_cgo.append(cgo.END)
+            start = stop
+        return line_cgo
+
+# ------------------------------------
+
+    def sample_potential(self, points):
+        """Potential of the current map at `points` (N x 3 coordinates in
+        Angstroms, e.g. of atoms, solvent-accessible surface points or surface
+        vertices), trilinearly interpolated in a single vectorized call.
+        """
+        return dx.sample_points(self.pymol_cmd.get_map(self.map_name), points)
+
+    def atom_potentials(self, selection=None):
+        """Potential at each atom of `selection` (default: the molecule), in the
+        order of cmd.get_coords.
+        """
+        coords = self.pymol_cmd.get_coords(selection or self.molecule)
+        if coords is None:
+            return np.empty(0, dtype=np.float32)
+        return self.sample_potential(coords)
+
+    def store_atom_potentials(self, selection=None, prop='b'):
+        """Write the potential at each atom of `selection` (default: the
+        molecule) into its b-factor, or into `prop` as for
+        PyMolModel.alter_atoms() (e.g. 'p.potential' for a user property.)
+        Returns the values written.
+        """
+        selection = selection or self.molecule
+        values = self.atom_potentials(selection)
+        self.pymol_cmd.alter_atoms(selection, prop, values)
+        return values
+
+    def residue_potentials(self, selection=None):
+        """Mean potential over the atoms of each residue in `selection`
+        (default: the molecule), as a list of (object, chain, resi, resn,
+        potential, number of atoms) tuples, in atom order.
+        """
+        selection = selection or self.molecule
+        keys = []
+        self.pymol_cmd.iterate(selection, '_keys.append((model, chain, resi, resn))',
+            space={'_keys': keys})
+        values = self.atom_potentials(selection)
+        if len(values) != len(keys):
+            raise util.PluginException(f"Selection '{selection}' has {len(keys)} "
+                f"atoms but {len(values)} coordinates.")
+        residues = dict() # key -> residue index, in order of first atom
+        inverse = np.fromiter((residues.setdefault(k, len(residues)) for k in keys),
+            dtype=np.intp, count=len(keys))
+        sums = np.bincount(inverse, weights=values, minlength=len(residues))
+        counts = np.bincount(inverse, minlength=len(residues))
+        return [
+            (*k, float(sums[i] / counts[i]), int(counts[i])) for k, i in residues.items()
+        ]
 
 # ------------------------------------------------------------------------------
 # Views
@@ -169,29 +427,32 @@ class VizDialogView(QtWidgets.QDialog, Ui_other_viz_dialog):
 # ------------------------------------------------------------------------------
 # Controller
 
-class VizDialogController(util.BaseController):
+class VizDialogController(util.DialogController):
     def __init__(self, model):
         super(VizDialogController, self).__init__()
         self.model = model
-        self.view = VizDialogView()
 
-        util.biconnect(self.view.pos_iso_checkBox, self.model, "show_pos_iso")
-        util.biconnect(self.view.pos_iso_doubleSpinBox, self.model, "pos_surf_val")
-        util.biconnect(self.view.pos_iso_color_lineEdit, self.model, "pos_surf_color")
+    def init_view(self):
+        view = VizDialogView()
 
-        util.biconnect(self.view.neg_iso_checkBox, self.model, "show_neg_iso")
-        util.biconnect(self.view.neg_iso_doubleSpinBox, self.model, "neg_surf_val")
-        util.biconnect(self.view.neg_iso_color_lineEdit, self.model, "neg_surf_color")
+        util.biconnect(view.pos_iso_checkBox, self.model, "show_pos_iso")
+        util.biconnect(view.pos_iso_doubleSpinBox, self.model, "pos_surf_val")
+        util.biconnect(view.pos_iso_color_lineEdit, self.model, "pos_surf_color")
 
-        util.biconnect(self.view.fieldlines_checkBox, self.model, "show_fieldlines")
+        util.biconnect(view.neg_iso_checkBox, self.model, "show_neg_iso")
+        util.biconnect(view.neg_iso_doubleSpinBox, self.model, "neg_surf_val")
+        util.biconnect(view.neg_iso_color_lineEdit, self.model, "neg_surf_color")
+
+        util.biconnect(view.fieldlines_checkBox, self.model, "show_fieldlines")
+        util.biconnect(view.max_fieldlines_spinBox, self.model, "max_fieldlines")
         # TODO: fieldlines_ramp_lineEdit
 
+        util.biconnect(view.map_memory_spinBox, self.model.pymol_cmd, "max_map_memory")
+
         # init view from model values
         self.model.refresh()
-
-    @util.PYQT_SLOT()
-    def exec_(self):
-        self.view.exec_()
+        self.model.pymol_cmd.refresh()
+        return view
 
 class VizGroupBoxController(util.BaseController):
     def __init__(self, pymol_controller=None, view=None):
@@ -199,7 +460,7 @@ class VizGroupBoxController(util.BaseController):
         if pymol_controller is None:
             raise ValueError
         self.model = VisualizationModel(
-            pymol_cmd = pymol_controller.model.pymol_instance
+            pymol_cmd = pymol_controller.model
         )
         self.dialog_controller = VizDialogController(self.model)
         if view is None:
@@ -209,6 +470,7 @@ class VizGroupBoxController(util.BaseController):
 
         util.biconnect(self.view.viz_surface_checkBox, self.model, "do_mol_viz")
         util.biconnect(self.view.viz_range_doubleSpinBox, self.model, "mol_surf")
+        util.biconnect(self.view.auto_levels_checkBox, self.model, "auto_levels")
 
         util.biconnect(self.view.other_viz_checkBox, self.model, "do_other_viz")
         self.view.other_viz_options_button.clicked.connect(self.dialog_controller.exec_)
@@ -20,6 +20,8 @@ PLUGIN_DIALOG = None
 def run_plugin_gui():
     '''Open our custom dialog.
     '''
+    import time
+    t_start = time.perf_counter()
     import APBS_Qt_plugin.util as util
     global PLUGIN_DIALOG
 
@@ -32,7 +34,7 @@ def run_plugin_gui():
         if PLUGIN_DIALOG is None:
             import APBS_Qt_plugin.plugin as plugin
             PLUGIN_DIALOG = plugin.PluginController()
-        PLUGIN_DIALOG.show()
+        PLUGIN_DIALOG.show(t_start)
 
     # handle uncaught exceptions
     except util.PluginDialogException as exc:
@@ -0,0 +1,501 @@
+#!/usr/bin/env python
+"""
+Timing benchmarks for the plugin's performance-sensitive code paths. Usage:
+
+    python tests/benchmarks.py <benchmark name> [--sizes N [N ...]]
+
+Benchmarks comparing against PyMol's own implementation are skipped if pymol
+can't be imported.
+"""
+import argparse
+import os.path
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+this_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.dirname(this_dir))
+
+BENCHMARKS = dict()
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+def timed(func, *args, repeat=3, **kwargs):
+    """Best-of-`repeat` wall clock time of func(*args, **kwargs), in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def get_pymol_cmd():
+    try:
+        import pymol
+        pymol.finish_launching(['pymol', '-qc'])
+        from pymol import cmd
+        return cmd
+    except ImportError:
+        print("(pymol not available; skipping comparison)")
+        return None
+
+def report(label, n, **times):
+    cols = '  '.join(f"{k}: {v:8.4f} s" for k, v in times.items())
+    print(f"{label:>12} {n:>10}  {cols}")
+
+# ------------------------------------------------------------------------------
+
+def write_synthetic_dx(path, counts, origin=(-50., -50., -50.), delta=(0.5, 0.5, 0.5)):
+    """Write a DX file with random contents, formatted as APBS does."""
+    data = np.random.default_rng(0).normal(size=counts).astype(np.float32)
+    with open(path, 'w') as f:
+        f.write("# Data from synthetic benchmark\n")
+        f.write("object 1 class gridpositions counts %d %d %d\n" % counts)
+        f.write("origin %12.6e %12.6e %12.6e\n" % origin)
+        f.write("delta %12.6e 0.000000e+00 0.000000e+00\n" % delta[0])
+        f.write("delta 0.000000e+00 %12.6e 0.000000e+00\n" % delta[1])
+        f.write("delta 0.000000e+00 0.000000e+00 %12.6e\n" % delta[2])
+        f.write("object 2 class gridconnections counts %d %d %d\n" % counts)
+        f.write("object 3 class array type double rank 0 items %d data follows\n" % data.size)
+        flat = data.ravel()
+        n_full = (flat.size // 3) * 3
+        np.savetxt(f, flat[:n_full].reshape(-1, 3), fmt='%12.6e')
+        if flat.size > n_full:
+            f.write(' '.join('%12.6e' % x for x in flat[n_full:]) + '\n')
+        f.write('attribute "dep" string "positions"\n')
+        f.write('object "regular positions regular connections" class field\n')
+        f.write('component "positions" value 1\n')
+        f.write('component "connections" value 2\n')
+        f.write('component "data" value 3\n')
+    return data
+
+@benchmark
+def dx_read(args):
+    """Read an n^3 DX map: apbs.load_apbs_map's numpy reader vs. cmd.load."""
+    from APBS_Qt_plugin.core import dx
+    cmd = get_pymol_cmd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n in (args.sizes or [33, 65, 97, 129, 161, 193]):
+            path = os.path.join(tmp_dir, f'bench_{n}.dx')
+            write_synthetic_dx(path, (n, n, n))
+            times = {'numpy': timed(dx.read_dx, path)}
+            if cmd is not None:
+                times['pymol'] = timed(cmd.load, path, 'bench_map', format='dx')
+                cmd.delete('bench_map')
+            report('dx_read', n, **times)
+            os.remove(path)
+
+# ------------------------------------------------------------------------------
+
+class _FakeAtom():
+    # stand-in for chempy.Atom, when pymol isn't available
+    __slots__ = ('coord', 'elec_radius')
+    def __init__(self, coord, elec_radius):
+        self.coord = coord
+        self.elec_radius = elec_radius
+
+def _loop_bounding_box(atoms):
+    # previous per-atom implementation of GridPluginModel.set_grid_params
+    mins = [None, None, None]
+    maxs = [None, None, None]
+    for a in atoms:
+        for i in (0, 1, 2):
+            if mins[i] is None or (a.coord[i] - a.elec_radius) < mins[i]:
+                mins[i] = a.coord[i] - a.elec_radius
+            if maxs[i] is None or (a.coord[i] + a.elec_radius) > maxs[i]:
+                maxs[i] = a.coord[i] + a.elec_radius
+    return mins, maxs
+
+def _get_model_bounding_box(cmd, selection):
+    # previous implementation: build a chempy model, then loop over its atoms
+    return _loop_bounding_box(cmd.get_model(selection).atom)
+
+def _get_coords_bounding_box(cmd, selection):
+    # current implementation of GridPluginModel.set_grid_params
+    from APBS_Qt_plugin.core import grid
+    radii = []
+    cmd.iterate(selection, 'radii.append(elec_radius)', space={'radii': radii})
+    return grid.bounding_box(cmd.get_coords(selection), radii)
+
+@benchmark
+def grid_bbox(args):
+    """Molecular bounding box for n atoms: cmd.get_model and a per-atom loop vs.
+    cmd.get_coords, cmd.iterate and a numpy reduction, on a PQR file loaded
+    into pymol. If pymol can't be imported, the loop runs over synthetic atom
+    objects instead, and only the numpy reduction is timed against it.
+    """
+    from APBS_Qt_plugin.core import grid
+    cmd = get_pymol_cmd()
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n in (args.sizes or [1000, 10000, 100000, 1000000]):
+            if cmd is not None:
+                path = os.path.join(tmp_dir, f'bench_{n}.pqr')
+                write_synthetic_pqr(path, n)
+                cmd.load(path, 'bench_mol', format='pqr')
+                report('grid_bbox', n,
+                    get_model = timed(_get_model_bounding_box, cmd, 'bench_mol', repeat=1),
+                    get_coords = timed(_get_coords_bounding_box, cmd, 'bench_mol')
+                )
+                cmd.delete('bench_mol')
+                os.remove(path)
+            else:
+                coords = rng.uniform(-100., 100., size=(n, 3)).astype(np.float32)
+                radii = rng.uniform(1., 2., size=n).tolist()
+                atoms = [_FakeAtom(c, r) for c, r in zip(coords.tolist(), radii)]
+                report('grid_bbox', n,
+                    synthetic_loop = timed(_loop_bounding_box, atoms),
+                    numpy = timed(grid.bounding_box, coords, radii)
+                )
+
+# ------------------------------------------------------------------------------
+
+def write_synthetic_pqr(path, n_atoms):
+    """Write a PQR file of n_atoms records at random coordinates, including the
+    run-together coordinate columns that PQRBaseModel.clean_pqr_columns fixes.
+    """
+    rng = np.random.default_rng(0)
+    coords = rng.uniform(-150., 150., size=(n_atoms, 3))
+    charges = rng.uniform(-1., 1., size=n_atoms)
+    radii = rng.uniform(1., 2., size=n_atoms)
+    with open(path, 'w') as f:
+        f.write("REMARK   1 PQR file generated by synthetic benchmark\n")
+        f.write("REMARK   5    17 atom in residue XYZ could not be assigned\n")
+        for i in range(n_atoms):
+            f.write("ATOM  %5d  CA  ALA A%4d    %8.3f%8.3f%8.3f %7.4f %6.4f\n" % (
+                i % 100000, (i // 10) % 10000, *coords[i], charges[i], radii[i]
+            ))
+
+def measure(func, *args):
+    """Return (wall clock time, peak python heap usage in MB) of one call."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / (1024. * 1024.)
+
+def _in_memory_clean_pqr(path):
+    # previous implementation: read whole file, regex, rewrite
+    from APBS_Qt_plugin.core import pqr
+    with open(path, 'r+') as f:
+        pqr_text = f.read()
+        pqr_text = pqr.clean_pqr_columns(pqr_text)
+        unassigned_atoms = pqr.get_unassigned_atoms(pqr_text)
+        f.seek(0)
+        f.write(pqr_text)
+        f.truncate()
+
+@benchmark
+def pqr_clean(args):
+    """Clean columns of a PQR file of n MB: in-memory vs. streaming."""
+    from APBS_Qt_plugin.core import pqr
+    bytes_per_atom = 71
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_mb in (args.sizes or [1, 10, 100]):
+            path = os.path.join(tmp_dir, f'bench_{n_mb}.pqr')
+            write_synthetic_pqr(path, n_mb * 1024 * 1024 // bytes_per_atom)
+            t_old, mem_old = measure(_in_memory_clean_pqr, path)
+            t_new, mem_new = measure(pqr.clean_pqr_file, path)
+            report('pqr_clean', n_mb, in_memory=t_old, streaming=t_new)
+            print(f"{'':>23}  peak MB: in_memory: {mem_old:8.1f}    streaming: {mem_new:8.1f}")
+            os.remove(path)
+
+# ------------------------------------------------------------------------------
+
+def _notified_list_build(model_cls, n, connect, batch=False):
+    model = model_cls()
+    connect(model)
+    if batch:
+        with model.batch_update():
+            for i in range(n):
+                model.values.append(str(i))
+    else:
+        for i in range(n):
+            model.values.append(str(i))
+
+@benchmark
+def notified_list(args):
+    """Append n items one at a time to a list-valued model field, with a view
+    connected to the field's full-value Signal (QVariantList conversion of the
+    whole list per append) vs. its change descriptor Signal, and in a batch.
+    """
+    import attrs
+    try:
+        from APBS_Qt_plugin import util
+    except ImportError:
+        print("(pymol.Qt not available; skipping)")
+        return
+
+    @util.attrs_define
+    class _ListModel(util.BaseModel):
+        values: list = attrs.Factory(list)
+
+    def _on_update(values):
+        pass
+    def _on_change(change):
+        pass
+
+    for n in (args.sizes or [1000, 10000]):
+        report('notified_list', n,
+            full = timed(_notified_list_build, _ListModel, n,
+                lambda m: m.values_update.connect(_on_update)),
+            changes = timed(_notified_list_build, _ListModel, n,
+                lambda m: m.values_changed.connect(_on_change)),
+            batched = timed(_notified_list_build, _ListModel, n,
+                lambda m: m.values_update.connect(_on_update), batch=True)
+        )
+
+def _legacy_field_transformer(util):
+    # previous field transformer: every field piped through convert and
+    # validate, with signal names and types looked up on each assignment
+    import attrs
+
+    def _legacy_setter_emit(obj, attr_obj, value):
+        old_val = getattr(obj, attr_obj.name)
+        if old_val != value:
+            p = util.PropertyNames.from_name(attr_obj.name)
+            signal = getattr(obj, p.signal_name, None)
+            if signal:
+                if hasattr(value, "coerce_to_signal"):
+                    val = value.coerce_to_signal(signal)
+                else:
+                    val = util._type_from_signal(signal)(value)
+                signal.emit(val)
+        return value
+
+    def _transformer(cls, fields):
+        return [f.evolve(on_setattr=attrs.setters.pipe(
+            attrs.setters.convert, attrs.setters.validate, _legacy_setter_emit
+        )) for f in fields]
+    return _transformer
+
+def _assign_fields(model, n):
+    for i in range(n):
+        model.x = i
+        model.y = float(i)
+        model.name = str(i)
+
+@benchmark
+def model_setter(args):
+    """Assign n new values to each of three scalar fields of a model, with a
+    view connected: per-assignment lookup of signal names and types (previous
+    setter) vs. the setters generated at class creation.
+    """
+    import attrs
+    try:
+        from APBS_Qt_plugin import util
+    except ImportError:
+        print("(pymol.Qt not available; skipping)")
+        return
+
+    @attrs.define(slots=True, kw_only=True,
+        field_transformer=_legacy_field_transformer(util))
+    class _LegacyModel(util.BaseModel):
+        x: int = 0
+        y: float = 0.
+        name: str = ""
+
+    @util.attrs_define
+    class _Model(util.BaseModel):
+        x: int = 0
+        y: float = 0.
+        name: str = ""
+
+    def _on_update(value):
+        pass
+
+    def _make(model_cls):
+        model = model_cls()
+        for name in ('x', 'y', 'name'):
+            util.connect_signal(model, name, _on_update)
+        return model
+
+    for n in (args.sizes or [10000, 100000]):
+        report('model_setter', n,
+            before = timed(_assign_fields, _make(_LegacyModel), n),
+            after = timed(_assign_fields, _make(_Model), n)
+        )
+
+# ------------------------------------------------------------------------------
+
+_IMPORT_CORE = "import APBS_Qt_plugin.batch"
+_IMPORT_PLUGIN = "import APBS_Qt_plugin.plugin"
+_CHECK_NO_QT = ("import sys; assert not [m for m in sys.modules "
+    "if m.split('.')[0] in ('pymol', 'PyQt5', 'PySide2')], 'Qt was imported'")
+
+def _time_import(statement, quiet=False):
+    # wall clock time of a fresh interpreter running `statement`
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', statement], cwd=os.path.dirname(this_dir),
+        stderr=(subprocess.DEVNULL if quiet else None), check=True)
+    return time.perf_counter() - start
+
+@benchmark
+def import_time(args):
+    """Start a fresh interpreter (n times, best time reported) and import: the
+    Qt-free core used by batch workers vs. the full plugin (skipped if pymol
+    can't be imported); times include interpreter startup, given as 'python'.
+    """
+    n = (args.sizes or [5])[0]
+    times = {
+        'python': min(_time_import("pass") for _ in range(n)),
+        'core': min(_time_import(f"{_IMPORT_CORE}; {_CHECK_NO_QT}") for _ in range(n))
+    }
+    try:
+        times['plugin'] = min(_time_import(_IMPORT_PLUGIN, quiet=True) for _ in range(n))
+    except subprocess.CalledProcessError:
+        print("(pymol.Qt not available; skipping plugin import)")
+    report('import_time', n, **times)
+
+# ------------------------------------------------------------------------------
+
+def synthetic_dipole_map(n, delta=0.5, separation=10.):
+    """DXMap of an n^3 grid centered on a pair of opposite unit charges."""
+    from APBS_Qt_plugin.core import dx
+    origin = -0.5 * delta * (n - 1)
+    axis = origin + delta * np.arange(n, dtype=np.float32)
+    x, y, z = np.meshgrid(axis, axis, axis, indexing='ij', sparse=True)
+    data = np.zeros((n, n, n), dtype=np.float32)
+    for q, x0 in ((1., 0.5 * separation), (-1., -0.5 * separation)):
+        data += q / np.sqrt((x - x0)**2 + y**2 + z**2 + 1.)
+    return dx.DXMap(data=data, origin=(origin,) * 3, delta=(delta,) * 3)
+
+def _trace_from_surface(dx_map, coords, radii, n_lines):
+    from APBS_Qt_plugin.core import fieldlines
+    seeds = fieldlines.surface_seeds(coords, radii, n_lines)
+    return fieldlines.trace_field_lines(dx_map, seeds)
+
+def _exact_map_stats(data):
+    # extra passes over the whole map, after it's been read
+    return (data.min(), data.max(), data.mean(), data.std(),
+        np.percentile(data, [1., 5., 95., 99.]))
+
+@benchmark
+def map_stats(args):
+    """Statistics and percentiles of an n^3 map: chunked histogram (as done
+    while reading a DX file) vs. exact numpy reductions over the whole map.
+    """
+    from APBS_Qt_plugin.core import mapstats
+    for n in (args.sizes or [65, 129, 193]):
+        data = synthetic_dipole_map(n).data
+        report('map_stats', n,
+            exact = timed(_exact_map_stats, data),
+            histogram = timed(mapstats.MapStats.from_array, data)
+        )
+
+def _sample_each_point(dx_map, points):
+    # what a script sampling one atom at a time does
+    from APBS_Qt_plugin.core import dx
+    return [dx.sample_points(dx_map, p) for p in points]
+
+@benchmark
+def point_sampling(args):
+    """Potential at n atoms of a 129^3 map: one call per atom vs. one call."""
+    from APBS_Qt_plugin.core import dx
+    dx_map = synthetic_dipole_map(129)
+    rng = np.random.default_rng(0)
+    for n in (args.sizes or [1000, 10000, 100000]):
+        points = rng.uniform(-30., 30., size=(n, 3))
+        report('point_sampling', n,
+            per_atom = timed(_sample_each_point, dx_map, points, repeat=1),
+            vectorized = timed(dx.sample_points, dx_map, points)
+        )
+
+def _alter_each_atom(cmd, obj_name, values):
+    # what a script writing one atom at a time does
+    for i, v in enumerate(values.tolist()):
+        cmd.alter(f"{obj_name} and index {i + 1}", f"b = {v!r}")
+
+@benchmark
+def atom_write(args):
+    """Write n per-atom values to b-factors: one cmd.alter call per atom (up to
+    10k atoms) vs. PyMolModel.alter_atoms (skipped if pymol can't be imported.)
+    """
+    cmd = get_pymol_cmd()
+    if cmd is None:
+        return
+    from APBS_Qt_plugin import pymol_api
+    model = pymol_api.PyMolModel()
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n in (args.sizes or [1000, 10000, 100000, 1000000]):
+            path = os.path.join(tmp_dir, f'bench_{n}.pqr')
+            write_synthetic_pqr(path, n)
+            cmd.load(path, 'bench_mol', format='pqr')
+            values = rng.normal(size=cmd.count_atoms('bench_mol'))
+            times = dict()
+            if n <= 10000:
+                times['per_atom'] = timed(_alter_each_atom, cmd, 'bench_mol', values,
+                    repeat=1)
+            times['alter_atoms'] = timed(model.alter_atoms, 'bench_mol', 'b', values)
+            report('atom_write', n, **times)
+            cmd.delete('bench_mol')
+            os.remove(path)
+
+@benchmark
+def fieldlines(args):
+    """Field lines on an n^3 map from 1000 seeds on the surface of 5000 atoms:
+    numpy RK4 tracer vs. cmd.gradient (skipped if pymol can't be imported.)
+    """
+    cmd = get_pymol_cmd()
+    rng = np.random.default_rng(0)
+    coords = rng.normal(scale=8., size=(5000, 3))
+    radii = np.full(len(coords), 1.7)
+    for n in (args.sizes or [65, 129, 201]):
+        dx_map = synthetic_dipole_map(n)
+        times = {'numpy': timed(_trace_from_surface, dx_map, coords, radii, 1000, repeat=1)}
+        if cmd is not None:
+            from chempy.brick import Brick
+            cmd.load_brick(Brick.from_numpy(dx_map.data, dx_map.delta, dx_map.origin),
+                'bench_map')
+            times['pymol'] = timed(cmd.gradient, 'bench_grad', 'bench_map', repeat=1)
+            cmd.delete('bench_*')
+        report('fieldlines', n, **times)
+
+def _in_memory_map_difference(path_a, path_b, out_path):
+    # read both maps whole, resample B onto A's grid, and write A - B
+    from APBS_Qt_plugin.core import dx
+    a, b = dx.read_dx(path_a), dx.read_dx(path_b)
+    axes = [a.origin[i] + a.delta[i] * np.arange(a.counts[i]) for i in range(3)]
+    diff = a.data - dx._sample_block(b, *axes)
+    dx.write_dx(dx.DXMap(data=diff, origin=a.origin, delta=a.delta), out_path)
+
+@benchmark
+def map_arith(args):
+    """A - B for two n^3 DX maps on offset grids: whole maps in memory vs.
+    maparith.evaluate streaming through the files in slabs.
+    """
+    from APBS_Qt_plugin.core import maparith
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n in (args.sizes or [65, 129, 193]):
+            path_a = os.path.join(tmp_dir, f'bench_a_{n}.dx')
+            path_b = os.path.join(tmp_dir, f'bench_b_{n}.dx')
+            out_path = os.path.join(tmp_dir, f'bench_out_{n}.dx')
+            write_synthetic_dx(path_a, (n, n, n))
+            write_synthetic_dx(path_b, (n, n, n), origin=(-49.75, -49.75, -49.75))
+            t_old, mem_old = measure(_in_memory_map_difference, path_a, path_b, out_path)
+            t_new, mem_new = measure(maparith.evaluate, 'A - B',
+                {'A': path_a, 'B': path_b}, out_path)
+            report('map_arith', n, in_memory=t_old, streaming=t_new)
+            print(f"{'':>23}  peak MB: in_memory: {mem_old:8.1f}    streaming: {mem_new:8.1f}")
+            for path in (path_a, path_b, out_path):
+                os.remove(path)
+
+# ------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('name', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--sizes', type=int, nargs='+', default=None,
+        help="Problem sizes to run (meaning depends on benchmark).")
+    args = parser.parse_args()
+    BENCHMARKS[args.name](args)
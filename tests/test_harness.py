@@ -2,6 +2,7 @@
 
 import os.path
 import sys
+import time
 from pymol.Qt import QtWidgets
 
 this_dir = os.path.dirname(os.path.realpath(__file__))
@@ -15,9 +16,10 @@ class App(QtWidgets.QApplication):
     def __init__(self, sys_argv):
         super(App, self).__init__(sys_argv)
         global PLUGIN_DIALOG
+        t_start = time.perf_counter()
         if PLUGIN_DIALOG is None:
             PLUGIN_DIALOG = plugin.PluginController()
-        PLUGIN_DIALOG.show()
+        PLUGIN_DIALOG.show(t_start)
 
 
 if __name__ == '__main__':